@@ -0,0 +1,236 @@
+import argparse
+import glob
+import logging
+import os
+
+import pandas as pd
+
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+
+# Plots are optional, summaries only need pandas
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+REPOSITORY_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_FOLDER = os.path.join(REPOSITORY_FOLDER, "data")
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+CHUNK_SIZE = 200000 #rows
+PLOT_INTERVAL = "1h"
+CSV_DTYPES = {"n": "category", "bn": "category", "v": "float64", "u": "category", "t": "float64"}
+
+
+def find_data_files(data_folder, data_file):
+    """
+    Active csv file and the files rotated from it, oldest first
+    :param data_folder: collector DATA_FOLDER
+    :param data_file: collector DATA_FILE
+    :return: list of file paths
+    """
+    stem, extension = os.path.splitext(os.path.join(data_folder, data_file))
+    file_paths = glob.glob(f"{glob.escape(stem)}-*{extension}")
+    if os.path.isfile(stem + extension):
+        file_paths.append(stem + extension)
+    return sorted(file_paths, key=lambda file_path: (os.path.getmtime(file_path), file_path))
+
+
+class ConsumptionSummary:
+    """
+    Per device statistics built chunk by chunk
+    Memory depends on the number of devices (and plot buckets), not on the number of rows
+    Consumption is the sum of the positive level deltas of each device, as in ConsumptionAggregator,
+    rows of a device must be in time order across chunks, as written by the collector
+    """
+
+    def __init__(self, prices=pmParams.RESOURCE_PRICES, plot_interval=PLOT_INTERVAL):
+        """
+        :param prices: {resource type: price per unit}
+        :param plot_interval: pandas offset of plot buckets, None skips plot data
+        """
+        self.prices = pd.Series(prices, dtype="float64")
+        self.plot_interval = pd.Timedelta(plot_interval).total_seconds() if plot_interval else None
+        self.devices = None
+        # Last level of every device, links deltas across chunks
+        self.last_levels = pd.Series(dtype="float64")
+        self.buckets = None
+        self.rows = 0
+
+    def add_chunk(self, chunk):
+        """
+        :param chunk: DataFrame with n, bn, v, u, t columns
+        :return:
+        """
+        chunk = chunk.dropna(subset=["n", "v", "t"])
+        if chunk.empty:
+            return
+        self.rows += len(chunk)
+        chunk = chunk.sort_values(["n", "t"], kind="stable")
+        device = chunk["n"].astype(str)
+        # Deltas within the chunk, the first row of a device uses the previous chunk last level
+        previous = chunk.groupby(device, sort=False)["v"].shift()
+        previous = previous.fillna(device.map(self.last_levels))
+        consumption = (chunk["v"] - previous).clip(lower=0).fillna(0.0)
+        price = chunk["bn"].astype(str).map(self.prices).fillna(0.0)
+        frame = pd.DataFrame({
+            "n": device,
+            "bn": chunk["bn"].astype(str),
+            "u": chunk["u"].astype(str),
+            "v": chunk["v"],
+            "t": chunk["t"],
+            "consumption": consumption,
+            "cost": consumption * price,
+        })
+        grouped = frame.groupby("n", sort=False).agg(
+            bn=("bn", "last"), u=("u", "last"), count=("v", "size"), sum=("v", "sum"),
+            min=("v", "min"), max=("v", "max"), first_t=("t", "first"), last_t=("t", "last"),
+            last=("v", "last"), consumption=("consumption", "sum"), cost=("cost", "sum"))
+        self.merge_devices(grouped)
+        self.last_levels = grouped["last"].combine_first(self.last_levels)
+        if self.plot_interval:
+            self.add_buckets(frame)
+
+    def merge_devices(self, grouped):
+        if self.devices is None:
+            self.devices = grouped
+            return
+        devices = self.devices.reindex(self.devices.index.union(grouped.index))
+        grouped = grouped.reindex(devices.index)
+        for column in ("count", "sum", "consumption", "cost"):
+            devices[column] = devices[column].fillna(0) + grouped[column].fillna(0)
+        devices["min"] = pd.concat([devices["min"], grouped["min"]], axis=1).min(axis=1)
+        devices["max"] = pd.concat([devices["max"], grouped["max"]], axis=1).max(axis=1)
+        devices["first_t"] = devices["first_t"].combine_first(grouped["first_t"])
+        for column in ("bn", "u", "last_t", "last"):
+            devices[column] = grouped[column].combine_first(devices[column])
+        self.devices = devices
+
+    def add_buckets(self, frame):
+        """
+        Sum of levels and consumption per device and time bucket, for plots
+        """
+        bucket = (frame["t"] // self.plot_interval) * self.plot_interval
+        buckets = frame.groupby([frame["n"], frame["bn"], bucket]).agg(
+            v_sum=("v", "sum"), v_count=("v", "size"), cost=("cost", "sum"))
+        self.buckets = buckets if self.buckets is None else buckets.add(self.buckets, fill_value=0)
+
+    def device_summary(self):
+        """
+        :return: DataFrame indexed by device with count, min, max, mean, last, consumption, cost
+        """
+        if self.devices is None:
+            return pd.DataFrame()
+        summary = self.devices.copy()
+        summary["mean"] = summary["sum"] / summary["count"]
+        summary["first_time"] = pd.to_datetime(summary.pop("first_t"), unit="s")
+        summary["last_time"] = pd.to_datetime(summary.pop("last_t"), unit="s")
+        summary["count"] = summary["count"].astype("int64")
+        summary.index.name = "n"
+        return summary[["bn", "u", "count", "min", "max", "mean", "last", "consumption", "cost", "first_time", "last_time"]]
+
+    def family_summary(self):
+        """
+        :return: DataFrame indexed by resource type with devices, count, mean, consumption, cost
+        """
+        if self.devices is None:
+            return pd.DataFrame()
+        family = self.devices.groupby("bn").agg(
+            u=("u", "last"), devices=("count", "size"), count=("count", "sum"), sum=("sum", "sum"),
+            consumption=("consumption", "sum"), cost=("cost", "sum"))
+        family["mean"] = family.pop("sum") / family["count"]
+        family["count"] = family["count"].astype("int64")
+        family["price"] = family.index.map(self.prices)
+        return family[["u", "devices", "count", "mean", "consumption", "price", "cost"]]
+
+
+def summarize_files(file_paths, chunk_size=CHUNK_SIZE, prices=pmParams.RESOURCE_PRICES, plot_interval=PLOT_INTERVAL):
+    """
+    Stream csv files through a ConsumptionSummary
+    :param file_paths: csv files with the collector header, oldest first
+    :param chunk_size: rows read at once
+    :return: ConsumptionSummary
+    """
+    summary = ConsumptionSummary(prices, plot_interval)
+    for file_path in file_paths:
+        logging.info(f"Reading {file_path}")
+        for chunk in pd.read_csv(file_path, usecols=storageParams.CSV_HEADER, dtype=CSV_DTYPES, chunksize=chunk_size):
+            summary.add_chunk(chunk)
+    return summary
+
+
+def save_plots(summary, output_folder):
+    """
+    Device levels and per family cost over time, from the bucketed data
+    :return: list of saved image paths
+    """
+    if plt is None:
+        logging.warning("matplotlib is not installed, skipping plots")
+        return []
+    if summary.buckets is None:
+        return []
+    buckets = summary.buckets.reset_index()
+    buckets["datetime"] = pd.to_datetime(buckets["t"], unit="s")
+    buckets["v"] = buckets["v_sum"] / buckets["v_count"]
+    saved = []
+
+    families = sorted(buckets["bn"].unique())
+    fig, axs = plt.subplots(len(families), sharex="all", squeeze=False, figsize=(10, 3 * len(families)), dpi=90)
+    fig.suptitle("Device measured level over time")
+    for ax, family in zip(axs[:, 0], families):
+        ax.set_title(family)
+        for device, values in buckets[buckets["bn"] == family].groupby("n"):
+            ax.plot(values["datetime"], values["v"], label=device)
+        if buckets[buckets["bn"] == family]["n"].nunique() <= 10:
+            ax.legend()
+    axs[-1, 0].set_xlabel("Datetime")
+    saved.append(os.path.join(output_folder, "device_levels.png"))
+    fig.savefig(saved[-1])
+    plt.close(fig)
+
+    cost = buckets.groupby(["bn", "datetime"])["cost"].sum().groupby(level="bn").cumsum()
+    fig, ax = plt.subplots(figsize=(10, 4), dpi=90)
+    fig.suptitle("Sensor family supply cost in euros")
+    for family, values in cost.groupby(level="bn"):
+        ax.plot(values.index.get_level_values("datetime"), values.values, label=family)
+    ax.set_xlabel("Datetime")
+    ax.set_ylabel("Cumulative cost")
+    ax.legend()
+    saved.append(os.path.join(output_folder, "family_cost.png"))
+    fig.savefig(saved[-1])
+    plt.close(fig)
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consumption and cost summaries of the collector csv output")
+    parser.add_argument("files", nargs="*", help="csv files, defaults to the active and rotated collector files")
+    parser.add_argument("--data-folder", default=DATA_FOLDER, help="collector data folder")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows read at once")
+    parser.add_argument("--plot-interval", default=PLOT_INTERVAL, help="plot bucket size, pandas offset like 15min or 1h")
+    parser.add_argument("--no-plots", action="store_true", help="only write summary tables")
+    parser.add_argument("--output", default=RESULTS_FOLDER, help="folder of summary tables and plots")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+
+    file_paths = args.files or find_data_files(args.data_folder, storageParams.DATA_FILE)
+    if not file_paths:
+        parser.error(f"no {storageParams.DATA_FILE} files in {args.data_folder}")
+    summary = summarize_files(file_paths, args.chunk_size, plot_interval=None if args.no_plots else args.plot_interval)
+    os.makedirs(args.output, exist_ok=True)
+    device_summary = summary.device_summary()
+    family_summary = summary.family_summary()
+    device_summary.to_csv(os.path.join(args.output, "device_summary.csv"))
+    family_summary.to_csv(os.path.join(args.output, "family_summary.csv"))
+    print(f"{summary.rows} records from {len(file_paths)} files\n")
+    print(device_summary.to_string(), end="\n\n")
+    print(family_summary.to_string())
+    saved = [] if args.no_plots else save_plots(summary, args.output)
+    print(f"\nResults saved to {args.output}" + "".join(f"\n  {path}" for path in saved))
+
+
+if __name__ == '__main__':
+    main()
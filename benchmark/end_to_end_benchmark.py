@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from mqtt.broker.in_process_broker import InProcessBroker
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.conf.sensor_conf_values import WaterConfValues, GasConfValues, ElectricityConfValues
+from mqtt.consumer.policy_manager_data_collector import PolicyManagerAndDataCollector
+from mqtt.device.metering_smart_object import MeteringSmartObject
+from mqtt.message import senml_decoder
+from mqtt.resource.water_sensor_resource import WaterSensorResource
+from mqtt.resource.gas_sensor_resource import GasSensorResource
+from mqtt.resource.electricity_sensor_resource import ElectricitySensorResource
+from mqtt.resource.generic_actuator_resource import GenericActuatorResource
+
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Resource name -> (sensor class, conf values)
+RESOURCES = {
+    "water": (WaterSensorResource, WaterConfValues),
+    "gas": (GasSensorResource, GasConfValues),
+    "electricity": (ElectricitySensorResource, ElectricityConfValues),
+}
+
+TICK = 0.01 #s
+LEVEL_STEP = 0.001
+# Far above every SUPPLY_THRESHOLD
+LEVEL_JUMP = 100.0
+DRAIN_TIMEOUT = 10 #s
+
+
+class CountingRecordSink:
+    """
+    Record sink counting rows instead of storing them
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.last_record_time = None
+
+    def open(self):
+        pass
+
+    def write_record(self, row):
+        self.records += 1
+        self.last_record_time = time.perf_counter()
+
+    def buffered_records(self):
+        return 0
+
+    def flush(self, sync=False):
+        return True
+
+    def sync(self):
+        return True
+
+    async def start_periodic_flush_task(self, interval=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class BenchmarkDevice:
+    """
+    Emulated device driven by the benchmark instead of its sensor task
+    Every alert_every values the level jumps over the threshold,
+    the time until the matching alert reaches the device is the latency
+    """
+
+    def __init__(self, smart_object, sens_values, alert_every, latencies):
+        self.smart_object = smart_object
+        self.sens_values = sens_values
+        self.alert_every = alert_every
+        self.latencies = latencies
+        self.level = sens_values.MIN_USAGE
+        self.sent_values = 0
+        self.crossing_time = None
+        self.handle_control_message = smart_object.handle_control_message
+        smart_object.handle_control_message = self.on_control_message
+
+    def send_value(self):
+        self.sent_values += 1
+        if self.sent_values % self.alert_every == 0:
+            self.level += LEVEL_JUMP
+            self.crossing_time = time.perf_counter()
+        else:
+            self.level += LEVEL_STEP
+        self.smart_object.on_data_changed(self.level, type=self.sens_values.RESOURCE_TYPE, unit=self.sens_values.UNIT)
+
+    async def on_control_message(self, message):
+        if self.crossing_time is not None and b"threshold_reached" in message.payload:
+            self.latencies.append(time.perf_counter() - self.crossing_time)
+            self.crossing_time = None
+        await self.handle_control_message(message)
+
+
+def read_rss_kb():
+    """
+    :return: (current, peak) resident set size in kB from /proc, None when unavailable
+    """
+    rss = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    rss[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return rss.get("VmRSS"), rss.get("VmHWM")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def create_devices(broker, device_count, encoding, alert_every, latencies):
+    """
+    Spread devices over plants of three resources each, like the fleet topology
+    :return: list of BenchmarkDevice
+    """
+    devices = []
+    resource_names = list(RESOURCES)
+    for index in range(device_count):
+        resource = resource_names[index % len(resource_names)]
+        sensor_class, sens_values = RESOURCES[resource]
+        plant = f"impianto{index // len(resource_names) + 1:02d}"
+        smart_object = MeteringSmartObject({
+            "sensor": sensor_class(),
+            "actuator": GenericActuatorResource()
+        }, resource, "padiglione-bench", plant, mqtt_client=broker.create_client(client_id=f"bench-device-{index}"))
+        smart_object.telemetry_encoding = encoding
+        await smart_object.on_connect()
+        asyncio.get_event_loop().create_task(smart_object.on_message())
+        await smart_object.subscribe_to_control_topic()
+        devices.append(BenchmarkDevice(smart_object, sens_values, alert_every, latencies))
+    return devices
+
+
+async def drive_devices(devices, rate, duration):
+    """
+    Send rate values per second round robin across devices
+    :return: sent values
+    """
+    sent = 0
+    carry = 0.0
+    index = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        tick_start = time.perf_counter()
+        carry += rate * TICK
+        while carry >= 1:
+            devices[index].send_value()
+            index = (index + 1) % len(devices)
+            carry -= 1
+            sent += 1
+        await asyncio.sleep(max(0.0, TICK - (time.perf_counter() - tick_start)))
+    return sent
+
+
+async def run_benchmark(device_count, rate, duration, encoding, alert_every):
+    broker = InProcessBroker()
+    record_sink = CountingRecordSink()
+    # Fresh write ahead log, nothing replayed from a previous run
+    wal_folder = tempfile.mkdtemp(prefix="bench-wal-")
+    collector = PolicyManagerAndDataCollector(
+        record_sinks=[record_sink],
+        mqtt_client=broker.create_client(client_id="bench-collector"),
+        write_ahead_log_path=os.path.join(wal_folder, "policy_manager.wal"),
+        resume_persistence_path=None
+    )
+    rss_start_kb, _ = read_rss_kb()
+    await collector.start(demo_time=None)
+
+    latencies = []
+    devices = await create_devices(broker, device_count, encoding, alert_every, latencies)
+    # Let info messages reach the collector
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    sent = await drive_devices(devices, rate, duration)
+    drive_time = time.perf_counter() - start
+    drain_deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while record_sink.records < sent and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(TICK)
+    processed_time = (record_sink.last_record_time or time.perf_counter()) - start
+    rss_kb, peak_rss_kb = read_rss_kb()
+    routed_messages = broker.routed_messages
+    # The write ahead log task and file are closed before their folder goes
+    await collector.shutdown()
+    shutil.rmtree(wal_folder, ignore_errors=True)
+
+    return {
+        "sent_messages": sent,
+        "processed_records": record_sink.records,
+        "routed_messages": routed_messages,
+        "offered_rate": sent / drive_time,
+        "throughput": record_sink.records / processed_time if processed_time > 0 else None,
+        "alerts": len(latencies),
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "latency_max_ms": max(latencies) * 1000 if latencies else None,
+        "rss_start_kb": rss_start_kb,
+        "rss_kb": rss_kb,
+        "peak_rss_kb": peak_rss_kb,
+    }
+
+
+def save_results(results, output):
+    folder = os.path.dirname(output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collector end to end benchmark on an in-process broker")
+    parser.add_argument("--devices", type=int, default=300, help="emulated devices")
+    parser.add_argument("--rate", type=float, default=2000, help="telemetry messages per second across all devices")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--encoding", choices=("json", "cbor"), default="json", help="telemetry senml encoding")
+    parser.add_argument("--alert-every", type=int, default=10, help="values per device between threshold crossings")
+    parser.add_argument("--output", help="results json file, defaults to benchmark/results/e2e-<timestamp>.json")
+    args = parser.parse_args()
+
+    # Keep per message logging out of the measure
+    logging.getLogger().setLevel(logging.WARNING)
+    encoding = mqttParams.SENML_CBOR_CONTENT_TYPE if args.encoding == "cbor" else mqttParams.SENML_JSON_CONTENT_TYPE
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics = loop.run_until_complete(run_benchmark(args.devices, args.rate, args.duration, encoding, args.alert_every))
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "json_backend": senml_decoder.JSON_BACKEND,
+        "parameters": {
+            "devices": args.devices,
+            "rate": args.rate,
+            "duration": args.duration,
+            "encoding": encoding,
+            "alert_every": args.alert_every,
+        },
+        "metrics": metrics,
+    }
+    output = args.output or os.path.join(RESULTS_FOLDER, f"e2e-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    save_results(results, output)
+    for key, value in metrics.items():
+        print(f"{key:<20}{value:>14.2f}" if isinstance(value, float) else f"{key:<20}{value!s:>14}")
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import time
+import uuid
+
+from kpn_senml import SenmlPack, SenmlRecord
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.message import senml_decoder
+from mqtt.message.senml_decoder import decode_senml_payload
+from mqtt.message.telemetry_message import TelemetryMessage
+
+MESSAGES = 100000
+
+
+def build_payloads(count, encoding=mqttParams.SENML_JSON_CONTENT_TYPE):
+    """
+    Craft device-like senml payloads
+    :param count: number of payloads
+    :param encoding: senml+json or senml+cbor content type
+    :return: list of bytes
+    """
+    payloads = []
+    device_ids = [str(uuid.uuid4()) for _ in range(100)]
+    for i in range(count):
+        pack = SenmlPack("iot:sensor:water")
+        pack.add(SenmlRecord(name=device_ids[i % len(device_ids)], value=100.0 + i * 0.01, unit="l/s", time=1643294876 + i))
+        if encoding == mqttParams.SENML_CBOR_CONTENT_TYPE:
+            payloads.append(pack.to_cbor())
+        else:
+            payloads.append(pack.to_json().encode("utf-8"))
+    return payloads
+
+
+def decode_with_telemetry_message(payload):
+    # Former collector path: build object, re-serialize it, parse it again when writing records
+    return json.loads(TelemetryMessage().build_class_from_senml_json(payload).to_json())
+
+
+def measure(decode, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def main():
+    payloads = build_payloads(MESSAGES)
+    before = measure(decode_with_telemetry_message, payloads)
+    print(f"{'TelemetryMessage path':<36}{before:12.0f} msg/s")
+
+    backend = senml_decoder.json_loads
+    senml_decoder.json_loads = json.loads
+    stdlib = measure(decode_senml_payload, payloads)
+    senml_decoder.json_loads = backend
+    print(f"{'decode_senml_payload (json)':<36}{stdlib:12.0f} msg/s  x{stdlib / before:.1f}")
+
+    if senml_decoder.JSON_BACKEND != "json":
+        fast = measure(decode_senml_payload, payloads)
+        label = f"decode_senml_payload ({senml_decoder.JSON_BACKEND})"
+        print(f"{label:<36}{fast:12.0f} msg/s  x{fast / before:.1f}")
+
+    if senml_decoder.cbor_loads is not None:
+        cbor_payloads = build_payloads(MESSAGES, mqttParams.SENML_CBOR_CONTENT_TYPE)
+        cbor = measure(lambda payload: decode_senml_payload(payload, mqttParams.SENML_CBOR_CONTENT_TYPE), cbor_payloads)
+        print(f"{'decode_senml_payload (cbor)':<36}{cbor:12.0f} msg/s  x{cbor / before:.1f}")
+        json_bytes = sum(len(payload) for payload in payloads) / len(payloads)
+        cbor_bytes = sum(len(payload) for payload in cbor_payloads) / len(cbor_payloads)
+        print(f"Payload size: json {json_bytes:.0f} B, cbor {cbor_bytes:.0f} B ({cbor_bytes / json_bytes:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from collections import Counter
+
+from mqtt.broker.in_process_broker import InProcessBroker, build_message
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+from mqtt.consumer.policy_manager_data_collector import PolicyManagerAndDataCollector
+from mqtt.consumer.policy_table import PolicyFileWatcher
+from mqtt.message.device_info_message import DeviceInfoMessage
+from mqtt.message.senml_decoder import TelemetryRecord
+from mqtt.message.telemetry_message import TelemetryMessage
+from mqtt.message.topic_resolver import build_device_topic
+
+REPOSITORY_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DATA_FILE_PATH = os.path.join(REPOSITORY_FOLDER, "data", storageParams.DATA_FILE)
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Recorded rows carry no location and plant, replayed devices are placed here by default
+REPLAY_LOCATION = "padiglione-replay"
+REPLAY_PLANT = "impianto-replay"
+REPLAY_SOFTWARE_VERSION = "replay"
+TICK = 0.01 #s
+# Records sent between yields to the collector when not waiting for their time
+YIELD_EVERY = 100
+DRAIN_TIMEOUT = 30 #s
+
+
+def read_records(file_paths):
+    """
+    Stream rows of collector csv files as TelemetryRecord, file after file
+    Rows without a numeric value or time are skipped, the seq column is optional
+    :param file_paths: csv files with the collector header, oldest first
+    :return: generator of TelemetryRecord
+    """
+    for file_path in file_paths:
+        with open(file_path, newline="") as csv_file:
+            for row in csv.DictReader(csv_file):
+                try:
+                    value = float(row["v"])
+                    timestamp = float(row["t"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                sequence = row.get("seq")
+                yield TelemetryRecord(row["n"], row["bn"], value, row.get("u") or None,
+                                      int(timestamp) if timestamp.is_integer() else timestamp,
+                                      int(sequence) if sequence else None)
+
+
+class ReplayRecordSink:
+    """
+    Record sink counting processed rows instead of storing them
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.last_record_time = None
+
+    def open(self):
+        pass
+
+    def write_record(self, row):
+        self.records += 1
+        self.last_record_time = time.perf_counter()
+
+    def buffered_records(self):
+        return 0
+
+    def flush(self, sync=False):
+        return True
+
+    def sync(self):
+        return True
+
+    async def start_periodic_flush_task(self, interval=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplaySender:
+    """
+    Republish recorded rows as senml telemetry on the device topic layout
+    Through the in-process broker, or straight into the collector receive stage
+    Every device first gets its retained info message, like a starting smart object
+    """
+
+    def __init__(self, collector, broker, direct, location, plant, encoding):
+        """
+        :param collector: PolicyManagerAndDataCollector fed by the replay
+        :param broker: InProcessBroker the collector is connected to
+        :param direct: skip the broker, hand messages to the collector
+        :param location: location of replayed devices
+        :param plant: plant of replayed devices
+        :param encoding: senml+json or senml+cbor content type
+        """
+        self.collector = collector
+        self.mqtt_client = None if direct else broker.create_client(client_id="replay-sender")
+        self.location = location
+        self.plant = plant
+        self.encoding = encoding
+        # device id -> telemetry topic
+        self.telemetry_topics = {}
+
+    async def connect(self):
+        if self.mqtt_client:
+            await self.mqtt_client.connect()
+
+    async def send(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self.mqtt_client:
+            await self.mqtt_client.publish(topic, payload, retain=retain)
+        elif retain:
+            self.collector.update_device_registry(build_message(topic, payload, retain=True))
+        else:
+            await self.collector.receive_telemetry_message(build_message(topic, payload))
+
+    async def register_device(self, record):
+        """
+        :param record: first TelemetryRecord of the device
+        :return: device telemetry topic
+        """
+        resource = record.bn.rsplit(":", 1)[-1]
+        info = DeviceInfoMessage(record.n, REPLAY_SOFTWARE_VERSION, REPLAY_SOFTWARE_VERSION, self.location, self.plant, self.encoding)
+        await self.send(build_device_topic(self.location, self.plant, resource, record.n, mqttParams.INFO_TOPIC), info.to_json(), retain=True)
+        topic = self.telemetry_topics[record.n] = build_device_topic(self.location, self.plant, resource, record.n, mqttParams.TELEMETRY_TOPIC)
+        return topic
+
+    async def send_record(self, record):
+        """
+        Send a record once the collector ingest queue has room,
+        a fast replay is slowed down instead of dropping messages
+        :param record: TelemetryRecord
+        :return:
+        """
+        topic = self.telemetry_topics.get(record.n)
+        if topic is None:
+            topic = await self.register_device(record)
+        message = TelemetryMessage(name=record.n, type=record.bn, value=record.v, unit=record.u,
+                                   timestamp=record.t, sequence=record.seq)
+        while self.collector.ingest_queue.full():
+            await asyncio.sleep(0)
+        await self.send(topic, message.build_senml_payload(self.encoding))
+
+
+async def replay_records(records, sender, speed):
+    """
+    Send records paced on their recorded time
+    A record older than the previous one is sent right away
+    :param records: TelemetryRecord iterable in recorded order
+    :param sender: ReplaySender
+    :param speed: recorded seconds per wall second, 0 sends as fast as possible
+    :return: (sent records, first recorded time, last recorded time)
+    """
+    sent = 0
+    first_time = last_time = None
+    start = time.perf_counter()
+    for record in records:
+        if first_time is None:
+            first_time = last_time = record.t
+        last_time = max(last_time, record.t)
+        if speed > 0:
+            delay = start + (record.t - first_time) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await sender.send_record(record)
+        sent += 1
+        if sent % YIELD_EVERY == 0:
+            await asyncio.sleep(0)
+    return sent, first_time, last_time
+
+
+async def wait_for_collector(collector, record_sink, timeout=DRAIN_TIMEOUT):
+    """
+    Wait until sent messages went through the ingest workers:
+    empty ingest queue, no batch in flight and no new record for a tick
+    :return: False when timeout expired first
+    """
+    deadline = time.perf_counter() + timeout
+    records = -1
+    while time.perf_counter() < deadline:
+        if (records == record_sink.records and collector.ingest_queue.empty()
+                and collector.applied_batch_ticket == collector.next_batch_ticket):
+            return True
+        records = record_sink.records
+        await asyncio.sleep(TICK)
+    logging.warning(f"Collector not drained after {timeout} seconds, results are partial")
+    return False
+
+
+async def run_replay(file_paths, speed, direct, encoding, location, plant, policy_path=None):
+    """
+    :return: (metrics dict, list of alert dict in the order they were raised)
+    """
+    broker = InProcessBroker()
+    record_sink = ReplayRecordSink()
+    # Fresh write ahead log, nothing replayed from a previous run
+    wal_folder = tempfile.mkdtemp(prefix="replay-wal-")
+    collector = PolicyManagerAndDataCollector(
+        record_sinks=[record_sink],
+        mqtt_client=broker.create_client(client_id="replay-collector"),
+        write_ahead_log_path=os.path.join(wal_folder, "policy_manager.wal"),
+        resume_persistence_path=None,
+        overload_policy="block"
+    )
+    if policy_path:
+        collector.policy_watcher = PolicyFileWatcher(policy_path, collector.ALLOWED_RESOURCE_TYPES)
+        collector.policy_table = collector.policy_watcher.load()
+
+    # Alerts are dated with the recorded time of the value crossing the threshold
+    alerts = []
+    send_threshold_alert = collector.send_threshold_alert
+
+    def on_threshold_alert(topic, resource_type, record=None):
+        parsed_topic = collector.topic_resolver.resolve(topic)
+        alerts.append({
+            "recorded_time": record.t if record else None,
+            "value": record.v if record else None,
+            "device": parsed_topic.device_id,
+            "resource_type": resource_type,
+            "location": parsed_topic.location,
+            "plant": parsed_topic.plant,
+        })
+        send_threshold_alert(topic, resource_type, record)
+    collector.send_threshold_alert = on_threshold_alert
+
+    await collector.start(demo_time=None)
+    sender = ReplaySender(collector, broker, direct, location, plant, encoding)
+    await sender.connect()
+
+    start = time.perf_counter()
+    sent, first_time, last_time = await replay_records(read_records(file_paths), sender, speed)
+    send_time = time.perf_counter() - start
+    drained = await wait_for_collector(collector, record_sink)
+    processed_time = (record_sink.last_record_time or time.perf_counter()) - start
+    pending_resumes = len(collector.pending_resumes())
+    # The write ahead log task and file are closed before their folder goes
+    await collector.shutdown()
+    shutil.rmtree(wal_folder, ignore_errors=True)
+
+    recorded_span = last_time - first_time if sent else 0
+    metrics = {
+        "sent_records": sent,
+        "processed_records": record_sink.records,
+        "devices": len(sender.telemetry_topics),
+        "recorded_seconds": recorded_span,
+        "replay_seconds": processed_time,
+        "send_rate": sent / send_time if send_time > 0 else None,
+        "throughput": record_sink.records / processed_time if processed_time > 0 else None,
+        "time_warp": recorded_span / processed_time if processed_time > 0 else None,
+        "alerts": len(alerts),
+        "pending_resumes": pending_resumes,
+        "drain_timed_out": not drained,
+    }
+    return metrics, alerts
+
+
+def parse_speed(value):
+    """
+    :param value: "max" or recorded seconds per wall second
+    :return: float, 0 for as fast as possible
+    """
+    if value == "max":
+        return 0.0
+    speed = float(value)
+    if speed < 0:
+        raise argparse.ArgumentTypeError("speed must be max or a non negative number")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay collector csv output through the policy manager")
+    parser.add_argument("files", nargs="*", help=f"csv files in recorded order, defaults to data/{storageParams.DATA_FILE}")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1 is real time, N is N times faster, max (or 0) as fast as possible")
+    parser.add_argument("--target", choices=("broker", "direct"), default="broker",
+                        help="publish through the in-process broker or feed the collector receive stage directly")
+    parser.add_argument("--encoding", choices=("json", "cbor"), default="json", help="telemetry senml encoding")
+    parser.add_argument("--location", default=REPLAY_LOCATION, help="location of replayed devices")
+    parser.add_argument("--plant", default=REPLAY_PLANT, help="plant of replayed devices")
+    parser.add_argument("--policy", help="policy json file to check, defaults to the collector one")
+    parser.add_argument("--output", help="results json file, defaults to benchmark/results/replay-<timestamp>.json")
+    args = parser.parse_args()
+
+    # Keep per message logging out of the measure
+    logging.getLogger().setLevel(logging.WARNING)
+    file_paths = args.files or [DATA_FILE_PATH]
+    policy_path = args.policy
+    encoding = mqttParams.SENML_CBOR_CONTENT_TYPE if args.encoding == "cbor" else mqttParams.SENML_JSON_CONTENT_TYPE
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics, alerts = loop.run_until_complete(run_replay(
+        file_paths, args.speed, args.target == "direct", encoding, args.location, args.plant, policy_path))
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": {
+            "files": file_paths,
+            "speed": args.speed,
+            "target": args.target,
+            "encoding": encoding,
+            "policy": policy_path,
+        },
+        "metrics": metrics,
+        "alerts": alerts,
+    }
+    output = args.output or os.path.join(RESULTS_FOLDER, f"replay-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    folder = os.path.dirname(output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    for key, value in metrics.items():
+        print(f"{key:<20}{value:>14.2f}" if isinstance(value, float) else f"{key:<20}{value!s:>14}")
+    for resource_type, count in sorted(Counter(alert["resource_type"] for alert in alerts).items()):
+        print(f"  {resource_type:<26}{count:>8} alerts")
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import zlib
+
+from contextlib import asynccontextmanager
+
+import paho.mqtt.client as mqtt
+
+SHARED_SUBSCRIPTION_PREFIX = "$share/"
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Match topic against a filter with + and # wildcards
+    Same result as paho topic_matches_sub, without building a matcher per call
+    :param topic_filter:str
+    :param topic:str
+    :return bool:
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, filter_level in enumerate(filter_levels):
+        if filter_level == "#":
+            return True
+        if index == len(topic_levels) or (filter_level != "+" and filter_level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def build_message(topic, payload, qos=0, retain=False):
+    """
+    :param topic:str
+    :param payload: bytes
+    :return: paho MQTTMessage, as received from asyncio_mqtt.Client
+    """
+    message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    message.payload = payload
+    message.qos = qos
+    message.retain = retain
+    return message
+
+
+class InProcessBroker:
+    """
+    Broker stand-in living in the current event loop
+    Routes messages between InProcessClient instances without sockets
+    Supports + and # wildcards, retained messages and $share groups
+    ($share members are picked by topic hash, so a topic always reaches the same member)
+    Subscribers of each topic are cached until subscriptions change
+    Meant for benchmarks, replays and offline simulations
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.retained_messages = {}
+        self.routed_messages = 0
+        # topic -> clients receiving it
+        self.routes = {}
+
+    def create_client(self, **kwargs):
+        """
+        Create a client accepting the same arguments as asyncio_mqtt.Client
+        :return InProcessClient:
+        """
+        client = InProcessClient(self, kwargs.get("client_id", ""))
+        self.clients.append(client)
+        return client
+
+    def publish(self, topic, payload, qos, retain):
+        """
+        Deliver message to every subscribed client, once per client
+        :param topic:str
+        :param payload: bytes
+        :param qos:int
+        :param retain:bool
+        :return:
+        """
+        if retain:
+            if payload:
+                self.retained_messages[topic] = (payload, qos)
+            else:
+                self.retained_messages.pop(topic, None)
+        self.routed_messages += 1
+        subscribers = self.routes.get(topic)
+        if subscribers is None:
+            subscribers = self.routes[topic] = self.find_subscribers(topic)
+        for client in subscribers:
+            client.deliver(topic, payload, qos, False)
+
+    def find_subscribers(self, topic):
+        """
+        Clients receiving topic, once per client and one member per $share group
+        :param topic:str
+        :return: list of InProcessClient
+        """
+        subscribers = []
+        shared_groups = {}
+        for client in self.clients:
+            if not client.is_connected:
+                continue
+            for topic_filter, group in client.subscriptions:
+                if topic_matches(topic_filter, topic):
+                    if group is None:
+                        subscribers.append(client)
+                        break
+                    shared_groups.setdefault((group, topic_filter), []).append(client)
+        for members in shared_groups.values():
+            member = members[zlib.crc32(topic.encode("utf-8")) % len(members)]
+            if member not in subscribers:
+                subscribers.append(member)
+        return subscribers
+
+    def invalidate_routes(self):
+        self.routes.clear()
+
+    def deliver_retained(self, client, topic_filter):
+        for topic, (payload, qos) in list(self.retained_messages.items()):
+            if topic_matches(topic_filter, topic):
+                client.deliver(topic, payload, qos, True)
+
+
+class InProcessClient:
+    """
+    In-process stand-in for asyncio_mqtt.Client
+    Implements the subset used by the project:
+    connect, disconnect, subscribe, publish, filtered_messages
+    Messages are paho MQTTMessage instances
+    """
+
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.is_connected = False
+        # list of (topic filter, $share group or None)
+        self.subscriptions = []
+        # list of (topic filter, asyncio.Queue)
+        self.message_queues = []
+        # topic -> queues receiving it
+        self.topic_queues = {}
+
+    async def connect(self):
+        self.is_connected = True
+        self.broker.invalidate_routes()
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.broker.invalidate_routes()
+
+    async def subscribe(self, topic, qos=0, **kwargs):
+        """
+        :param topic: topic filter or list of (topic filter, qos)
+        :param qos:int
+        :return:
+        """
+        topic_filters = [topic_filter for topic_filter, _ in topic] if isinstance(topic, list) else [topic]
+        for topic_filter in topic_filters:
+            group = None
+            if topic_filter.startswith(SHARED_SUBSCRIPTION_PREFIX):
+                group, topic_filter = topic_filter[len(SHARED_SUBSCRIPTION_PREFIX):].split("/", 1)
+            self.subscriptions.append((topic_filter, group))
+            self.broker.invalidate_routes()
+            if group is None:
+                self.broker.deliver_retained(self, topic_filter)
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        if not self.is_connected:
+            raise ConnectionError(f"Client {self.client_id} is not connected")
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, bytes):
+            payload = str(payload).encode("utf-8")
+        self.broker.publish(topic, payload, qos, retain)
+
+    def deliver(self, topic, payload, qos, retain):
+        message_queues = self.topic_queues.get(topic)
+        if message_queues is None:
+            message_queues = self.topic_queues[topic] = [
+                message_queue for topic_filter, message_queue in self.message_queues if topic_matches(topic_filter, topic)]
+        if not message_queues:
+            return
+        message = build_message(topic, payload, qos, retain)
+        for message_queue in message_queues:
+            message_queue.put_nowait(message)
+
+    @asynccontextmanager
+    async def filtered_messages(self, topic_filter, **kwargs):
+        message_queue = asyncio.Queue()
+        entry = (topic_filter, message_queue)
+        self.message_queues.append(entry)
+        self.topic_queues.clear()
+
+        async def messages():
+            while True:
+                yield await message_queue.get()
+        try:
+            yield messages()
+        finally:
+            self.message_queues.remove(entry)
+            self.topic_queues.clear()
+            logging.debug(f"Removed {topic_filter} message filter of {self.client_id}")
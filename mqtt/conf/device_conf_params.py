@@ -0,0 +1,31 @@
+import os
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+
+class DeviceConfigurationParams(object):
+    # Telemetry content format, advertised in the retained info message
+    TELEMETRY_ENCODING = mqttParams.SENML_JSON_CONTENT_TYPE
+    # Gateway mode, many smart objects multiplexed over a small connection pool
+    GATEWAY_ENABLED = False
+    GATEWAY_CONNECTIONS = 4
+    # Control topics subscribed per SUBSCRIBE packet
+    GATEWAY_SUBSCRIBE_BATCH_SIZE = 500
+    # Registrations gathered before subscribing
+    GATEWAY_SUBSCRIBE_WINDOW = 0.1 #s
+    # One vectorized simulation engine per resource type instead of one task per sensor
+    SIMULATION_ENGINE_ENABLED = False
+    # Fleet launcher, topology next to this file whatever the working directory
+    FLEET_TOPOLOGY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fleet_topology.json")
+    FLEET_WORKERS = 4
+    FLEET_REPORT_INTERVAL = 10 #s
+    # Telemetry batching, one senml pack per window or per max records
+    BATCHING_ENABLED = False
+    BATCH_WINDOW = 10 #s
+    BATCH_MAX_RECORDS = 10
+    # Simulation mode: fleet and policy manager on a virtual clock, one seeded random generator per sensor
+    # None simulates the plant of the smart object process, else a fleet topology file
+    SIMULATION_TOPOLOGY_PATH = None
+    SIMULATION_SEED = 42
+    SIMULATION_START = "2022-01-01T00:00:00" #UTC
+    SIMULATION_DURATION = 7 * 24 * 60 * 60 #s of virtual time
+    SIMULATION_OUTPUT_PATH = "../../data/simulation/industrial_metering_consumption.csv"
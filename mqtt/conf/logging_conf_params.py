@@ -0,0 +1,17 @@
+class LoggingConfigurationParams(object):
+    LEVEL = "DEBUG"
+    # "text" or "json" (one object per line)
+    FORMAT = "text"
+    TEXT_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+    # Records are formatted and written by a background thread,
+    # the event loop only puts them on a queue
+    QUEUE_ENABLED = True
+    # Per message events: keep 1 record out of N, 0 drops them all
+    # e.g. {"telemetry_value": 100, "telemetry_published": 100}
+    SAMPLING_RATES = {
+        "telemetry_value": 1,
+        "telemetry_published": 1,
+        "control_published": 1,
+        "control_received": 1,
+        "device_info": 1,
+    }
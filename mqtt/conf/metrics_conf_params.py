@@ -0,0 +1,16 @@
+class MetricsConfigurationParams(object):
+    # Prometheus text exposition on http://HTTP_ADDRESS:<process>_HTTP_PORT/metrics
+    HTTP_ENABLED = False
+    HTTP_ADDRESS = "127.0.0.1"
+    POLICY_MANAGER_HTTP_PORT = 9108
+    SMART_OBJECT_HTTP_PORT = 9109
+    # Policy manager shard i listens on SHARD_HTTP_PORT_BASE + i
+    SHARD_HTTP_PORT_BASE = 9110
+    # Policy manager queries (/consumption, /series, /devices) on POLICY_MANAGER_HTTP_PORT, even with HTTP_ENABLED off
+    QUERY_HTTP_ENABLED = True
+    # Periodic dump of the same text to file, None disables it
+    POLICY_MANAGER_DUMP_PATH = None # "../../data/policy_manager_metrics.prom"
+    SMART_OBJECT_DUMP_PATH = None # "../../data/smart_object_metrics.prom"
+    DUMP_INTERVAL = 10 #s
+    # Histogram buckets in seconds
+    LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
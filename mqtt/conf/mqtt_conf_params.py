@@ -5,4 +5,7 @@ class MqttConfigurationParams(object):
     DEVICE_TOPIC = "device"
     TELEMETRY_TOPIC = "telemetry"
     CONTROL_TOPIC = "control"
-    INFO_TOPIC = "info"
\ No newline at end of file
+    INFO_TOPIC = "info"
+    # SenML telemetry content formats (RFC 8428)
+    SENML_JSON_CONTENT_TYPE = "application/senml+json"
+    SENML_CBOR_CONTENT_TYPE = "application/senml+cbor"
\ No newline at end of file
@@ -0,0 +1,57 @@
+import os
+
+
+class PolicyManagerConfigurationParams(object):
+    # Thresholds, restart delays and their overrides, next to this file whatever the working directory
+    POLICY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "policy_manager_params.json")
+    # Seconds between policy file checks, SIGHUP also triggers a reload
+    POLICY_WATCH_INTERVAL = 2 #s
+    # Sharded mode, one worker process per shard
+    SHARD_COUNT = 4
+    # "hash": every shard subscribes to all telemetry and keeps its topic-hash slice
+    # "share": $share group subscription, the broker must dispatch by topic hash
+    # (e.g. EMQX hash_topic strategy) to keep per-topic state inside one shard
+    SHARD_MODE = "hash"
+    SHARED_SUBSCRIPTION_GROUP = "policy-manager"
+    # Records sent to the supervisor per batch
+    SHARD_RECORD_BATCH_SIZE = 200
+    # Max wait for the supervisor to sync its sinks before a shard checkpoint, the checkpoint is skipped past it
+    SHARD_SYNC_TIMEOUT = 5 #s
+    # Resume control timer wheel, range is TICK * WHEEL_SIZE ** LEVELS
+    RESUME_TIMER_TICK = 0.1 #s
+    RESUME_TIMER_WHEEL_SIZE = 64
+    RESUME_TIMER_LEVELS = 4
+    # Pending resumes survive restarts, None disables persistence
+    RESUME_PERSISTENCE_PATH = "../../data/pending_resumes.json"
+    # Receive stage only enqueues telemetry, INGEST_WORKERS coroutines process it
+    INGEST_QUEUE_SIZE = 10000 #messages
+    INGEST_WORKERS = 4
+    INGEST_BATCH_SIZE = 100 #messages per worker batch
+    # When the ingest queue is full:
+    # "block": stop reading from the broker until there is room
+    # "drop_oldest": discard the oldest queued telemetry
+    # "drop_newest": discard the incoming telemetry
+    # Alerts and resumes have their own unbounded queue and are never dropped
+    OVERLOAD_POLICY = "drop_oldest"
+    # Decode batches off the event loop: None, "thread" or "process"
+    DECODE_EXECUTOR = None
+    DECODE_EXECUTOR_WORKERS = 2
+    # Parsed device topics kept by the topic resolver
+    TOPIC_CACHE_SIZE = 100000
+    # Online consumption aggregates, cost uses these prices per unit
+    AGGREGATION_ENABLED = True
+    RESOURCE_PRICES = {
+        "iot:sensor:water": 0.46,
+        "iot:sensor:gas": 0.65,
+        "iot:sensor:electricity": 0.18
+    }
+    # Device registry, retained info messages are bulk loaded before telemetry is consumed
+    # Loading ends after REGISTRY_LOAD_QUIET seconds without new info messages, or REGISTRY_LOAD_TIMEOUT
+    REGISTRY_LOAD_QUIET = 0.2 #s
+    REGISTRY_LOAD_TIMEOUT = 5 #s
+    # Discard telemetry of devices without a registered info message
+    REJECT_UNKNOWN_DEVICES = False
+    # Per device window of record sequence numbers: duplicates are dropped,
+    # records older than the window are dropped as expired,
+    # reordered records are stored but skip aggregates, live series and threshold checks
+    SEQUENCE_WINDOW = 64 #records, 0 disables the check
@@ -0,0 +1,29 @@
+class StorageConfigurationParams(object):
+    # Collected telemetry output
+    DATA_FOLDER = "../../data"
+    DATA_FILE = "industrial_metering_consumption.csv"
+    # seq is kept by the write ahead log and the columnar sink, the csv layout is unchanged
+    CSV_HEADER = ["n", "bn", "v", "u", "t"]
+    # Streaming sink flushing
+    FLUSH_INTERVAL = 5 #s
+    FLUSH_BATCH_SIZE = 500 #records
+    # Rows kept while the file cannot be written, the oldest are dropped beyond it
+    MAX_BUFFERED_RECORDS = 100000 #records
+    # Active file rotation, whichever comes first
+    ROTATION_MAX_BYTES = 64 * 1024 * 1024
+    ROTATION_MAX_AGE = 24 * 60 * 60 #s
+    # Columnar output partitioned by resource type and day
+    COLUMNAR_ENABLED = False
+    COLUMNAR_FOLDER = "../../data/columnar"
+    # Live series of the last samples of every device, queried on /series
+    RING_BUFFER_ENABLED = True
+    RING_BUFFER_CAPACITY = 1024 #samples per device
+    # Write ahead log of records, threshold state and pending resumes, replayed after a crash
+    WAL_ENABLED = True
+    WAL_PATH = "../../data/policy_manager.wal"
+    # Group commit, one fsync every interval or every N records, whichever comes first
+    WAL_COMMIT_INTERVAL = 0.05 #s
+    WAL_COMMIT_RECORDS = 1000 #entries
+    # Checkpoint flushes the sinks and compacts the log, bounding replay time
+    WAL_CHECKPOINT_INTERVAL = 30 #s
+    WAL_CHECKPOINT_RECORDS = 50000 #entries
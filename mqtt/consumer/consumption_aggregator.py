@@ -0,0 +1,135 @@
+import math
+
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+
+
+class RunningAggregate:
+    """
+    O(1) running statistics of a stream of samples
+    Consumption is the sum of the positive deltas between consecutive samples of each device,
+    a decreasing level is not counted as negative consumption
+    """
+
+    __slots__ = ("count", "sum", "min", "max", "last", "last_time", "consumption")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.last = None
+        self.last_time = None
+        self.consumption = 0.0
+
+    def add(self, value, timestamp, consumption):
+        """
+        :param value: sample level
+        :param timestamp: sample time
+        :param consumption: device delta carried by the sample
+        :return:
+        """
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.last = value
+        self.last_time = timestamp
+        self.consumption += consumption
+
+    def to_dict(self, price=None):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.sum / self.count if self.count else None,
+            "last": self.last,
+            "last_time": self.last_time,
+            "consumption": self.consumption,
+            "cost": self.consumption * price if price is not None else None,
+        }
+
+
+class ConsumptionAggregator:
+    """
+    Online aggregates of telemetry records at device, resource, plant and location level
+    Plant and location aggregates are kept per resource type, values of different units are never mixed
+    Cost is consumption times the resource price
+    Each device caches its four aggregates, a sample costs one dict hit and four updates
+    """
+
+    def __init__(self, prices=pmParams.RESOURCE_PRICES):
+        """
+        :param prices: {resource type: price per unit}
+        """
+        self.prices = prices
+        # device telemetry topic -> (ParsedTopic, resource type, device, resource, plant, location aggregates)
+        self.device_aggregates = {}
+        # resource type -> RunningAggregate
+        self.resources = {}
+        # (location, plant, resource type) -> RunningAggregate
+        self.plants = {}
+        # (location, resource type) -> RunningAggregate
+        self.locations = {}
+
+    def add(self, parsed_topic, record):
+        """
+        Update every level with a new sample
+        :param parsed_topic: ParsedTopic of the record telemetry topic
+        :param record: TelemetryRecord
+        :return:
+        """
+        aggregates = self.device_aggregates.get(parsed_topic.telemetry_topic)
+        if aggregates is None:
+            aggregates = self.device_aggregates[parsed_topic.telemetry_topic] = self.create_device_aggregates(parsed_topic, record.bn)
+        _, _, device, resource, plant, location = aggregates
+        value = record.v
+        consumption = value - device.last if device.count and value > device.last else 0.0
+        device.add(value, record.t, consumption)
+        resource.add(value, record.t, consumption)
+        plant.add(value, record.t, consumption)
+        location.add(value, record.t, consumption)
+
+    def create_device_aggregates(self, parsed_topic, resource_type):
+        resource = self.resources.get(resource_type)
+        if resource is None:
+            resource = self.resources[resource_type] = RunningAggregate()
+        plant_key = (parsed_topic.location, parsed_topic.plant, resource_type)
+        plant = self.plants.get(plant_key)
+        if plant is None:
+            plant = self.plants[plant_key] = RunningAggregate()
+        location_key = (parsed_topic.location, resource_type)
+        location = self.locations.get(location_key)
+        if location is None:
+            location = self.locations[location_key] = RunningAggregate()
+        return parsed_topic, resource_type, RunningAggregate(), resource, plant, location
+
+    def snapshot(self):
+        """
+        :return: json serializable aggregates of every level,
+                 plants and locations also carry the total cost of their resources
+        """
+        devices = {}
+        for parsed_topic, resource_type, device, _, _, _ in self.device_aggregates.values():
+            devices[parsed_topic.device_id] = dict(
+                device.to_dict(self.prices.get(resource_type)),
+                location=parsed_topic.location, plant=parsed_topic.plant, resource=resource_type)
+        plants = {}
+        for (location, plant, resource_type), aggregate in self.plants.items():
+            entry = plants.setdefault(f"{location}/{plant}", {"resources": {}, "cost": 0.0})
+            entry["resources"][resource_type] = aggregate.to_dict(self.prices.get(resource_type))
+            entry["cost"] += aggregate.consumption * self.prices.get(resource_type, 0.0)
+        locations = {}
+        for (location, resource_type), aggregate in self.locations.items():
+            entry = locations.setdefault(location, {"resources": {}, "cost": 0.0})
+            entry["resources"][resource_type] = aggregate.to_dict(self.prices.get(resource_type))
+            entry["cost"] += aggregate.consumption * self.prices.get(resource_type, 0.0)
+        return {
+            "devices": devices,
+            "resources": {resource_type: aggregate.to_dict(self.prices.get(resource_type))
+                          for resource_type, aggregate in self.resources.items()},
+            "plants": plants,
+            "locations": locations,
+        }
@@ -0,0 +1,160 @@
+import json
+import logging
+
+from collections import namedtuple
+from http import HTTPStatus
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+
+# Device known from its retained info message, location, plant and resource come from the topic
+RegisteredDevice = namedtuple("RegisteredDevice", ["device_id", "location", "plant", "resource", "manufacturer",
+                                                   "software_version", "encoding", "telemetry_topic"])
+
+# Secondary indexes, filter name -> RegisteredDevice field
+INDEXED_FIELDS = ("location", "plant", "resource", "manufacturer", "software_version")
+
+
+def normalize_software_version(software_version):
+    """
+    Devices send the version as a number (1.0), queries as a string ("1.0")
+    :param software_version: number, string or None
+    :return: str, None when not given
+    """
+    return None if software_version is None else str(software_version)
+
+
+class DeviceRegistry:
+    """
+    Devices registered by their info message, keyed by telemetry topic
+    Secondary indexes by location, plant, resource type, manufacturer and software version
+    An empty info payload deregisters the device
+    Telemetry topic lookups are a single dict hit
+    """
+
+    def __init__(self):
+        # telemetry topic -> RegisteredDevice
+        self.devices = {}
+        # telemetry topic -> senml content type, read on the telemetry hot path
+        self.encodings = {}
+        # field -> {value: set of telemetry topics}, plant values are (location, plant)
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.deregistrations = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, telemetry_topic):
+        return telemetry_topic in self.devices
+
+    def get(self, telemetry_topic):
+        """
+        :param telemetry_topic:str
+        :return: RegisteredDevice, None if unknown
+        """
+        return self.devices.get(telemetry_topic)
+
+    def update(self, parsed_topic, payload):
+        """
+        Register, update or deregister the device of an info message
+        :param parsed_topic: ParsedTopic of the info topic
+        :param payload: DeviceInfoMessage json, empty to deregister
+        :return:
+        """
+        if not payload:
+            self.deregister(parsed_topic.telemetry_topic)
+            return
+        device_info = json.loads(payload)
+        self.register(RegisteredDevice(
+            parsed_topic.device_id,
+            parsed_topic.location,
+            parsed_topic.plant,
+            parsed_topic.resource,
+            device_info.get("manufacturer"),
+            device_info.get("software_version"),
+            device_info.get("encoding", mqttParams.SENML_JSON_CONTENT_TYPE),
+            parsed_topic.telemetry_topic
+        ))
+
+    def load(self, info_messages):
+        """
+        Bulk load info messages, only the last message of each device is applied
+        :param info_messages: list of (ParsedTopic, payload) in arrival order
+        :return:
+        """
+        last_payloads = {}
+        for parsed_topic, payload in info_messages:
+            last_payloads[parsed_topic.telemetry_topic] = (parsed_topic, payload)
+        for parsed_topic, payload in last_payloads.values():
+            try:
+                self.update(parsed_topic, payload)
+            except Exception as e:
+                logging.error(f"Error loading device info of {parsed_topic.info_topic}")
+                logging.error(e)
+
+    def register(self, device):
+        """
+        :param device: RegisteredDevice, replaces the one on the same telemetry topic
+        :return:
+        """
+        telemetry_topic = device.telemetry_topic
+        previous = self.devices.get(telemetry_topic)
+        if previous is not None:
+            self.remove_from_indexes(previous)
+        self.devices[telemetry_topic] = device
+        self.encodings[telemetry_topic] = device.encoding
+        for field in INDEXED_FIELDS:
+            self.indexes[field].setdefault(self.index_key(device, field), set()).add(telemetry_topic)
+
+    def deregister(self, telemetry_topic):
+        """
+        :param telemetry_topic:str
+        :return bool: False if the device was not registered
+        """
+        device = self.devices.pop(telemetry_topic, None)
+        if device is None:
+            return False
+        self.encodings.pop(telemetry_topic, None)
+        self.remove_from_indexes(device)
+        self.deregistrations += 1
+        return True
+
+    def remove_from_indexes(self, device):
+        for field in INDEXED_FIELDS:
+            key = self.index_key(device, field)
+            topics = self.indexes[field][key]
+            topics.discard(device.telemetry_topic)
+            if not topics:
+                del self.indexes[field][key]
+
+    @staticmethod
+    def index_key(device, field):
+        if field == "plant":
+            return device.location, device.plant
+        if field == "software_version":
+            return normalize_software_version(device.software_version)
+        return getattr(device, field)
+
+    def select(self, location=None, plant=None, resource=None, manufacturer=None, software_version=None):
+        """
+        Devices matching every given filter, plant needs location
+        :return: list of RegisteredDevice sorted by telemetry topic
+        """
+        if plant is not None and location is None:
+            raise ValueError("plant filter needs a location")
+        filters = {"location": location, "plant": (location, plant) if plant is not None else None,
+                   "resource": resource, "manufacturer": manufacturer,
+                   "software_version": normalize_software_version(software_version)}
+        selections = [self.indexes[field].get(value, set()) for field, value in filters.items() if value is not None]
+        topics = set.intersection(*selections) if selections else self.devices
+        return [self.devices[topic] for topic in sorted(topics)]
+
+    def handle_devices_request(self, query):
+        """
+        LocalHttpServer handler of /devices
+        Filters: location, plant, resource, manufacturer, software_version
+        :param query: request parameters
+        :return: (HTTPStatus, content type, json body)
+        """
+        devices = self.select(query.get("location"), query.get("plant"), query.get("resource"),
+                              query.get("manufacturer"), query.get("software_version"))
+        return HTTPStatus.OK, "application/json", json.dumps([device._asdict() for device in devices])
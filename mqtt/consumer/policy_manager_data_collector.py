@@ -1,55 +1,152 @@
 import asyncio
 import json
 import os
+import signal
+import time
 import uuid
+import zlib
 import logging
 
-import csv
-import paho.mqtt.client as mqtt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http import HTTPStatus
 
 from asyncio_mqtt import Client, MqttError
 from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
 from mqtt.conf.credentials import Credentials as creds
-from mqtt.message.telemetry_message import TelemetryMessage
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+from mqtt.conf.metrics_conf_params import MetricsConfigurationParams as metricsParams
+from mqtt.message.senml_decoder import decode_senml_batch, detect_senml_encoding, TelemetryRecord
 from mqtt.message.control_message import ControlMessage
+from mqtt.message.topic_resolver import TopicResolver
 from mqtt.resource.water_sensor_resource import WaterSensorResource
 from mqtt.resource.gas_sensor_resource import GasSensorResource
 from mqtt.resource.electricity_sensor_resource import ElectricitySensorResource
+from mqtt.storage.streaming_csv_sink import StreamingCsvSink
+from mqtt.storage.columnar_record_sink import ColumnarRecordSink
+from mqtt.storage.ring_buffer_store import RingBufferStore
+from mqtt.storage.write_ahead_log import (WriteAheadLog, ENTRY_RECORD, ENTRY_THRESHOLD_STATE,
+                                          ENTRY_RESUME, ENTRY_RESUME_DONE, ENTRY_SEQUENCE_WINDOW)
+from mqtt.consumer.threshold_state_engine import ThresholdStateEngine
+from mqtt.consumer.timer_wheel import HierarchicalTimerWheel
+from mqtt.consumer.consumption_aggregator import ConsumptionAggregator
+from mqtt.consumer.device_registry import DeviceRegistry
+from mqtt.consumer.policy_table import PolicyFileWatcher
+from mqtt.consumer.sequence_window import (SequenceTracker, SEQUENCE_IN_ORDER, SEQUENCE_DUPLICATE, SEQUENCE_EXPIRED,
+                                           SEQUENCE_RESTARTED)
+from mqtt.observability.metrics_registry import REGISTRY, start_metrics_exporters
+from mqtt.observability.logging_setup import configure_logging, is_logged, TELEMETRY_VALUE, CONTROL_PUBLISHED, DEVICE_INFO
+from mqtt.process.virtual_clock import current_time
 
-logging.basicConfig(level=logging.DEBUG,
-                    format="%(asctime)s %(levelname)-8s %(message)s")
+configure_logging()
 
 DEMO_TIME = 60 #s
 
+
+def is_valid_record(record):
+    """
+    :param record: TelemetryRecord of an allowed resource type
+    :return: True when v and t are numbers and seq an integer or None
+    """
+    return (type(record.v) in (int, float) and type(record.t) in (int, float)
+            and (record.seq is None or type(record.seq) is int))
+
+
 class PolicyManagerAndDataCollector:
     """
     Policy Manager and Data Collector
-    Load threshold data from a file
+    Load thresholds and restart delays from a policy file, reloaded when it changes or on SIGHUP
     On message saves new value or checks if already present
     If level is above threshold sends control message
-    Schedule control message to resume operation
+    Schedule control message to resume operation on a timer wheel
     Stops after DEMO_RUNTIME seconds
-    Saves records to csv file
+    Streams records to csv file and optionally to columnar partitions
+    When sharded only handles its own slice of devices
+    Records, threshold state and pending resumes go through a write ahead log
+    replayed on start after a crash
+    Devices are registered from retained info messages before telemetry is consumed
+    Duplicate and reordered records are detected from their device sequence number
+    Received telemetry goes through a bounded ingest queue to a pool of workers,
+    control messages through their own queue
     """
 
-    # Craft data file path for csv
-    data_folder = "../../data"
-    data_file = "industrial_metering_consumption.csv"
-    file_path = os.path.join(data_folder, data_file)
-
-    # Load delay times from json config file
-    with open('../conf/policy_manager_params.json') as json_file:
-        config_values = json.load(json_file)
+    ALLOWED_RESOURCE_TYPES = frozenset((
+        WaterSensorResource.RESOURCE_TYPE,
+        GasSensorResource.RESOURCE_TYPE,
+        ElectricitySensorResource.RESOURCE_TYPE
+    ))
 
-    # Keep track of notified threshold-reached devices
-    is_resource_threshold_notified = {}
+    # Craft data file path for csv
+    file_path = os.path.join(storageParams.DATA_FOLDER, storageParams.DATA_FILE)
 
-    def __init__(self):
+    def __init__(self, shard_index=0, shard_count=1, shard_mode=pmParams.SHARD_MODE, record_sinks=None, mqtt_client=None,
+                 write_ahead_log_path=storageParams.WAL_PATH,
+                 resume_persistence_path=pmParams.RESUME_PERSISTENCE_PATH,
+                 overload_policy=pmParams.OVERLOAD_POLICY):
+        """
+        :param shard_index: slice of devices handled by this instance
+        :param shard_count: number of shards, 1 handles every device
+        :param shard_mode: "hash" or "share", see PolicyManagerConfigurationParams
+        :param record_sinks: defaults to csv (and columnar) sinks
+        :param mqtt_client: client with the asyncio_mqtt.Client interface, defaults to a broker connection
+        :param write_ahead_log_path: log file when WAL_ENABLED, None disables the log
+        :param resume_persistence_path: pending resumes file without write ahead log, None disables persistence
+        :param overload_policy: "block", "drop_oldest" or "drop_newest"
+        """
         self.id = str(uuid.uuid4())
-        self.resource_value_history = {}
-        self.senml_data_array = []
+        # Devices registered by their retained info message
+        self.device_registry = DeviceRegistry()
+        # Info messages received while the registry is bulk loading, None once loaded
+        self.pending_info_messages = []
+        # Device topic -> ParsedTopic
+        self.topic_resolver = TopicResolver()
+        # Running consumption and cost per device, resource, plant and location
+        self.consumption_aggregator = ConsumptionAggregator() if pmParams.AGGREGATION_ENABLED else None
+        # Last samples of every device, in memory
+        self.series_store = RingBufferStore() if storageParams.RING_BUFFER_ENABLED else None
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_mode = shard_mode
+        # Compiled policy file, swapped as a whole on reload
+        self.policy_watcher = PolicyFileWatcher(resource_types=self.ALLOWED_RESOURCE_TYPES)
+        self.policy_table = self.policy_watcher.load()
+        # Last level and notified flag of every telemetry topic
+        self.threshold_state = ThresholdStateEngine(self.get_supply_threshold)
+        # Recent sequence numbers of every telemetry topic
+        self.sequence_tracker = SequenceTracker() if pmParams.SEQUENCE_WINDOW > 0 else None
+        # Pending resumes are already in the write ahead log when it is enabled
+        self.write_ahead_log = None
+        self.checkpoint_running = False
+        resume_persistence_path = self.build_shard_file_path(resume_persistence_path)
+        if storageParams.WAL_ENABLED and write_ahead_log_path:
+            self.write_ahead_log = WriteAheadLog(self.build_shard_file_path(write_ahead_log_path))
+            resume_persistence_path = None
+        # Pending resume_operation controls keyed by control topic
+        self.resume_scheduler = HierarchicalTimerWheel(
+            pmParams.RESUME_TIMER_TICK,
+            pmParams.RESUME_TIMER_WHEEL_SIZE,
+            pmParams.RESUME_TIMER_LEVELS,
+            resume_persistence_path
+        )
+        if record_sinks is None:
+            record_sinks = [StreamingCsvSink(self.file_path)]
+            if storageParams.COLUMNAR_ENABLED:
+                record_sinks.append(ColumnarRecordSink())
+        self.record_sinks = record_sinks
+        # Receive stage -> ingest workers
+        self.ingest_queue = asyncio.Queue(pmParams.INGEST_QUEUE_SIZE)
+        self.ingest_batch_size = pmParams.INGEST_BATCH_SIZE
+        self.overload_policy = overload_policy
+        # Batches are applied in the order they were taken from the queue
+        self.next_batch_ticket = 0
+        self.applied_batch_ticket = 0
+        self.batch_turn = asyncio.Condition()
+        self.decode_executor = None
+        # (control topic, ControlMessage) waiting to be published
+        self.control_queue = asyncio.Queue()
+        self.init_metrics()
         # Using Client class from async-mqtt wrapper
-        self.mqtt_client = Client(
+        self.mqtt_client = mqtt_client or Client(
             hostname=mqttParams.BROKER_ADDRESS,
             port=mqttParams.BROKER_PORT,
             clean_session=True,
@@ -59,6 +156,79 @@ class PolicyManagerAndDataCollector:
             password=creds.POLICY_MANAGER_PW
         )
 
+    def build_shard_file_path(self, file_path):
+        """
+        :param file_path: file shared by every shard, may be None
+        :return: file_path with a -shard-N suffix when sharded
+        """
+        if file_path and self.shard_count > 1:
+            stem, extension = os.path.splitext(file_path)
+            return f"{stem}-shard-{self.shard_index}{extension}"
+        return file_path
+
+    def get_supply_threshold(self, topic, resource_type):
+        """
+        :param topic: telemetry topic
+        :param resource_type: bn
+        :return: SUPPLY_THRESHOLD of the device, overrides applied
+        """
+        return self.policy_table.policy(self.topic_resolver.resolve(topic), resource_type).supply_threshold
+
+    def init_metrics(self):
+        """
+        Register hot path metrics in the process registry
+        Gauges are read when metrics are rendered
+        """
+        self.received_messages = REGISTRY.counter(
+            "policy_manager_telemetry_messages_total", "Telemetry messages received")
+        self.received_records = REGISTRY.counter(
+            "policy_manager_telemetry_records_total", "Telemetry records received per resource type", ("resource_type",))
+        self.parse_failures = REGISTRY.counter(
+            "policy_manager_parse_failures_total", "Telemetry payloads that could not be decoded")
+        self.decode_latency = REGISTRY.histogram(
+            "policy_manager_decode_seconds", "Senml payload decode time")
+        self.threshold_alerts = REGISTRY.counter(
+            "policy_manager_threshold_alerts_total", "Threshold alerts sent per resource type", ("resource_type",))
+        REGISTRY.gauge("policy_manager_pending_resumes", "Resume controls waiting on the timer wheel").set_function(
+            lambda: len(self.resume_scheduler.entries))
+        REGISTRY.gauge("policy_manager_buffered_records", "Records buffered by the record sinks").set_function(
+            lambda: sum(record_sink.buffered_records() for record_sink in self.record_sinks))
+        self.dropped_messages = REGISTRY.counter(
+            "policy_manager_ingest_dropped_total", "Telemetry messages dropped by the overload policy", ("policy",))
+        self.blocked_messages = REGISTRY.counter(
+            "policy_manager_ingest_blocked_total", "Telemetry messages that waited for room in the ingest queue")
+        REGISTRY.gauge("policy_manager_ingest_queue_depth", "Telemetry messages waiting for an ingest worker").set_function(
+            self.ingest_queue.qsize)
+        REGISTRY.gauge("policy_manager_control_queue_depth", "Control messages waiting to be published").set_function(
+            self.control_queue.qsize)
+        REGISTRY.gauge("policy_manager_registered_devices", "Devices registered by their info message").set_function(
+            lambda: len(self.device_registry))
+        REGISTRY.gauge("policy_manager_device_deregistrations", "Devices removed by an empty info message").set_function(
+            lambda: self.device_registry.deregistrations)
+        self.unknown_device_messages = REGISTRY.counter(
+            "policy_manager_unknown_device_messages_total", "Telemetry messages of devices without info message")
+        self.duplicate_records = REGISTRY.counter(
+            "policy_manager_duplicate_records_total", "Telemetry records dropped as duplicates of their sequence number")
+        self.late_records = REGISTRY.counter(
+            "policy_manager_late_records_total",
+            "Telemetry records received out of order, reordered ones are stored, expired ones dropped", ("outcome",))
+        self.sequence_restarts = REGISTRY.counter(
+            "policy_manager_sequence_restarts_total", "Sequence windows restarted by a device counter reset")
+        self.policy_reloads = REGISTRY.counter(
+            "policy_manager_policy_reloads_total", "Policy file reloads per result", ("result",))
+        REGISTRY.gauge("policy_manager_policy_version", "Policy file loads since start").set_function(
+            lambda: self.policy_table.version)
+        self.wal_recovery_seconds = REGISTRY.gauge(
+            "policy_manager_wal_recovery_seconds", "Time spent replaying the write ahead log on start")
+        self.wal_recovered_entries = REGISTRY.gauge(
+            "policy_manager_wal_recovered_entries", "Write ahead log entries replayed on start")
+        self.wal_commit_failures = REGISTRY.counter(
+            "policy_manager_wal_commit_failures_total", "Write ahead log group commits that failed and were kept for retry")
+        self.wal_skipped_checkpoints = REGISTRY.counter(
+            "policy_manager_wal_skipped_checkpoints_total", "Write ahead log checkpoints skipped because a record sink failed")
+        REGISTRY.gauge("policy_manager_wal_buffered_entries", "Write ahead log entries waiting for a group commit").set_function(
+            lambda: self.write_ahead_log.buffered_entries if self.write_ahead_log else 0)
+
     async def on_connect(self):
         """
         Connect to mqtt broker
@@ -81,6 +251,8 @@ class PolicyManagerAndDataCollector:
                 mqttParams.DEVICE_TOPIC,
                 mqttParams.TELEMETRY_TOPIC
             )
+            if self.shard_count > 1 and self.shard_mode == "share":
+                device_telemetry_topic = f"$share/{pmParams.SHARED_SUBSCRIPTION_GROUP}/{device_telemetry_topic}"
             await self.mqtt_client.subscribe(device_telemetry_topic)
             logging.info("Subscribed to: " + device_telemetry_topic)
         except Exception as e:
@@ -109,123 +281,488 @@ class PolicyManagerAndDataCollector:
             async with self.mqtt_client.filtered_messages(
                     f'{mqttParams.MQTT_DEFAULT_TOPIC}/+/+/+/{mqttParams.DEVICE_TOPIC}/+/{mqttParams.INFO_TOPIC}') as messages:
                 async for message in messages:
-                    logging.info(f"New device info received --> {message.payload.decode('utf-8')}")
+                    if is_logged(DEVICE_INFO):
+                        logging.info("New device info received --> %s", message.payload.decode('utf-8'), extra={"event": DEVICE_INFO, "topic": message.topic})
+                    if self.pending_info_messages is not None:
+                        self.pending_info_messages.append(message)
+                    else:
+                        self.update_device_registry(message)
         except Exception as e:
             logging.error("Error receiving info message")
             logging.error(e)
 
+    def update_device_registry(self, message):
+        """
+        Register the device of an info message
+        An empty retained payload means the device is gone
+        A live, not retained, info message is sent by a starting device:
+        its sequence numbers start again, so its window is reset
+        :param message: mqtt message received on info topic
+        :return:
+        """
+        try:
+            parsed_topic = self.topic_resolver.resolve(message.topic)
+            self.device_registry.update(parsed_topic, message.payload)
+            if not message.payload:
+                logging.info("Device %s deregistered", parsed_topic.device_id)
+            elif self.sequence_tracker and not message.retain:
+                self.sequence_tracker.reset(parsed_topic.telemetry_topic)
+        except Exception as e:
+            logging.error("Error parsing device info message")
+            logging.error(e)
+
+    async def load_device_registry(self, quiet=pmParams.REGISTRY_LOAD_QUIET, timeout=pmParams.REGISTRY_LOAD_TIMEOUT):
+        """
+        Bulk load the retained info messages delivered on subscription
+        Waits until no info message arrives for quiet seconds, at most timeout seconds
+        :return:
+        """
+        try:
+            deadline = asyncio.get_event_loop().time() + timeout
+            received = -1
+            while received != len(self.pending_info_messages) and asyncio.get_event_loop().time() < deadline:
+                received = len(self.pending_info_messages)
+                await asyncio.sleep(quiet)
+            info_messages, self.pending_info_messages = self.pending_info_messages, None
+            self.device_registry.load([(self.topic_resolver.resolve(message.topic), message.payload)
+                                       for message in info_messages])
+            logging.info(f"Loaded {len(self.device_registry)} devices from {len(info_messages)} info messages")
+        except Exception as e:
+            self.pending_info_messages = None
+            logging.error("Error loading device registry")
+            logging.error(e)
+
     async def on_telemetry_message(self):
         """
-        Iterative core function of the program
-        Compose TelemetryMessage and checks if allowed type
-        Store new values for threshold checks
-        Delay resume control message when threshold is reached
-        Completely asynchronous
+        Iterative receive stage
+        Only enqueues telemetry of this shard into the bounded ingest queue,
+        decoding, storing and threshold checks are done by the ingest workers
+        so a slow control publish never stalls the broker connection
         """
         try:
             # Iterate through messages
             async with self.mqtt_client.filtered_messages(
                     f'{mqttParams.MQTT_DEFAULT_TOPIC}/+/+/+/{mqttParams.DEVICE_TOPIC}/+/{mqttParams.TELEMETRY_TOPIC}') as messages:
                 async for message in messages:
-                    # Craft Telemetry message
-                    telemetry_message:TelemetryMessage = self.parse_telemetry_message(message)
-                    # Check for the resource type
-                    if telemetry_message.type in (WaterSensorResource.RESOURCE_TYPE, GasSensorResource.RESOURCE_TYPE, ElectricitySensorResource.RESOURCE_TYPE):
-                        self.senml_data_array.append(telemetry_message.to_json())
-                        new_level = telemetry_message.value
-                        logging.info(f"Detected new value: {new_level} in topic {message.topic}")
-
-                        if message.topic not in self.resource_value_history:
-                            logging.info(f"New level saved for {message.topic}")
-                            # Storing values by topic because unique identifier
-                            self.resource_value_history[message.topic] = new_level
-                            self.is_resource_threshold_notified[message.topic] = False
-                        else:
-                            if self.is_level_threshold(self.resource_value_history.get(message.topic), new_level, telemetry_message.type) and not self.is_resource_threshold_notified[message.topic]:
-                                logging.info(f"THRESHOLD LEVEL REACHED! Sending control notification on {message.topic}")
-                                # Resource is now notified
-                                self.is_resource_threshold_notified[message.topic] = True
-
-                                # Topic string manipulation by adding control to it
-                                control_topic = self.refactor_telemetry_topic_to_control(message)
-
-                                await self.publish_control_message(control_topic, ControlMessage('alert', {message.topic:"threshold_reached"}))
-                                # Resetting resource value history
-                                self.resource_value_history.pop(message.topic, None)
-
-                                # Retrieve delay based on sensor type
-                                delay = self.config_values[telemetry_message.type]["RESTART_DELAY"]
-                                # Safely delay resume control message with async
-                                asyncio.run_coroutine_threadsafe(self.delay_control_message(delay, control_topic), asyncio.get_event_loop())
+                    await self.receive_telemetry_message(message)
 
         except Exception as e:
             logging.error("Error receiving message!")
             logging.error(e)
 
-    def write_senml_records_to_file(self):
+    async def receive_telemetry_message(self, message):
+        """
+        Enqueue one telemetry message of this shard from a registered
+        (or, unless rejected, unknown) device
+        Also the entry point of replays fed without a broker
+        :param message: mqtt message received on telemetry topic
+        :return:
+        """
+        if not self.is_topic_in_shard(message.topic):
+            return
+        self.received_messages.inc()
+        if message.topic not in self.device_registry:
+            self.unknown_device_messages.inc()
+            if pmParams.REJECT_UNKNOWN_DEVICES:
+                return
+        await self.enqueue_telemetry_message(message)
+
+    async def enqueue_telemetry_message(self, message):
+        """
+        Put message in the ingest queue, applying the overload policy when full
+        :param message: mqtt message received on telemetry topic
+        :return:
+        """
+        if self.ingest_queue.full():
+            if self.overload_policy == "block":
+                self.blocked_messages.inc()
+                await self.ingest_queue.put(message)
+                return
+            self.dropped_messages.labels(self.overload_policy).inc()
+            if self.overload_policy == "drop_newest":
+                return
+            self.ingest_queue.get_nowait()
+        self.ingest_queue.put_nowait(message)
+
+    async def start_ingest_worker_task(self):
+        """
+        Processing stage, INGEST_WORKERS of them run concurrently
+        Takes a batch from the ingest queue and decodes it, inline or in the decode executor
+        Batches are applied (stored and checked) in dequeue order,
+        so per topic threshold state sees values in arrival order
+        :return:
+        """
+        while True:
+            batch = [await self.ingest_queue.get()]
+            while len(batch) < self.ingest_batch_size and not self.ingest_queue.empty():
+                batch.append(self.ingest_queue.get_nowait())
+            ticket = self.next_batch_ticket
+            self.next_batch_ticket += 1
+            try:
+                results = await self.decode_telemetry_batch(batch)
+            except Exception as e:
+                logging.error("Error decoding telemetry batch")
+                logging.error(e)
+                results = [(None, 0.0)] * len(batch)
+            async with self.batch_turn:
+                await self.batch_turn.wait_for(lambda: self.applied_batch_ticket == ticket)
+                try:
+                    self.apply_telemetry_batch(batch, results)
+                except Exception as e:
+                    logging.error("Error processing telemetry batch")
+                    logging.error(e)
+                finally:
+                    self.applied_batch_ticket += 1
+                    self.batch_turn.notify_all()
+
+    async def decode_telemetry_batch(self, batch):
         """
-        Write senml records saved in list to csv file
-        header = n, bn, v, u, t
+        Decode senml payloads of a batch
+        Content type is the one advertised by the device, or detected
+        for devices whose info message was not received
+        :param batch: list of mqtt messages
+        :return: list of (list of TelemetryRecord or None, decode seconds)
+        """
+        payloads = [(message.payload, self.device_registry.encodings.get(message.topic) or detect_senml_encoding(message.payload))
+                    for message in batch]
+        if self.decode_executor is None:
+            return decode_senml_batch(payloads)
+        return await asyncio.get_event_loop().run_in_executor(self.decode_executor, decode_senml_batch, payloads)
+
+    def apply_telemetry_batch(self, batch, results):
+        """
+        Keep valid records of allowed types, drop duplicates, stream them to sinks,
+        then update aggregates, live series and thresholds of the whole batch at once
+        :param batch: list of mqtt messages
+        :param results: decode_telemetry_batch results
+        :return:
+        """
+        topics = []
+        records = []
+        for message, (message_records, decode_seconds) in zip(batch, results):
+            if message_records is None:
+                self.parse_failures.inc()
+                logging.error("Error! Cannot parse message on %s", message.topic)
+                continue
+            self.decode_latency.observe(decode_seconds)
+            # Check for the resource type
+            for record in message_records:
+                if record.bn in self.ALLOWED_RESOURCE_TYPES:
+                    if not is_valid_record(record):
+                        # Logged, stored and compared as numbers: one bad record must not abort the batch
+                        self.parse_failures.inc()
+                        logging.error("Error! Invalid record %s on %s", record, message.topic)
+                        continue
+                    self.received_records.labels(record.bn).inc()
+                    topics.append(message.topic)
+                    records.append(record)
+        topics, records, in_order = self.check_record_sequences(topics, records)
+        if self.write_ahead_log:
+            for topic, record in zip(topics, records):
+                self.write_ahead_log.append(ENTRY_RECORD, topic, *record)
+        for record_sink in self.record_sinks:
+            for record in records:
+                record_sink.write_record(record)
+        self.update_record_state(topics, records, in_order)
+        if (self.write_ahead_log and not self.checkpoint_running
+                and self.write_ahead_log.logged_entries >= storageParams.WAL_CHECKPOINT_RECORDS):
+            self.checkpoint_running = True
+            asyncio.get_event_loop().create_task(self.checkpoint_write_ahead_log())
+
+    def check_record_sequences(self, topics, records):
+        """
+        Drop duplicate and expired records, flag reordered ones
+        Records without sequence number are kept as in order
+        :param topics: telemetry topic of each record
+        :param records: list of TelemetryRecord
+        :return: (topics, records, list of in order flags) of the kept records
+        """
+        if self.sequence_tracker is None:
+            return topics, records, [True] * len(records)
+        kept_topics = []
+        kept_records = []
+        in_order = []
+        for topic, record in zip(topics, records):
+            if record.seq is None:
+                outcome = SEQUENCE_IN_ORDER
+            else:
+                outcome = self.sequence_tracker.check(topic, record.seq)
+            if outcome == SEQUENCE_DUPLICATE:
+                self.duplicate_records.inc()
+                continue
+            if outcome == SEQUENCE_EXPIRED:
+                self.late_records.labels("expired").inc()
+                continue
+            if outcome == SEQUENCE_RESTARTED:
+                self.sequence_restarts.inc()
+                outcome = SEQUENCE_IN_ORDER
+            if outcome != SEQUENCE_IN_ORDER:
+                self.late_records.labels("reordered").inc()
+            kept_topics.append(topic)
+            kept_records.append(record)
+            in_order.append(outcome == SEQUENCE_IN_ORDER)
+        return kept_topics, kept_records, in_order
+
+    def update_record_state(self, topics, records, in_order, send_alerts=True):
+        """
+        Feed in order records to aggregates, live series and threshold checks
+        A reordered record is older than the last level of its device,
+        its delta would count false consumption and could fire a false alert
+        :param topics: telemetry topic of each record
+        :param records: list of TelemetryRecord
+        :param in_order: check_record_sequences flags
+        :param send_alerts: see check_resource_thresholds
+        :return:
+        """
+        if not all(in_order):
+            topics = [topic for topic, ordered in zip(topics, in_order) if ordered]
+            records = [record for record, ordered in zip(records, in_order) if ordered]
+        if self.consumption_aggregator or self.series_store:
+            for topic, record in zip(topics, records):
+                parsed_topic = self.topic_resolver.resolve(topic)
+                if self.consumption_aggregator:
+                    self.consumption_aggregator.add(parsed_topic, record)
+                if self.series_store:
+                    self.series_store.add(parsed_topic, record)
+        self.check_resource_thresholds(topics, records, send_alerts)
+
+    def is_topic_in_shard(self, topic):
+        """
+        Check if topic belongs to this shard slice
+        Shared subscriptions are already sliced by the broker
+        :param topic:str
+        :return bool:
+        """
+        if self.shard_count == 1 or self.shard_mode == "share":
+            return True
+        return zlib.crc32(topic.encode("utf-8")) % self.shard_count == self.shard_index
+
+    def check_resource_thresholds(self, topics, records, send_alerts=True):
+        """
+        Check new values against their threshold in one batch
+        Queue alert and delay resume control message when threshold is reached
+        :param topics: telemetry topic of each record
+        :param records: list of TelemetryRecord
+        :param send_alerts: False only updates threshold state, used on recovery
+        :return:
+        """
+        slots = []
+        for topic, record in zip(topics, records):
+            if is_logged(TELEMETRY_VALUE):
+                logging.info("Detected new value: %s in topic %s", record.v, topic, extra={"event": TELEMETRY_VALUE})
+            slots.append(self.threshold_state.get_slot(topic, record.bn))
+        reached = self.threshold_state.evaluate(slots, [record.v for record in records])
+        if not send_alerts:
+            return
+        for index in reached:
+            slot = slots[index]
+            self.send_threshold_alert(self.threshold_state.topics[slot], self.threshold_state.resource_types[slot], records[index])
+
+    def send_threshold_alert(self, topic, resource_type, record=None):
+        """
+        Queue alert for device control topic and schedule resume
+        :param topic: telemetry topic
+        :param resource_type: bn
+        :param record: TelemetryRecord that reached the threshold
+        :return:
+        """
+        logging.info("THRESHOLD LEVEL REACHED! Sending control notification on %s", topic)
+        parsed_topic = self.topic_resolver.resolve(topic)
+        control_topic = parsed_topic.control_topic
+
+        self.control_queue.put_nowait((control_topic, ControlMessage('alert', {topic:"threshold_reached"})))
+        self.threshold_alerts.labels(resource_type).inc()
+
+        # Retrieve delay of the device policy
+        delay = self.policy_table.policy(parsed_topic, resource_type).restart_delay
+        due_time = current_time() + delay
+        # One pending resume per control topic
+        if not self.resume_scheduler.schedule_at(control_topic, due_time):
+            logging.info("Resume already pending on %s", control_topic)
+        elif self.write_ahead_log:
+            self.write_ahead_log.append(ENTRY_RESUME, control_topic, due_time)
+
+    async def start_control_publisher_task(self):
+        """
+        Publish queued control messages in order
+        The control queue is unbounded, alerts and resumes are never dropped
         :return:
         """
         try:
-            header = list((json.loads(self.senml_data_array[0]).keys()))
-            with open(self.file_path, "w", newline="") as f:
-                cw = csv.DictWriter(f, header)
-                cw.writeheader()
-                logging.info(f"Writing header {header} to file")
-                for record in self.senml_data_array:
-                    cw.writerow(json.loads(record))
-                logging.info("Records successfully written to file")
+            while True:
+                topic, message = await self.control_queue.get()
+                await self.publish_control_message(topic, message)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logging.error("Error writing to file")
+            logging.error("Error in control publisher task")
             logging.error(e)
 
-    def refactor_telemetry_topic_to_control(self, message):
+    async def publish_resume_control_message(self, topic):
+        """
+        Publish a resume control message when its delay is over
+        :param topic:str control topic
+        :return None
+        """
+        logging.info("DELAY IS OVER, sending resume control on %s", topic)
+        self.control_queue.put_nowait((topic, ControlMessage('alert', {topic: "resume_operation"})))
+        if self.write_ahead_log:
+            self.write_ahead_log.append(ENTRY_RESUME_DONE, topic)
+
+    def recover_from_write_ahead_log(self):
         """
-        Strip telemetry from topic string and append control
-        :param message:str
-        :return control_topic:str
+        Rebuild state lost by a crash from the write ahead log
+        Threshold state, sequence windows and pending resumes of the last checkpoint are restored,
+        records logged after it are written again to the sinks and replayed
+        through sequence, aggregates, live series and threshold checks without sending alerts
+        Replay is bounded by WAL_CHECKPOINT_RECORDS
+        :return:
         """
         try:
-            topic = message.topic.split('/')[:-1]
-            topic.append(mqttParams.CONTROL_TOPIC)
-            control_topic = '/'.join(topic)
-            return control_topic
+            started_at = time.perf_counter()
+            entries = self.write_ahead_log.replay()
+            pending_resumes = {}
+            topics = []
+            records = []
+            for entry_type, fields in entries:
+                if entry_type == ENTRY_RECORD:
+                    topics.append(fields[0])
+                    records.append(TelemetryRecord(*fields[1:]))
+                elif entry_type == ENTRY_THRESHOLD_STATE:
+                    self.threshold_state.restore_slot(*fields)
+                elif entry_type == ENTRY_SEQUENCE_WINDOW:
+                    if self.sequence_tracker:
+                        self.sequence_tracker.restore(fields[0], fields[1], int(fields[2], 16))
+                elif entry_type == ENTRY_RESUME:
+                    pending_resumes[fields[0]] = fields[1]
+                elif entry_type == ENTRY_RESUME_DONE:
+                    pending_resumes.pop(fields[0], None)
+            # Logged records were already deduplicated, replaying them rebuilds the same windows
+            topics, records, in_order = self.check_record_sequences(topics, records)
+            for record_sink in self.record_sinks:
+                for record in records:
+                    record_sink.write_record(record)
+            self.update_record_state(topics, records, in_order, send_alerts=False)
+            for control_topic, due_time in pending_resumes.items():
+                self.resume_scheduler.schedule_at(control_topic, due_time)
+            recovery_seconds = time.perf_counter() - started_at
+            self.wal_recovery_seconds.set(recovery_seconds)
+            self.wal_recovered_entries.set(len(entries))
+            logging.info(f"Recovered {len(records)} records, {len(self.threshold_state.topics)} threshold states "
+                         f"and {len(pending_resumes)} pending resumes from {self.write_ahead_log.file_path} "
+                         f"in {recovery_seconds:.3f} seconds")
         except Exception as e:
-            logging.error("Error refactoring topic")
+            logging.error("Error recovering from write ahead log")
             logging.error(e)
 
-    async def delay_control_message(self, delay, topic):
+    def build_checkpoint_snapshot(self):
         """
-        Await given time and publish a resume control message
-        :param delay:float
-        :param topic:str
-        :return None
+        :return: write ahead log entries rebuilding threshold state, sequence windows and pending resumes
+        """
+        snapshot = [(ENTRY_THRESHOLD_STATE, slot_state) for slot_state in self.threshold_state.export_state()]
+        if self.sequence_tracker:
+            snapshot.extend((ENTRY_SEQUENCE_WINDOW, (topic, highest, f"{mask:x}"))
+                            for topic, highest, mask in self.sequence_tracker.export_state())
+        snapshot.extend((ENTRY_RESUME, resume) for resume in self.resume_scheduler.pending())
+        return snapshot
+
+    def flush_record_sinks(self):
+        """
+        Write buffered rows of every record sink, without syncing them
+        :return: True when every sink wrote its rows
+        """
+        return all([record_sink.flush() for record_sink in self.record_sinks])
+
+    def sync_record_sinks(self):
         """
+        fsync every record sink, run in the executor
+        :return: True when every sink has its flushed rows on disk
+        """
+        return all([record_sink.sync() for record_sink in self.record_sinks])
+
+    async def checkpoint_write_ahead_log(self):
+        """
+        Flush the record sinks and build the state snapshot, sync the sinks off the event loop,
+        then compact the log to the snapshot and the entries appended meanwhile
+        When a sink fails the log is kept, its records are still to be stored
+        :return:
+        """
+        self.checkpoint_running = True
         try:
-            await asyncio.sleep(delay)
-            logging.info(f"DELAY IS OVER, sending resume control on {topic}")
-            await self.publish_control_message(topic, ControlMessage('alert', {topic: "resume_operation"}))
+            flushed = self.flush_record_sinks()
+            snapshot = self.build_checkpoint_snapshot()
+            self.write_ahead_log.start_checkpoint()
+            if not flushed or not await asyncio.get_event_loop().run_in_executor(None, self.sync_record_sinks):
+                self.write_ahead_log.cancel_checkpoint()
+                self.wal_skipped_checkpoints.inc()
+                logging.error("Record sinks not synced, skipping write ahead log checkpoint")
+                return
+            self.write_ahead_log.checkpoint(snapshot)
+        except asyncio.CancelledError:
+            self.write_ahead_log.cancel_checkpoint()
+            raise
         except Exception as e:
-            logging.error("Error delaying resume control message")
+            self.write_ahead_log.cancel_checkpoint()
+            logging.error("Error checkpointing write ahead log")
             logging.error(e)
+        finally:
+            self.checkpoint_running = False
 
-    def is_level_threshold(self, last_level, new_level, type):
-        return new_level - last_level >= self.config_values[type]["SUPPLY_THRESHOLD"]
+    async def start_checkpoint_task(self, interval=storageParams.WAL_CHECKPOINT_INTERVAL):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if not self.checkpoint_running:
+                    await self.checkpoint_write_ahead_log()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in write ahead log checkpoint task")
+            logging.error(e)
 
-    def parse_telemetry_message(self, mqtt_message:mqtt.MQTTMessage):
+    async def reload_policy_table(self):
         """
-        Compose TelemetryMessage using mqtt message json payload
-        :param mqtt_message: json payload received
-        :return TelemetryMessage: built from payload
+        Compile the policy file off the event loop, then swap it in
+        Thresholds of known topics are recomputed, their levels and notified flags are kept
+        An invalid file is logged and the current policy stays in place
+        :return:
         """
         try:
-            if isinstance(mqtt_message, mqtt.MQTTMessage):
-                return TelemetryMessage().build_class_from_senml_json(mqtt_message.payload)
+            policy_table = await asyncio.get_event_loop().run_in_executor(None, self.policy_watcher.load)
         except Exception as e:
-            logging.error("Error! Cannot parse message")
+            self.policy_reloads.labels("error").inc()
+            logging.error(f"Error reloading policy file {self.policy_watcher.file_path}, keeping version {self.policy_table.version}")
             logging.error(e)
+            return
+        self.policy_table = policy_table
+        self.threshold_state.set_threshold_function(self.get_supply_threshold)
+        self.policy_reloads.labels("ok").inc()
+        logging.info(f"Policy file reloaded, version {policy_table.version}")
+
+    def install_reload_signal_handler(self):
+        """
+        Reload the policy file on SIGHUP, where the platform and loop allow it
+        :return:
+        """
+        try:
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGHUP, lambda: asyncio.get_event_loop().create_task(self.reload_policy_table()))
+        except (AttributeError, NotImplementedError, RuntimeError):
+            logging.info("SIGHUP policy reload not available, watching the policy file only")
+
+    def consumption_snapshot(self):
+        """
+        :return: running aggregates of every level, see ConsumptionAggregator.snapshot
+        """
+        if not self.consumption_aggregator:
+            return {}
+        return self.consumption_aggregator.snapshot()
+
+    def pending_resumes(self):
+        """
+        :return: list of (control topic, due timestamp) sorted by due time
+        """
+        return self.resume_scheduler.pending()
 
     async def publish_control_message(self, topic:str, message:ControlMessage):
         """
@@ -236,48 +773,115 @@ class PolicyManagerAndDataCollector:
         """
         if topic and message:
             try:
-                await self.mqtt_client.publish(topic, message.to_json(), qos=2)
-                logging.info(f"Data {message.to_json()} successfully published to {topic}")
+                payload = message.to_json()
+                await self.mqtt_client.publish(topic, payload, qos=2)
+                if is_logged(CONTROL_PUBLISHED):
+                    logging.info("Data %s successfully published to %s", payload, topic, extra={"event": CONTROL_PUBLISHED})
             except Exception as e:
                 logging.error("Error! Could not publish message")
                 logging.error(e)
         else:
             logging.error("Error! msg != None or topic != None or mqttClient not connected")
 
-    async def start(self):
+    def create_decode_executor(self):
+        """
+        :return: executor for DECODE_EXECUTOR, None to decode on the event loop
+        """
+        if pmParams.DECODE_EXECUTOR == "thread":
+            return ThreadPoolExecutor(pmParams.DECODE_EXECUTOR_WORKERS, thread_name_prefix="senml-decode")
+        if pmParams.DECODE_EXECUTOR == "process":
+            return ProcessPoolExecutor(pmParams.DECODE_EXECUTOR_WORKERS)
+        return None
+
+    async def start(self, demo_time=DEMO_TIME):
+        """
+        :param demo_time: seconds before stopping, None runs until the loop is stopped
+        """
         try:
             await self.on_connect()
-            await self.subscribe_to_info_topic()
+            for record_sink in self.record_sinks:
+                record_sink.open()
+                asyncio.get_event_loop().create_task(record_sink.start_periodic_flush_task())
+            self.resume_scheduler.load()
+            if self.write_ahead_log:
+                self.recover_from_write_ahead_log()
+                self.write_ahead_log.open()
+                await self.checkpoint_write_ahead_log()
+                asyncio.get_event_loop().create_task(self.write_ahead_log.start_group_commit_task(
+                    lambda e: self.wal_commit_failures.inc()))
+                asyncio.get_event_loop().create_task(self.start_checkpoint_task())
+            asyncio.get_event_loop().create_task(self.resume_scheduler.start_ticking_task(self.publish_resume_control_message))
+            asyncio.get_event_loop().create_task(self.start_control_publisher_task())
+            asyncio.get_event_loop().create_task(self.policy_watcher.start_watch_task(self.reload_policy_table))
+            self.install_reload_signal_handler()
+            self.decode_executor = self.create_decode_executor()
+            for _ in range(pmParams.INGEST_WORKERS):
+                asyncio.get_event_loop().create_task(self.start_ingest_worker_task())
+            # Info filter is in place before subscribing, retained messages are delivered on subscription
             asyncio.get_event_loop().create_task(self.on_info_message())
+            await asyncio.sleep(0)
+            await self.subscribe_to_info_topic()
+            await self.load_device_registry()
 
-            await self.subscribe_to_telemetry_topic()
             asyncio.get_event_loop().create_task(self.on_telemetry_message())
-            asyncio.get_event_loop().create_task(self.stop())
+            await asyncio.sleep(0)
+            await self.subscribe_to_telemetry_topic()
+            if demo_time is not None:
+                asyncio.get_event_loop().create_task(self.stop(demo_time))
             logging.info("Policy Manager and Data Collector started ...")
         except Exception as e:
             logging.error("Error starting Data Manager!")
             logging.error(e)
 
-    async def stop(self):
+    async def stop(self, demo_time=DEMO_TIME):
         """
-        Sleeps for given time and then stops tasks and loop
-        Finally calls record's write to file method
+        Sleeps for given time, shuts down and stops the loop
         :return:
         """
         try:
-            logging.info(f"Running simulation for {DEMO_TIME} seconds")
-            await asyncio.sleep(DEMO_TIME)
-            for task in asyncio.all_tasks():
-                task.cancel()
-            asyncio.get_event_loop().stop()
-            logging.info("Commencing writing senml Records to file ...")
-            self.write_senml_records_to_file()
+            logging.info(f"Running simulation for {demo_time} seconds")
+            await asyncio.sleep(demo_time)
+            await self.shutdown()
         except Exception as e:
             logging.error("Error interrupting task")
             logging.error(e)
+        finally:
+            asyncio.get_event_loop().stop()
+
+    async def shutdown(self):
+        """
+        Cancels every other task of the loop, then flushes and closes
+        the record sinks and the write ahead log, the loop keeps running
+        :return:
+        """
+        try:
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            logging.info("Flushing remaining senml Records to file ...")
+            synced = self.flush_record_sinks() and await asyncio.get_event_loop().run_in_executor(None, self.sync_record_sinks)
+            for record_sink in self.record_sinks:
+                record_sink.close()
+            self.resume_scheduler.save()
+            if self.write_ahead_log:
+                # Without synced sinks the log keeps their records for the next start
+                await self.write_ahead_log.close(self.build_checkpoint_snapshot() if synced else None)
+            if self.decode_executor:
+                self.decode_executor.shutdown(wait=False)
+        except Exception as e:
+            logging.error("Error shutting down Data Manager")
+            logging.error(e)
 
 def main():
-    asyncio.get_event_loop().create_task(PolicyManagerAndDataCollector().start())
+    policy_manager = PolicyManagerAndDataCollector()
+    http_server = start_metrics_exporters(metricsParams.POLICY_MANAGER_HTTP_PORT, metricsParams.POLICY_MANAGER_DUMP_PATH,
+                                          serve_http=metricsParams.QUERY_HTTP_ENABLED)
+    if http_server:
+        http_server.add_route("/consumption", lambda query: (HTTPStatus.OK, "application/json", json.dumps(policy_manager.consumption_snapshot())))
+        if policy_manager.series_store:
+            http_server.add_route("/series", policy_manager.series_store.handle_series_request)
+        http_server.add_route("/devices", policy_manager.device_registry.handle_devices_request)
+    asyncio.get_event_loop().create_task(policy_manager.start())
     asyncio.get_event_loop().run_forever()
 
 if __name__ == '__main__':
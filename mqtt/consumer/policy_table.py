@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+
+from collections import namedtuple
+
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+
+# Resolved policy of one device
+Policy = namedtuple("Policy", ["supply_threshold", "restart_delay"])
+
+# Policy file field -> Policy field
+POLICY_FIELDS = {"SUPPLY_THRESHOLD": "supply_threshold", "RESTART_DELAY": "restart_delay"}
+OVERRIDES_KEY = "overrides"
+
+
+def compile_policy_fields(values, name, required):
+    """
+    :param values: {"SUPPLY_THRESHOLD": ..., "RESTART_DELAY": ...}
+    :param name: entry name used in errors
+    :param required: every field must be present
+    :return: {Policy field: value}
+    """
+    if not isinstance(values, dict):
+        raise ValueError(f"{name} must be an object")
+    unknown = set(values) - set(POLICY_FIELDS)
+    if unknown:
+        raise ValueError(f"{name} has unknown fields {sorted(unknown)}")
+    fields = {}
+    for key, field in POLICY_FIELDS.items():
+        if key not in values:
+            if required:
+                raise ValueError(f"{name} is missing {key}")
+            continue
+        value = values[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{name} {key} must be a non negative number")
+        fields[field] = float(value)
+    return fields
+
+
+class PolicyTable:
+    """
+    Compiled, read only policy file
+    Overrides are applied in order type < location < plant < device
+    A device policy is resolved on first use and then cached,
+    a reload builds a new table instead of changing this one
+
+    File layout, overrides are optional:
+    {
+      "<resource type>": {"SUPPLY_THRESHOLD": 0.8, "RESTART_DELAY": 10},
+      "overrides": {
+        "locations": {"<location>": {"<resource type>": {"SUPPLY_THRESHOLD": 1.0}}},
+        "plants": {"<location>/<plant>": {"<resource type>": {"RESTART_DELAY": 5}}},
+        "devices": {"<device id>": {"SUPPLY_THRESHOLD": 0.2}}
+      }
+    }
+    """
+
+    def __init__(self, config, version=0, resource_types=()):
+        """
+        :param config: parsed policy file
+        :param version: reload counter
+        :param resource_types: resource types the file must define
+        :raise ValueError: invalid policy file
+        """
+        self.version = version
+        overrides = config.get(OVERRIDES_KEY, {})
+        # resource type -> complete fields
+        self.types = {resource_type: compile_policy_fields(values, resource_type, True)
+                      for resource_type, values in config.items() if resource_type != OVERRIDES_KEY}
+        missing = set(resource_types) - set(self.types)
+        if missing:
+            raise ValueError(f"policy file is missing resource types {sorted(missing)}")
+        # (location, resource type) -> partial fields
+        self.locations = self.compile_scoped_overrides(overrides.get("locations", {}), "location")
+        # (location, plant, resource type) -> partial fields
+        self.plants = self.compile_scoped_overrides(overrides.get("plants", {}), "plant")
+        # device id -> partial fields
+        self.devices = {device_id: compile_policy_fields(values, f"device {device_id}", False)
+                        for device_id, values in overrides.get("devices", {}).items()}
+        # telemetry topic -> Policy
+        self.device_policies = {}
+
+    def compile_scoped_overrides(self, overrides, scope):
+        compiled = {}
+        for name, values_by_type in overrides.items():
+            key = tuple(name.split("/", 1)) if scope == "plant" else (name,)
+            if len(key) != (2 if scope == "plant" else 1):
+                raise ValueError(f"{scope} override {name} must be <location>/<plant>")
+            if not isinstance(values_by_type, dict):
+                raise ValueError(f"{scope} {name} must be an object")
+            for resource_type, values in values_by_type.items():
+                if resource_type not in self.types:
+                    raise ValueError(f"{scope} {name} overrides unknown resource type {resource_type}")
+                compiled[key + (resource_type,)] = compile_policy_fields(values, f"{scope} {name} {resource_type}", False)
+        return compiled
+
+    def policy(self, parsed_topic, resource_type):
+        """
+        :param parsed_topic: ParsedTopic of the device
+        :param resource_type: bn
+        :return: Policy of the device
+        """
+        policy = self.device_policies.get(parsed_topic.telemetry_topic)
+        if policy is None:
+            policy = self.device_policies[parsed_topic.telemetry_topic] = self.resolve(parsed_topic, resource_type)
+        return policy
+
+    def resolve(self, parsed_topic, resource_type):
+        fields = dict(self.types[resource_type])
+        fields.update(self.locations.get((parsed_topic.location, resource_type), ()))
+        fields.update(self.plants.get((parsed_topic.location, parsed_topic.plant, resource_type), ()))
+        fields.update(self.devices.get(parsed_topic.device_id, ()))
+        return Policy(**fields)
+
+
+class PolicyFileWatcher:
+    """
+    Policy file loader, reloads it when its modification time or size change
+    """
+
+    def __init__(self, file_path=pmParams.POLICY_PATH, resource_types=()):
+        """
+        :param file_path: policy json file
+        :param resource_types: resource types the file must define, see PolicyTable
+        """
+        self.file_path = file_path
+        self.resource_types = resource_types
+        self.file_signature = None
+        self.version = 0
+
+    def read_signature(self):
+        stat = os.stat(self.file_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """
+        Read and compile the policy file
+        :return: PolicyTable
+        :raise ValueError, OSError: invalid or unreadable file
+        """
+        # A broken file is not retried until it changes again
+        self.file_signature = self.read_signature()
+        with open(self.file_path) as json_file:
+            table = PolicyTable(json.load(json_file), self.version + 1, self.resource_types)
+        self.version = table.version
+        return table
+
+    def is_changed(self):
+        try:
+            return self.read_signature() != self.file_signature
+        except OSError:
+            return False
+
+    async def start_watch_task(self, on_change, interval=pmParams.POLICY_WATCH_INTERVAL):
+        """
+        Await on_change every time the policy file changes
+        :param on_change: async callable()
+        :param interval: seconds between checks
+        :return:
+        """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if self.is_changed():
+                    await on_change()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in policy file watch task")
+            logging.error(e)
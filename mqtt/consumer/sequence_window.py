@@ -0,0 +1,89 @@
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+
+# Outcome of SequenceTracker.check
+SEQUENCE_IN_ORDER = 0
+SEQUENCE_REORDERED = 1
+SEQUENCE_DUPLICATE = 2
+SEQUENCE_EXPIRED = 3
+SEQUENCE_RESTARTED = 4
+
+
+class SequenceWindow:
+    """
+    Highest sequence number seen and bitmask of the window below it,
+    bit i set means highest - i was seen
+    """
+
+    __slots__ = ("highest", "mask")
+
+    def __init__(self, highest, mask=1):
+        self.highest = highest
+        self.mask = mask
+
+
+class SequenceTracker:
+    """
+    Sliding window duplicate and reorder detection, one window per key
+    Each check is a dict hit and a few integer operations
+    A device restarting its counter under the same id sends small sequence numbers
+    far below the highest one: they start a new window instead of being expired
+    """
+
+    def __init__(self, window_size=pmParams.SEQUENCE_WINDOW):
+        """
+        :param window_size: sequence numbers remembered below the highest one
+        """
+        self.window_size = window_size
+        self.full_mask = (1 << window_size) - 1
+        # key -> SequenceWindow
+        self.windows = {}
+
+    def check(self, key, sequence):
+        """
+        Classify and remember a sequence number
+        :param key: device telemetry topic
+        :param sequence:int
+        :return: SEQUENCE_IN_ORDER, SEQUENCE_REORDERED, SEQUENCE_DUPLICATE, SEQUENCE_EXPIRED
+                 or SEQUENCE_RESTARTED, a restarted window is in order
+        """
+        window = self.windows.get(key)
+        if window is None:
+            self.windows[key] = SequenceWindow(sequence)
+            return SEQUENCE_IN_ORDER
+        offset = sequence - window.highest
+        if offset > 0:
+            window.mask = ((window.mask << offset) | 1) & self.full_mask if offset < self.window_size else 1
+            window.highest = sequence
+            return SEQUENCE_IN_ORDER
+        offset = -offset
+        if offset >= self.window_size:
+            if sequence < self.window_size:
+                self.windows[key] = SequenceWindow(sequence)
+                return SEQUENCE_RESTARTED
+            return SEQUENCE_EXPIRED
+        bit = 1 << offset
+        if window.mask & bit:
+            return SEQUENCE_DUPLICATE
+        window.mask |= bit
+        return SEQUENCE_REORDERED
+
+    def reset(self, key):
+        """
+        Forget the window of a device, e.g. registered again after a restart
+        :param key: device telemetry topic
+        """
+        self.windows.pop(key, None)
+
+    def export_state(self):
+        """
+        :return: list of (key, highest, mask) of every window
+        """
+        return [(key, window.highest, window.mask) for key, window in self.windows.items()]
+
+    def restore(self, key, highest, mask):
+        """
+        :param key: device telemetry topic
+        :param highest: export_state highest sequence number
+        :param mask: export_state bitmask
+        """
+        self.windows[key] = SequenceWindow(highest, mask & self.full_mask)
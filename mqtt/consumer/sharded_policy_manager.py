@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+from mqtt.conf.metrics_conf_params import MetricsConfigurationParams as metricsParams
+from mqtt.consumer.policy_manager_data_collector import PolicyManagerAndDataCollector
+from mqtt.storage.streaming_csv_sink import StreamingCsvSink
+from mqtt.storage.columnar_record_sink import ColumnarRecordSink
+from mqtt.storage.queue_record_sink import QueueRecordSink, SyncRequest
+from mqtt.observability.metrics_registry import start_metrics_exporters
+from mqtt.observability.logging_setup import configure_logging
+
+configure_logging()
+
+
+def run_policy_manager_shard(shard_index, shard_count, shard_mode, record_queue, ack_queue):
+    """
+    Worker process entry point
+    Runs one PolicyManagerAndDataCollector on its own event loop
+    Records are sent to the supervisor instead of being written to file
+    :param shard_index:int
+    :param shard_count:int
+    :param shard_mode:str
+    :param record_queue: multiprocessing.Queue
+    :param ack_queue: multiprocessing.Queue of the supervisor answers to this shard sync requests
+    :return:
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    policy_manager = PolicyManagerAndDataCollector(
+        shard_index=shard_index,
+        shard_count=shard_count,
+        shard_mode=shard_mode,
+        record_sinks=[QueueRecordSink(record_queue, ack_queue, shard_index)]
+    )
+    logging.info(f"Starting Policy Manager shard {shard_index + 1}/{shard_count} (pid {os.getpid()})")
+    # Each shard has its own registry, exported on its own port and file
+    metrics_dump_path = metricsParams.POLICY_MANAGER_DUMP_PATH
+    if metrics_dump_path:
+        stem, extension = os.path.splitext(metrics_dump_path)
+        metrics_dump_path = f"{stem}-shard-{shard_index}{extension}"
+    start_metrics_exporters(metricsParams.SHARD_HTTP_PORT_BASE + shard_index, metrics_dump_path)
+    loop.create_task(policy_manager.start())
+    loop.run_forever()
+
+
+class ShardedPolicyManagerSupervisor:
+    """
+    Sharded Policy Manager and Data Collector
+    Spawns one worker process per shard, each owning a disjoint slice of devices
+    Per-topic threshold state lives in the shard owning the topic
+    Merges shard records into the csv (and columnar) sinks
+    """
+
+    def __init__(self, shard_count=pmParams.SHARD_COUNT, shard_mode=pmParams.SHARD_MODE):
+        self.shard_count = shard_count
+        self.shard_mode = shard_mode
+        self.record_queue = multiprocessing.Queue()
+        self.ack_queues = [multiprocessing.Queue() for _ in range(shard_count)]
+        self.shard_processes = []
+        self.record_sinks = [StreamingCsvSink(PolicyManagerAndDataCollector.file_path)]
+        if storageParams.COLUMNAR_ENABLED:
+            self.record_sinks.append(ColumnarRecordSink())
+
+    def start(self):
+        """
+        Spawn shard processes
+        :return:
+        """
+        try:
+            for shard_index in range(self.shard_count):
+                process = multiprocessing.Process(
+                    target=run_policy_manager_shard,
+                    args=(shard_index, self.shard_count, self.shard_mode, self.record_queue, self.ack_queues[shard_index]),
+                    name=f"policy-manager-shard-{shard_index}",
+                    daemon=True
+                )
+                process.start()
+                self.shard_processes.append(process)
+            logging.info(f"Started {self.shard_count} Policy Manager shards in {self.shard_mode} mode")
+        except Exception as e:
+            logging.error("Error starting Policy Manager shards!")
+            logging.error(e)
+
+    def merge_shard_records(self):
+        """
+        Write shard record batches to sinks until every shard is done
+        and sync the sinks when a shard asks to before its checkpoint
+        A shard is done when it sends None or when its process is gone
+        :return:
+        """
+        for record_sink in self.record_sinks:
+            record_sink.open()
+        finished_shards = 0
+        try:
+            while finished_shards < self.shard_count:
+                try:
+                    rows = self.record_queue.get(timeout=storageParams.FLUSH_INTERVAL)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in self.shard_processes):
+                        logging.error("Every shard stopped without closing its record sink")
+                        break
+                    for record_sink in self.record_sinks:
+                        record_sink.flush()
+                    continue
+                if rows is None:
+                    finished_shards += 1
+                    continue
+                if isinstance(rows, SyncRequest):
+                    # Shard checkpoint: its rows sent so far must be on disk
+                    synced = all([record_sink.flush(sync=True) for record_sink in self.record_sinks])
+                    self.ack_queues[rows.shard_index].put((rows.sync_id, synced))
+                    continue
+                for record_sink in self.record_sinks:
+                    for row in rows:
+                        record_sink.write_record(row)
+        except Exception as e:
+            logging.error("Error merging shard records")
+            logging.error(e)
+        finally:
+            for record_sink in self.record_sinks:
+                record_sink.close()
+
+    def stop(self):
+        for process in self.shard_processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        logging.info("Policy Manager shards stopped")
+
+
+def main():
+    supervisor = ShardedPolicyManagerSupervisor()
+    supervisor.start()
+    supervisor.merge_shard_records()
+    supervisor.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import math
+import sys
+
+from array import array
+
+# Vectorized batch evaluation when numpy is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this batch size the plain loop is faster than numpy overhead
+VECTORIZE_MIN_BATCH = 32
+
+
+class ThresholdStateEngine:
+    """
+    Compact threshold state of every telemetry topic
+    Each topic is interned to an integer slot
+    Slot columns are array backed: baseline level, notified flag, threshold
+    A baseline level is NaN until the first value after start or after an alert
+    """
+
+    def __init__(self, threshold_function):
+        """
+        :param threshold_function: callable(topic, resource type) -> SUPPLY_THRESHOLD,
+                                   called once per slot
+        """
+        self.threshold_function = threshold_function
+        self.slot_index = {}
+        self.topics = []
+        self.resource_types = []
+        self.baseline_levels = array("d")
+        self.notified = array("b")
+        self.thresholds = array("d")
+
+    def get_slot(self, topic, resource_type):
+        """
+        Return topic slot, allocating it on first sight
+        :param topic: telemetry topic
+        :param resource_type: bn, selects the slot threshold
+        :return slot:int
+        """
+        slot = self.slot_index.get(topic)
+        if slot is None:
+            topic = sys.intern(topic)
+            slot = self.slot_index[topic] = len(self.topics)
+            self.topics.append(topic)
+            self.resource_types.append(resource_type)
+            self.baseline_levels.append(math.nan)
+            self.notified.append(0)
+            self.thresholds.append(self.threshold_function(topic, resource_type))
+        return slot
+
+    def set_threshold(self, slot, threshold):
+        self.thresholds[slot] = threshold
+
+    def set_threshold_function(self, threshold_function):
+        """
+        Replace threshold_function and recompute the threshold of every slot
+        :param threshold_function: see __init__
+        :return:
+        """
+        self.threshold_function = threshold_function
+        for slot, (topic, resource_type) in enumerate(zip(self.topics, self.resource_types)):
+            self.thresholds[slot] = threshold_function(topic, resource_type)
+
+    def export_state(self):
+        """
+        :return: list of (topic, resource type, baseline level, notified) of every slot
+        """
+        return list(zip(self.topics, self.resource_types, self.baseline_levels, self.notified))
+
+    def restore_slot(self, topic, resource_type, baseline_level, notified):
+        """
+        Restore a slot exported by a previous run
+        :return slot:int
+        """
+        slot = self.get_slot(topic, resource_type)
+        self.baseline_levels[slot] = baseline_level
+        self.notified[slot] = notified
+        return slot
+
+    def evaluate(self, slots, values):
+        """
+        Check a batch of new levels against slot thresholds
+        Values of the same slot are applied in batch order
+        :param slots: list of slots
+        :param values: list of new levels, same length as slots
+        :return: batch positions of the values that reached their threshold, in batch order
+        """
+        if np is not None and len(slots) >= VECTORIZE_MIN_BATCH:
+            return self.evaluate_vectorized(np.asarray(slots, dtype=np.intp), np.asarray(values, dtype=np.float64))
+        return [index for index, (slot, value) in enumerate(zip(slots, values)) if self.evaluate_one(slot, value)]
+
+    def evaluate_one(self, slot, value):
+        baseline = self.baseline_levels[slot]
+        if baseline != baseline:
+            # New level saved
+            self.baseline_levels[slot] = value
+            self.notified[slot] = 0
+            return False
+        if not self.notified[slot] and value - baseline >= self.thresholds[slot]:
+            # Notified and baseline reset
+            self.notified[slot] = 1
+            self.baseline_levels[slot] = math.nan
+            return True
+        return False
+
+    def evaluate_vectorized(self, slots, values):
+        """
+        Same as evaluate_one over the whole batch
+        A slot repeated in the batch is handled in successive passes,
+        each pass holding at most one value per slot
+        :param slots: numpy intp array
+        :param values: numpy float64 array
+        :return: batch positions of the values that reached their threshold
+        """
+        # Occurrence rank of each entry among entries of the same slot
+        order = np.argsort(slots, kind="stable")
+        sorted_slots = slots[order]
+        positions = np.arange(len(slots))
+        group_starts = np.maximum.accumulate(np.where(np.r_[True, sorted_slots[1:] != sorted_slots[:-1]], positions, 0))
+        ranks = np.empty_like(positions)
+        ranks[order] = positions - group_starts
+
+        reached = np.zeros(len(slots), dtype=bool)
+        # Zero-copy views, released before the arrays can grow again
+        baseline_levels = np.frombuffer(self.baseline_levels, dtype=np.float64)
+        notified = np.frombuffer(self.notified, dtype=np.int8)
+        thresholds = np.frombuffer(self.thresholds, dtype=np.float64)
+        try:
+            for rank in range(ranks.max() + 1):
+                in_pass = ranks == rank
+                pass_slots = slots[in_pass]
+                pass_values = values[in_pass]
+                baselines = baseline_levels[pass_slots]
+                is_new = np.isnan(baselines)
+                is_reached = ~is_new & (notified[pass_slots] == 0) & (pass_values - baselines >= thresholds[pass_slots])
+                baseline_levels[pass_slots[is_new]] = pass_values[is_new]
+                notified[pass_slots[is_new]] = 0
+                baseline_levels[pass_slots[is_reached]] = np.nan
+                notified[pass_slots[is_reached]] = 1
+                reached[in_pass] = is_reached
+        finally:
+            del baseline_levels, notified, thresholds
+        return np.flatnonzero(reached).tolist()
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import math
+import os
+
+from mqtt.process.virtual_clock import current_time
+
+
+class TimerEntry:
+    __slots__ = ("key", "due_tick", "due_time", "level", "slot")
+
+    def __init__(self, key, due_tick, due_time):
+        self.key = key
+        self.due_tick = due_tick
+        self.due_time = due_time
+        self.level = None
+        self.slot = None
+
+
+class HierarchicalTimerWheel:
+    """
+    Hierarchical timer wheel keyed by timer key
+    Level l slots span tick_resolution * wheel_size ** l seconds
+    Entries cascade to lower levels as time advances
+    Insert and cancel are O(1), one timer per key
+    Pending timers can be persisted to a json file across restarts
+    The ticking task sleeps while no timer is pending
+    """
+
+    def __init__(self, tick_resolution, wheel_size, levels, persistence_path=None):
+        """
+        :param tick_resolution: seconds per tick
+        :param wheel_size: slots per level
+        :param levels: number of levels, range is tick_resolution * wheel_size ** levels
+        :param persistence_path: json file of pending timers, None disables persistence
+        """
+        self.tick_resolution = tick_resolution
+        self.wheel_size = wheel_size
+        self.levels = levels
+        self.persistence_path = persistence_path
+        self.wheels = [[{} for _ in range(wheel_size)] for _ in range(levels)]
+        self.entries = {}
+        self.current_tick = self.to_tick(current_time())
+        self.is_dirty = False
+        # Set when a timer is scheduled, wakes the idle ticking task
+        self.wakeup = None
+
+    def to_tick(self, timestamp):
+        return int(timestamp / self.tick_resolution)
+
+    def schedule(self, key, delay, replace=False):
+        """
+        Schedule a timer for key after delay seconds
+        :param key: timer key, at most one pending timer per key
+        :param delay: seconds
+        :param replace: move an already pending timer instead of keeping it
+        :return bool: False if a timer was already pending and kept
+        """
+        return self.schedule_at(key, current_time() + delay, replace)
+
+    def schedule_at(self, key, due_time, replace=False):
+        if key in self.entries:
+            if not replace:
+                return False
+            self.cancel(key)
+        if not self.entries:
+            # The idle wheel was not advanced, nothing is due in between
+            self.current_tick = max(self.current_tick, self.to_tick(current_time()))
+        entry = TimerEntry(key, max(math.ceil(due_time / self.tick_resolution), self.current_tick + 1), due_time)
+        self.entries[key] = entry
+        self.place(entry)
+        self.is_dirty = True
+        if self.wakeup:
+            self.wakeup.set()
+        return True
+
+    def cancel(self, key):
+        """
+        Cancel pending timer of key
+        :param key:
+        :return bool: False if no timer was pending
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        del self.wheels[entry.level][entry.slot][key]
+        self.is_dirty = True
+        return True
+
+    def place(self, entry):
+        ticks_left = entry.due_tick - self.current_tick
+        level = 0
+        span = self.wheel_size
+        while ticks_left >= span and level < self.levels - 1:
+            level += 1
+            span *= self.wheel_size
+        # Beyond range timers wait in the top level and cascade again
+        due_tick = min(entry.due_tick, self.current_tick + span - 1)
+        entry.level = level
+        entry.slot = (due_tick // self.wheel_size ** level) % self.wheel_size
+        self.wheels[level][entry.slot][entry.key] = entry
+
+    def advance(self, now):
+        """
+        Advance wheel up to now
+        :param now: timestamp
+        :return: list of expired keys, in due order
+        """
+        expired = []
+        target_tick = self.to_tick(now)
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            # Cascade higher levels whose slot is starting
+            level = 1
+            while level < self.levels and self.current_tick % self.wheel_size ** level == 0:
+                slot = (self.current_tick // self.wheel_size ** level) % self.wheel_size
+                cascading = self.wheels[level][slot]
+                self.wheels[level][slot] = {}
+                for entry in cascading.values():
+                    self.place(entry)
+                level += 1
+            slot = self.current_tick % self.wheel_size
+            due = self.wheels[0][slot]
+            if due:
+                self.wheels[0][slot] = {}
+                for entry in sorted(due.values(), key=lambda e: e.due_time):
+                    del self.entries[entry.key]
+                    expired.append(entry.key)
+                self.is_dirty = True
+            if not self.entries:
+                self.current_tick = target_tick
+        return expired
+
+    def pending(self):
+        """
+        :return: list of (key, due_time) sorted by due time
+        """
+        return sorted(((entry.key, entry.due_time) for entry in self.entries.values()), key=lambda item: item[1])
+
+    def save(self):
+        """
+        Atomically write pending timers to persistence file
+        :return:
+        """
+        if not self.persistence_path or not self.is_dirty:
+            return
+        try:
+            with open(self.persistence_path + ".tmp", "w") as f:
+                json.dump(dict(self.pending()), f)
+            os.replace(self.persistence_path + ".tmp", self.persistence_path)
+            self.is_dirty = False
+        except Exception as e:
+            logging.error("Error saving pending timers")
+            logging.error(e)
+
+    def load(self):
+        """
+        Reschedule timers saved by a previous run
+        Timers already due expire at the next tick
+        :return:
+        """
+        if not self.persistence_path or not os.path.isfile(self.persistence_path):
+            return
+        try:
+            with open(self.persistence_path) as f:
+                for key, due_time in json.load(f).items():
+                    self.schedule_at(key, due_time)
+            logging.info(f"Restored {len(self.entries)} pending timers from {self.persistence_path}")
+        except Exception as e:
+            logging.error("Error loading pending timers")
+            logging.error(e)
+
+    async def start_ticking_task(self, on_expired):
+        """
+        Advance the wheel every tick and await on_expired for every expired key
+        :param on_expired: async callable(key)
+        :return:
+        """
+        try:
+            self.wakeup = asyncio.Event()
+            while True:
+                if not self.entries:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                await asyncio.sleep(self.tick_resolution)
+                for key in self.advance(current_time()):
+                    await on_expired(key)
+                self.save()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in timer wheel ticking task")
+            logging.error(e)
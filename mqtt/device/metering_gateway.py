@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import uuid
+import zlib
+
+from asyncio_mqtt import Client
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
+from mqtt.conf.credentials import Credentials as creds
+
+
+class MeteringGateway:
+    """
+    Gateway for many emulated smart objects
+    A small pool of mqtt connections is shared by every registered smart object
+    Each smart object keeps its own telemetry/control/info topics
+    Control messages are routed to the smart object owning the control topic
+    """
+
+    def __init__(self, connection_count=devParams.GATEWAY_CONNECTIONS):
+        self.id = uuid.uuid4()
+        self.mqtt_clients = [
+            Client(
+                hostname=mqttParams.BROKER_ADDRESS,
+                port=mqttParams.BROKER_PORT,
+                clean_session=True,
+                client_id=f"{self.id}-{index}",
+                keepalive=10,
+                username=creds.SMART_OBJECT_USER,
+                password=creds.SMART_OBJECT_PW
+            )
+            for index in range(connection_count)
+        ]
+        # control topic -> MeteringSmartObject
+        self.smart_objects = {}
+        self.pending_subscriptions = [[] for _ in self.mqtt_clients]
+        self.is_subscribe_scheduled = False
+        self.connected = asyncio.Event()
+        # Exception of a failed start, raised to every waiting smart object
+        self.connect_error = None
+
+    def get_client(self, device_id):
+        """
+        Pooled connection of a device, stable for the device lifetime
+        :param device_id: UUID
+        :return Client:
+        """
+        return self.mqtt_clients[self.get_client_index(device_id)]
+
+    def get_client_index(self, device_id):
+        return zlib.crc32(str(device_id).encode("utf-8")) % len(self.mqtt_clients)
+
+    async def start(self):
+        """
+        Connect every pooled client and start routing control messages
+        :return:
+        """
+        try:
+            for mqtt_client in self.mqtt_clients:
+                await mqtt_client.connect()
+                asyncio.get_event_loop().create_task(self.on_message(mqtt_client), name=f"{self.id}on_message")
+            logging.info("Gateway %s connected to MQTT Broker with %d connections", self.id, len(self.mqtt_clients))
+            self.connected.set()
+        except Exception as e:
+            logging.error("Error starting Metering Gateway!")
+            logging.error(e)
+            self.connect_error = e
+            self.connected.set()
+
+    async def wait_connected(self):
+        """
+        :raise ConnectionError: the gateway could not connect its pool
+        """
+        await self.connected.wait()
+        if self.connect_error is not None:
+            raise ConnectionError(f"Gateway {self.id} is not connected: {self.connect_error}")
+
+    async def register_smart_object(self, smart_object):
+        """
+        Route smart object control topic to it
+        Subscriptions are gathered and sent in batches
+        :param smart_object: MeteringSmartObject
+        :return:
+        """
+        self.smart_objects[smart_object.control_topic] = smart_object
+        self.pending_subscriptions[self.get_client_index(smart_object.device_id)].append((smart_object.control_topic, 2))
+        if not self.is_subscribe_scheduled:
+            self.is_subscribe_scheduled = True
+            asyncio.get_event_loop().create_task(self.subscribe_to_control_topics())
+
+    async def deregister_smart_object(self, smart_object):
+        """
+        Stop routing and unsubscribe the smart object control topic
+        :param smart_object: MeteringSmartObject
+        :return:
+        """
+        self.smart_objects.pop(smart_object.control_topic, None)
+        client_index = self.get_client_index(smart_object.device_id)
+        pending = self.pending_subscriptions[client_index]
+        subscription = (smart_object.control_topic, 2)
+        if subscription in pending:
+            # Not subscribed yet
+            pending.remove(subscription)
+            return
+        try:
+            await self.mqtt_clients[client_index].unsubscribe(smart_object.control_topic)
+        except Exception as e:
+            logging.error("Error unsubscribing control topic!")
+            logging.error(e)
+
+    async def subscribe_to_control_topics(self):
+        """
+        Subscribe pending control topics with QoS level 2
+        one SUBSCRIBE packet per batch
+        :return:
+        """
+        try:
+            await asyncio.sleep(devParams.GATEWAY_SUBSCRIBE_WINDOW)
+            self.is_subscribe_scheduled = False
+            for mqtt_client, pending in zip(self.mqtt_clients, self.pending_subscriptions):
+                batch_size = devParams.GATEWAY_SUBSCRIBE_BATCH_SIZE
+                topics = pending[:]
+                pending.clear()
+                for index in range(0, len(topics), batch_size):
+                    await mqtt_client.subscribe(topics[index:index + batch_size])
+                if topics:
+                    logging.info("Gateway %s subscribed to %d control topics", self.id, len(topics))
+        except Exception as e:
+            logging.error("Error subscribing to control topics!")
+            logging.error(e)
+
+    async def on_message(self, mqtt_client):
+        """
+        Iterative async function
+        Route control messages of a pooled client to their smart object
+        :param mqtt_client: Client
+        :return:
+        """
+        try:
+            async with mqtt_client.filtered_messages(
+                    f'{mqttParams.MQTT_DEFAULT_TOPIC}/+/+/+/{mqttParams.DEVICE_TOPIC}/+/{mqttParams.CONTROL_TOPIC}') as messages:
+                async for message in messages:
+                    smart_object = self.smart_objects.get(message.topic)
+                    if smart_object:
+                        await smart_object.handle_control_message(message)
+        except Exception as e:
+            logging.error("Error routing incoming message!")
+            logging.error(e)
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import json
+import time
 import uuid
 
 import paho.mqtt.client as mqtt
@@ -13,13 +14,17 @@ from mqtt.resource.generic_actuator_resource import GenericActuatorResource
 from mqtt.message.telemetry_message import TelemetryMessage
 from mqtt.message.control_message import ControlMessage
 from mqtt.message.device_info_message import DeviceInfoMessage
+from mqtt.message.topic_resolver import build_device_topic
+from mqtt.device.telemetry_batcher import TelemetryBatcher
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
 from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
 from mqtt.conf.credentials import Credentials as creds
+from mqtt.observability.metrics_registry import REGISTRY
+from mqtt.observability.logging_setup import configure_logging, is_logged, TELEMETRY_PUBLISHED, CONTROL_RECEIVED
 
 
 
-logging.basicConfig(level=logging.DEBUG,
-                    format="%(asctime)s %(levelname)-8s %(message)s")
+configure_logging()
 
 DEMO_TIME = 70
 
@@ -30,67 +35,67 @@ class MeteringSmartObject:
     Subscribes to devices control topic
     On alert message it switches actuator's device status
     On a received notify_update a telemetry message is published
+    or gathered in a senml pack when batching
+    In gateway mode it shares the gateway connections
     """
 
-    def __init__(self, resources_dict, type, location, plant):
-        self.device_id = uuid.uuid4()
-        # Using async-mqtt wrapper for complete async compatibility
-        self.mqtt_client = Client(
-            hostname=mqttParams.BROKER_ADDRESS,
-            port=mqttParams.BROKER_PORT,
-            clean_session=True,
-            client_id=str(self.device_id),
-            keepalive=10,
-            username=creds.SMART_OBJECT_USER,
-            password=creds.SMART_OBJECT_PW
-            )
+    def __init__(self, resources_dict, type, location, plant, gateway=None, simulation_engines=None, mqtt_client=None, device_id=None):
+        # A given device_id keeps simulated fleets reproducible
+        self.device_id = device_id or uuid.uuid4()
+        self.gateway = gateway
+        # Resource type -> SensorSimulationEngine driving the sensor, if any
+        self.simulation_engines = simulation_engines or {}
+        if self.gateway:
+            # Pooled gateway connection
+            self.mqtt_client = self.gateway.get_client(self.device_id)
+        elif mqtt_client:
+            # Client with the asyncio_mqtt.Client interface, e.g. InProcessClient
+            self.mqtt_client = mqtt_client
+        else:
+            # Using async-mqtt wrapper for complete async compatibility
+            self.mqtt_client = Client(
+                hostname=mqttParams.BROKER_ADDRESS,
+                port=mqttParams.BROKER_PORT,
+                clean_session=True,
+                client_id=str(self.device_id),
+                keepalive=10,
+                username=creds.SMART_OBJECT_USER,
+                password=creds.SMART_OBJECT_PW
+                )
         self.resources_dict = resources_dict
         self.type = type
         self.software_version = 1.0
         self.manufacturer = "ACME-INC"
         self.location = location
         self.plant = plant
-        logging.info(f"{self.type} Metering Smart Object successfully created !")
-
-        self.telemetry_topic = "{0}/{1}/{2}/{3}/{4}/{5}/{6}".format(
-            mqttParams.MQTT_DEFAULT_TOPIC,
-            self.location,
-            self.plant,
-            self.type,
-            mqttParams.DEVICE_TOPIC,
-            self.device_id,
-            mqttParams.TELEMETRY_TOPIC
-        )
-
-        self.control_topic = "{0}/{1}/{2}/{3}/{4}/{5}/{6}".format(
-            mqttParams.MQTT_DEFAULT_TOPIC,
-            self.location,
-            self.plant,
-            self.type,
-            mqttParams.DEVICE_TOPIC,
-            self.device_id,
-            mqttParams.CONTROL_TOPIC
-        )
+        self.published_messages = 0
+        # Sequence number of the next telemetry record, lets the collector drop duplicates and spot reordering
+        self.telemetry_sequence = 0
+        # Shared by every smart object of the process, one child per resource type
+        self.publish_latency = REGISTRY.histogram(
+            "smart_object_publish_seconds", "Telemetry publish time", ("resource_type",)).labels(self.type)
+        self.publish_failures = REGISTRY.counter(
+            "smart_object_publish_failures_total", "Telemetry messages that could not be published", ("resource_type",)).labels(self.type)
+        self.telemetry_encoding = devParams.TELEMETRY_ENCODING
+        self.telemetry_batcher = TelemetryBatcher(self.on_batch_ready, encoding=self.telemetry_encoding) if devParams.BATCHING_ENABLED else None
+        logging.info("%s Metering Smart Object successfully created !", self.type)
 
-        self.info_topic = "{0}/{1}/{2}/{3}/{4}/{5}/{6}".format(
-            mqttParams.MQTT_DEFAULT_TOPIC,
-            self.location,
-            self.plant,
-            self.type,
-            mqttParams.DEVICE_TOPIC,
-            self.device_id,
-            mqttParams.INFO_TOPIC
-        )
+        self.telemetry_topic = build_device_topic(self.location, self.plant, self.type, self.device_id, mqttParams.TELEMETRY_TOPIC)
+        self.control_topic = build_device_topic(self.location, self.plant, self.type, self.device_id, mqttParams.CONTROL_TOPIC)
+        self.info_topic = build_device_topic(self.location, self.plant, self.type, self.device_id, mqttParams.INFO_TOPIC)
 
     async def on_connect(self):
         """
-        Connect to mqtt broker
+        Connect to mqtt broker, or wait for the gateway connections
         Publish retained device info message
         """
         try:
-            await self.mqtt_client.connect()
-            logging.info(f"Device {self.device_id} successfully connected to MQTT Broker")
-            message = DeviceInfoMessage(self.device_id, self.software_version, self.manufacturer, self.location, self.plant)
+            if self.gateway:
+                await self.gateway.wait_connected()
+            else:
+                await self.mqtt_client.connect()
+            logging.info("Device %s successfully connected to MQTT Broker", self.device_id)
+            message = DeviceInfoMessage(self.device_id, self.software_version, self.manufacturer, self.location, self.plant, self.telemetry_encoding)
             # Publish retained device info message
             await self.mqtt_client.publish(
                 self.info_topic,
@@ -110,14 +115,23 @@ class MeteringSmartObject:
         try:
             async with self.mqtt_client.filtered_messages('#') as messages:
                 async for message in messages:
-                    control_message:ControlMessage = self.parse_control_message(message)
-                    if control_message.type == 'alert':
-                        logging.info(f"CONTROL MESSAGE RECEIVED! Switching {self.type} actuator ...")
-                        await self.resources_dict['actuator'].switch_actuator_status()
+                    await self.handle_control_message(message)
         except Exception as e:
             logging.error("Error processing incoming message!")
             logging.error(e)
 
+    async def handle_control_message(self, message):
+        """
+        Switch actuator on alert control message
+        :param message: mqtt message received on control topic
+        :return:
+        """
+        control_message:ControlMessage = self.parse_control_message(message)
+        if control_message and control_message.type == 'alert':
+            if is_logged(CONTROL_RECEIVED):
+                logging.info("CONTROL MESSAGE RECEIVED! Switching %s actuator ...", self.type, extra={"event": CONTROL_RECEIVED})
+            await self.resources_dict['actuator'].switch_actuator_status()
+
     def parse_control_message(self, mqtt_message: mqtt.MQTTMessage):
         """
         Build ControlMessage from json payload
@@ -140,7 +154,7 @@ class MeteringSmartObject:
         """
         try:
             await self.mqtt_client.subscribe(self.control_topic, qos=2)
-            logging.info("Subscribed to: " + self.control_topic)
+            logging.info("Subscribed to: %s", self.control_topic)
         except Exception as e:
             logging.error("Error subscribing to control topic!")
             logging.error(e)
@@ -153,13 +167,13 @@ class MeteringSmartObject:
         - It checks if resources given are allowed
         - It registers to resources data listener
         - It registers sensor to actuator data listener
-        - It creates periodic event value update task
+        - It creates periodic event value update task or attaches to simulation engine
         :return:
         """
         try:
             for resource in self.resources_dict:
                 if isinstance(self.resources_dict[resource], (GasSensorResource, WaterSensorResource, ElectricitySensorResource, GenericActuatorResource)):
-                    logging.info(f"Registering to Resource {self.resources_dict[resource].type} (id: {self.resources_dict[resource].id}) notifications")
+                    logging.info("Registering to Resource %s (id: %s) notifications", self.resources_dict[resource].type, self.resources_dict[resource].id)
                     # Registering to data listener for both actuator and sensor
                     self.resources_dict[resource].add_data_listener(self.on_data_changed)
                     # Linking actuator status to sensor
@@ -168,7 +182,11 @@ class MeteringSmartObject:
 
                     # Starting periodic event value update for emulating purposes
                     if resource == "sensor":
-                        asyncio.get_event_loop().create_task(self.resources_dict[resource].start_periodic_event_value_update_task(), name=str(self.device_id)+"periodic")
+                        simulation_engine = self.simulation_engines.get(self.resources_dict[resource].type)
+                        if simulation_engine:
+                            self.resources_dict[resource].attach_simulation_engine(simulation_engine)
+                        else:
+                            asyncio.get_event_loop().create_task(self.resources_dict[resource].start_periodic_event_value_update_task(), name=str(self.device_id)+"periodic")
 
         except Exception as e:
             logging.error("Error Registering to resources! ")
@@ -182,7 +200,7 @@ class MeteringSmartObject:
         try:
             for resource in self.resources_dict:
                 self.resources_dict[resource].remove_data_listener(resource)
-                logging.info(f"Removed {resource} data listener for resource {self.device_id}")
+                logging.info("Removed %s data listener for resource %s", resource, self.device_id)
         except Exception as e:
             logging.error("Error de-registering to resources! ")
             logging.error(e)
@@ -192,7 +210,7 @@ class MeteringSmartObject:
         When a sensor/actuator changes value/state
         a TelemetryMessage is composed looking for
         a needed param and some optional but always given params
-        Creates task to publish data
+        Creates task to publish data, or adds it to the batch
         :param updated_value:
         :param kwargs: type
         :param kwargs: unit
@@ -201,15 +219,31 @@ class MeteringSmartObject:
         try:
             type = kwargs.get('type', None)
             unit = kwargs.get('unit', None)
-            message = TelemetryMessage(type=type, value=updated_value, unit=unit, name=self.device_id)
-            asyncio.get_event_loop().create_task(self.publish_telemetry_data(
-                topic=self.telemetry_topic,
-                message=message.build_senml_json_payload()
-            ))
+            message = TelemetryMessage(type=type, value=updated_value, unit=unit, name=self.device_id,
+                                       sequence=self.telemetry_sequence)
+            self.telemetry_sequence += 1
+            if self.telemetry_batcher:
+                self.telemetry_batcher.add(message)
+            else:
+                asyncio.get_event_loop().create_task(self.publish_telemetry_data(
+                    topic=self.telemetry_topic,
+                    message=message.build_senml_payload(self.telemetry_encoding)
+                ))
         except Exception as e:
             logging.error("Error! No data received")
             logging.error(e)
 
+    def on_batch_ready(self, payload):
+        """
+        Creates task to publish a senml pack of batched records
+        :param payload: pack.to_json()
+        :return:
+        """
+        asyncio.get_event_loop().create_task(self.publish_telemetry_data(
+            topic=self.telemetry_topic,
+            message=payload
+        ))
+
     async def publish_telemetry_data(self, topic, message):
         """
         Publish given message on given topic
@@ -219,9 +253,14 @@ class MeteringSmartObject:
         """
         if topic and message:
             try:
+                publish_start = time.perf_counter()
                 await self.mqtt_client.publish(topic, message)
-                logging.info(f"Data {message} successfully published to {topic}")
+                self.publish_latency.observe(time.perf_counter() - publish_start)
+                self.published_messages += 1
+                if is_logged(TELEMETRY_PUBLISHED):
+                    logging.info("Data %s successfully published to %s", message, topic, extra={"event": TELEMETRY_PUBLISHED})
             except Exception as e:
+                self.publish_failures.inc()
                 logging.error("Error! Could not publish data")
                 logging.error(e)
         else:
@@ -234,41 +273,52 @@ class MeteringSmartObject:
         """
         try:
             await self.mqtt_client.publish(self.info_topic, None, retain=True)
-            logging.info(f"Cleaned {self.info_topic} from retain message")
+            logging.info("Cleaned %s from retain message", self.info_topic)
         except Exception as e:
             logging.error("Error cleaning info topic from retain message")
             logging.error(e)
 
-    async def start(self):
+    async def start(self, demo_time=DEMO_TIME):
         """
         Starts smart object emulation
+        :param demo_time: seconds before stopping, None runs until the loop is stopped
         :return:
         """
         try:
             if self.device_id and len(self.resources_dict.keys()) > 0:
-                logging.info(f"Starting {self.type} Metering Emulator ...")
+                logging.info("Starting %s Metering Emulator ...", self.type)
 
                 await self.on_connect()
-                # Creating background task to receive messages
-                asyncio.get_event_loop().create_task(self.on_message(), name=str(self.device_id)+"on_message")
-                await self.subscribe_to_control_topic()
+                if self.gateway:
+                    # Control messages are routed by the gateway
+                    await self.gateway.register_smart_object(self)
+                else:
+                    # Creating background task to receive messages
+                    asyncio.get_event_loop().create_task(self.on_message(), name=str(self.device_id)+"on_message")
+                    await self.subscribe_to_control_topic()
                 await self.register_to_available_resources()
-                asyncio.get_event_loop().create_task(self.stop())
+                if demo_time is not None:
+                    asyncio.get_event_loop().create_task(self.stop(demo_time))
 
         except Exception as e:
             logging.error(f"Error starting {self.type} Metering Emulator! ")
             logging.error(e)
 
-    async def stop(self):
+    async def stop(self, demo_time=DEMO_TIME):
         """
         Sleeps for simulation time and then stops tasks and loop
         When done starts calls write to file function
         :return:
         """
         try:
-            await asyncio.sleep(DEMO_TIME)
+            await asyncio.sleep(demo_time)
             await self.deregister_to_resources()
+            if self.telemetry_batcher:
+                for payload in self.telemetry_batcher.drain():
+                    await self.publish_telemetry_data(self.telemetry_topic, payload)
             await self.clean_info_topic()
+            if self.gateway:
+                await self.gateway.deregister_smart_object(self)
             for task in asyncio.all_tasks():
                 if task.get_name() == str(self.device_id)+"on_message" or task.get_name() == str(self.device_id)+"periodic":
                     task.cancel()
@@ -0,0 +1,59 @@
+import asyncio
+
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
+from mqtt.message.telemetry_message import TelemetryMessage
+
+
+class TelemetryBatcher:
+    """
+    Gather telemetry messages of a smart object into senml packs
+    A pack is ready when it holds max_records records
+    or when window seconds have passed since its first record
+    One pack per resource type (bn)
+    """
+
+    def __init__(self, on_batch_ready, window=devParams.BATCH_WINDOW, max_records=devParams.BATCH_MAX_RECORDS,
+                 encoding=devParams.TELEMETRY_ENCODING):
+        """
+        :param on_batch_ready: callable(payload) called with every ready pack
+        :param window: seconds
+        :param max_records: records per pack
+        :param encoding: senml+json or senml+cbor content type
+        """
+        self.on_batch_ready = on_batch_ready
+        self.encoding = encoding
+        self.window = window
+        self.max_records = max_records
+        self.pending_messages = {}
+        self.pending_count = 0
+        self.flush_handle = None
+
+    def add(self, message):
+        """
+        Add a message to its type pack
+        :param message: TelemetryMessage
+        :return:
+        """
+        self.pending_messages.setdefault(message.type, []).append(message)
+        self.pending_count += 1
+        if self.pending_count >= self.max_records:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def drain(self):
+        """
+        Take pending messages as senml pack payloads
+        :return: list of encoded packs
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        payloads = [TelemetryMessage.build_senml_pack_payload(messages, self.encoding) for messages in self.pending_messages.values()]
+        self.pending_messages = {}
+        self.pending_count = 0
+        return payloads
+
+    def flush(self):
+        for payload in self.drain():
+            self.on_batch_ready(payload)
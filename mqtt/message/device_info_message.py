@@ -1,8 +1,10 @@
 import json
 
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+
 class DeviceInfoMessage(object):
 
-    def __init__(self, id, software_version, manufacturer, location, plant):
+    def __init__(self, id, software_version, manufacturer, location, plant, encoding=mqttParams.SENML_JSON_CONTENT_TYPE):
         """
         Telemetry message has all optional param because of
         build_class_from_senml_json method which needs an instance of self
@@ -11,12 +13,14 @@ class DeviceInfoMessage(object):
         :param manufacturer
         :param location
         :param plant
+        :param encoding: telemetry senml content type
         """
         self.id = str(id)
         self.software_version = software_version
         self.manufacturer = manufacturer
         self.location = location
         self.plant = plant
+        self.encoding = encoding
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__)
\ No newline at end of file
@@ -1,12 +1,13 @@
 import json
-import time
+
+from mqtt.process.virtual_clock import current_time
 
 
 class GenericMessage(object):
     def __init__(self, type, metadata, **kwargs):
         self.type = type
         self.metadata = metadata
-        self.timestamp = kwargs.get('timestamp', None) if kwargs.get('timestamp', None) else int(time.time())
+        self.timestamp = kwargs.get('timestamp', None) if kwargs.get('timestamp', None) else int(current_time())
 
     def to_json(self):
         return json.dumps(self, default=lambda o: o.__dict__)
\ No newline at end of file
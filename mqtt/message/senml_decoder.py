@@ -0,0 +1,120 @@
+import json
+import time
+
+from collections import namedtuple
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.process.virtual_clock import current_time
+
+# Faster json backend when installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+# Binary senml support when installed
+try:
+    import cbor2
+    cbor_loads = cbor2.loads
+except ImportError:
+    cbor_loads = None
+
+# Same order as the csv record header, seq is None for devices not sending it
+TelemetryRecord = namedtuple("TelemetryRecord", ["n", "bn", "v", "u", "t", "seq"], defaults=(None,))
+
+# RFC 8428 4.5.3: times below 2**28 are relative to now
+RELATIVE_TIME_LIMIT = 2 ** 28
+
+# Device sequence number, a senml extension field with the same label in json and cbor
+SEQUENCE_LABEL = "seq"
+
+# Field labels (bn, bt, bu, bv, n, u, v, vs, vb, t, seq), RFC 8428 6: cbor uses integer labels
+JSON_LABELS = ("bn", "bt", "bu", "bv", "n", "u", "v", "vs", "vb", "t", SEQUENCE_LABEL)
+CBOR_LABELS = (-2, -3, -4, -5, 0, 1, 2, 3, 4, 6, SEQUENCE_LABEL)
+
+
+def detect_senml_encoding(payload):
+    """
+    Guess content type from first payload byte
+    A senml cbor pack is a cbor array (major type 4), a json one starts with '['
+    :param payload: bytes
+    :return: senml+json or senml+cbor content type
+    """
+    if payload and 0x80 <= payload[0] <= 0x9f:
+        return mqttParams.SENML_CBOR_CONTENT_TYPE
+    return mqttParams.SENML_JSON_CONTENT_TYPE
+
+
+def decode_senml_payload(payload, encoding=mqttParams.SENML_JSON_CONTENT_TYPE):
+    """
+    Decode a senml pack straight into TelemetryRecord tuples
+    :param payload: bytes or str, pack.to_json() or pack.to_cbor()
+    :param encoding: senml+json or senml+cbor content type
+    :return: list of TelemetryRecord
+    """
+    if encoding == mqttParams.SENML_CBOR_CONTENT_TYPE:
+        if cbor_loads is None:
+            raise ValueError("cbor2 is required to decode senml+cbor payloads")
+        return build_telemetry_records(cbor_loads(payload), CBOR_LABELS)
+    return build_telemetry_records(json_loads(payload), JSON_LABELS)
+
+
+def decode_senml_batch(payloads):
+    """
+    Decode many senml packs, usable from a thread or process pool
+    :param payloads: list of (payload, encoding)
+    :return: list of (list of TelemetryRecord or None if not parsable, decode seconds)
+    """
+    results = []
+    for payload, encoding in payloads:
+        decode_start = time.perf_counter()
+        try:
+            records = decode_senml_payload(payload, encoding)
+        except Exception:
+            records = None
+        results.append((records, time.perf_counter() - decode_start))
+    return results
+
+
+def build_telemetry_records(raw_records, labels):
+    """
+    Resolve raw senml records into TelemetryRecord tuples
+    Base fields (bn, bt, bu, bv) apply to every following record of the pack
+    :param raw_records: list of dict parsed from the payload
+    :param labels: JSON_LABELS or CBOR_LABELS
+    :return: list of TelemetryRecord
+    """
+    bn_label, bt_label, bu_label, bv_label, n_label, u_label, v_label, vs_label, vb_label, t_label, seq_label = labels
+    records = []
+    base_name = None
+    base_time = 0
+    base_unit = None
+    base_value = 0
+    for record in raw_records:
+        if bn_label in record:
+            base_name = record[bn_label]
+        if bt_label in record:
+            base_time = record[bt_label]
+        if bu_label in record:
+            base_unit = record[bu_label]
+        if bv_label in record:
+            base_value = record[bv_label]
+
+        value = record.get(v_label)
+        if value is not None:
+            value = value + base_value
+        elif vb_label in record:
+            value = record[vb_label]
+        elif vs_label in record:
+            value = record[vs_label]
+
+        timestamp = base_time + record.get(t_label, 0)
+        if timestamp < RELATIVE_TIME_LIMIT:
+            timestamp = int(current_time()) + timestamp
+
+        records.append(TelemetryRecord(record.get(n_label), base_name, value, record.get(u_label, base_unit), timestamp,
+                                       record.get(seq_label)))
+    return records
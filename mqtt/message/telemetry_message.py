@@ -1,10 +1,40 @@
 import logging
-import time
 import json
 
 
 from kpn_senml import *
 
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.message.senml_decoder import SEQUENCE_LABEL
+from mqtt.process.virtual_clock import current_time
+
+
+def encode_senml_pack(pack, encoding):
+    """
+    Render pack in the given content format
+    :param pack: SenmlPack
+    :param encoding: senml+json or senml+cbor content type
+    :return: json str or cbor bytes
+    """
+    if encoding == mqttParams.SENML_CBOR_CONTENT_TYPE:
+        return pack.to_cbor()
+    return pack.to_json()
+
+
+class SequencedSenmlRecord(SenmlRecord):
+    """
+    SenmlRecord carrying the device sequence number as seq extension field
+    """
+
+    def __init__(self, name, sequence=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.sequence = sequence
+
+    def _build_rec_dict(self, naming_map, appendTo):
+        super()._build_rec_dict(naming_map, appendTo)
+        if self.sequence is not None:
+            appendTo[-1][SEQUENCE_LABEL] = self.sequence
+
 
 class TelemetryMessage(object):
 
@@ -17,27 +47,65 @@ class TelemetryMessage(object):
         :param kwargs: value
         :param kwargs: unit
         :param kwargs: timestamp
+        :param kwargs: sequence, per device monotonic number
         """
         self.name = kwargs.get('name', None)
         self.type = kwargs.get('type', None)
         self.value = kwargs.get('value', None)
         self.unit = kwargs.get('unit', None) if kwargs.get('unit', None) else None
-        self.timestamp = kwargs.get('timestamp', None) if kwargs.get('timestamp', None) else int(time.time())
+        self.timestamp = kwargs.get('timestamp', None) if kwargs.get('timestamp', None) else int(current_time())
+        self.sequence = kwargs.get('sequence', None)
 
-    def build_senml_json_payload(self):
+    def build_senml_pack(self):
         pack = SenmlPack(self.type)
         try:
-            record = SenmlRecord(name=str(self.name),
-                                 value=self.value,
-                                 unit=self.unit,
-                                 time=self.timestamp
-                                 )
+            record = SequencedSenmlRecord(name=str(self.name),
+                                          sequence=self.sequence,
+                                          value=self.value,
+                                          unit=self.unit,
+                                          time=self.timestamp
+                                          )
             pack.add(record)
         except Exception as e:
-            logging.error("Error Building Telemetry SenML Json payload")
+            logging.error("Error Building Telemetry SenML payload")
             logging.error(e)
         finally:
-            return pack.to_json()
+            return pack
+
+    def build_senml_json_payload(self):
+        return self.build_senml_pack().to_json()
+
+    def build_senml_payload(self, encoding=mqttParams.SENML_JSON_CONTENT_TYPE):
+        """
+        :param encoding: senml+json or senml+cbor content type
+        :return: json str or cbor bytes
+        """
+        return encode_senml_pack(self.build_senml_pack(), encoding)
+
+    @staticmethod
+    def build_senml_pack_payload(messages, encoding=mqttParams.SENML_JSON_CONTENT_TYPE):
+        """
+        Builds one senml pack from messages of the same type
+        Base time is the first message timestamp, record times are relative to it
+        :param messages: list of TelemetryMessage
+        :param encoding: senml+json or senml+cbor content type
+        :return: json str or cbor bytes
+        """
+        pack = SenmlPack(messages[0].type)
+        pack.base_time = messages[0].timestamp
+        try:
+            for message in messages:
+                pack.add(SequencedSenmlRecord(name=str(message.name),
+                                              sequence=message.sequence,
+                                              value=message.value,
+                                              unit=message.unit,
+                                              time=message.timestamp
+                                              ))
+        except Exception as e:
+            logging.error("Error Building Telemetry SenML pack payload")
+            logging.error(e)
+        finally:
+            return encode_senml_pack(pack, encoding)
 
     def build_class_from_senml_json(self, payload):
         """
@@ -52,11 +120,20 @@ class TelemetryMessage(object):
                 self.value = record["v"] if "v" in record else record['vb']
                 self.unit = record["u"] if "u" in record else None
                 self.name = record["n"]
+                self.timestamp = record["t"] if "t" in record else self.timestamp
+                self.sequence = record.get(SEQUENCE_LABEL, self.sequence)
         except Exception as e:
             logging.error("Error crafting Telemetry Message from json")
             logging.error(e)
         finally:
             return self
 
+    def to_record_row(self):
+        """
+        Row in csv record header order
+        :return: (n, bn, v, u, t, seq)
+        """
+        return self.name, self.type, self.value, self.unit, self.timestamp, self.sequence
+
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__).replace("name", "n").replace("value", "v").replace("timestamp", "t").replace("unit", "u").replace("type", "bn")
\ No newline at end of file
+        return json.dumps(dict(zip(("n", "bn", "v", "u", "t", "seq"), self.to_record_row())))
\ No newline at end of file
@@ -0,0 +1,71 @@
+from collections import OrderedDict, namedtuple
+
+from mqtt.conf.mqtt_conf_params import MqttConfigurationParams as mqttParams
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+
+# Fields of a device topic and every topic of the same device
+ParsedTopic = namedtuple("ParsedTopic", ["location", "plant", "resource", "device_id",
+                                         "telemetry_topic", "control_topic", "info_topic"])
+
+DEVICE_TOPIC_LEVELS = 7
+
+
+def build_device_topic(location, plant, resource, device_id, leaf):
+    """
+    /metering/[location]/[plant]/[resource]/device/[unique_id]/[leaf]
+    :param leaf: telemetry, control or info
+    :return topic:str
+    """
+    return "{0}/{1}/{2}/{3}/{4}/{5}/{6}".format(
+        mqttParams.MQTT_DEFAULT_TOPIC, location, plant, resource, mqttParams.DEVICE_TOPIC, device_id, leaf)
+
+
+def parse_device_topic(topic):
+    """
+    Split a device telemetry, control or info topic
+    :param topic:str
+    :return: ParsedTopic, None if topic is not a device topic
+    """
+    levels = topic.split('/')
+    if (len(levels) != DEVICE_TOPIC_LEVELS
+            or levels[0] != mqttParams.MQTT_DEFAULT_TOPIC
+            or levels[4] != mqttParams.DEVICE_TOPIC
+            or levels[6] not in (mqttParams.TELEMETRY_TOPIC, mqttParams.CONTROL_TOPIC, mqttParams.INFO_TOPIC)):
+        return None
+    location, plant, resource, device_id = levels[1], levels[2], levels[3], levels[5]
+    return ParsedTopic(
+        location, plant, resource, device_id,
+        build_device_topic(location, plant, resource, device_id, mqttParams.TELEMETRY_TOPIC),
+        build_device_topic(location, plant, resource, device_id, mqttParams.CONTROL_TOPIC),
+        build_device_topic(location, plant, resource, device_id, mqttParams.INFO_TOPIC)
+    )
+
+
+class TopicResolver:
+    """
+    Device topic parser with a bounded LRU cache
+    Each topic is split once, then resolving it is a dict hit
+    """
+
+    def __init__(self, max_size=pmParams.TOPIC_CACHE_SIZE):
+        """
+        :param max_size: topics kept, least recently used are evicted first
+        """
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def resolve(self, topic):
+        """
+        :param topic: device telemetry, control or info topic
+        :return: ParsedTopic, None if topic is not a device topic
+        """
+        parsed = self.cache.get(topic)
+        if parsed is not None:
+            self.cache.move_to_end(topic)
+            return parsed
+        parsed = parse_device_topic(topic)
+        if parsed is not None:
+            self.cache[topic] = parsed
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return parsed
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+MAX_REQUEST_LINE = 8192
+REQUEST_TIMEOUT = 5 #s
+
+
+class LocalHttpServer:
+    """
+    Minimal asyncio HTTP/1.0 server for local introspection endpoints
+    GET only, one request per connection
+    Handlers get the query parameters and return (status, content type, body)
+    """
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        # path -> handler
+        self.routes = {}
+        self.server = None
+
+    def add_route(self, path, handler):
+        """
+        :param path: request path, e.g. /metrics
+        :param handler: callable(query) -> (HTTPStatus, content type, str or bytes),
+                        query maps each parameter to its last value
+        :return:
+        """
+        self.routes[path] = handler
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, self.address, self.port)
+            logging.info(f"Serving {sorted(self.routes)} on http://{self.address}:{self.port}")
+        except Exception as e:
+            logging.error(f"Error starting http server on port {self.port}")
+            logging.error(e)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # Skip headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            status, content_type, body = self.handle_request(request_line[:MAX_REQUEST_LINE].decode("latin-1"))
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            writer.write(f"HTTP/1.0 {status.value} {status.phrase}\r\n"
+                         f"Content-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except Exception as e:
+            logging.error("Error handling http request")
+            logging.error(e)
+        finally:
+            writer.close()
+
+    def handle_request(self, request_line):
+        """
+        :param request_line: e.g. GET /metrics HTTP/1.1
+        :return: (HTTPStatus, content type, body)
+        """
+        parts = request_line.split()
+        if len(parts) < 2:
+            return HTTPStatus.BAD_REQUEST, "text/plain", "Bad request\n"
+        if parts[0] != "GET":
+            return HTTPStatus.METHOD_NOT_ALLOWED, "text/plain", "Only GET is supported\n"
+        url = urlsplit(parts[1])
+        handler = self.routes.get(url.path)
+        if handler is None:
+            return HTTPStatus.NOT_FOUND, "text/plain", "Not found\n"
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            return handler(query)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, "application/json", json.dumps({"error": str(e)})
+        except Exception as e:
+            logging.error(f"Error handling {url.path} request")
+            logging.error(e)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", "Internal error\n"
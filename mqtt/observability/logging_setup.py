@@ -0,0 +1,137 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from mqtt.conf.logging_conf_params import LoggingConfigurationParams as loggingParams
+
+# Per message events, passed as extra={"event": ...}
+TELEMETRY_VALUE = "telemetry_value"
+TELEMETRY_PUBLISHED = "telemetry_published"
+CONTROL_PUBLISHED = "control_published"
+CONTROL_RECEIVED = "control_received"
+DEVICE_INFO = "device_info"
+
+# Attributes of every LogRecord, anything else was given through extra
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+queue_handler = None
+queue_listener = None
+
+
+class EventSampler:
+    """
+    Keep 1 record out of N for each sampled event
+    Events missing from rates always pass
+    """
+
+    def __init__(self, rates):
+        """
+        :param rates: event -> N, 0 drops every record of the event
+        """
+        self.rates = dict(rates)
+        self.counts = dict.fromkeys(self.rates, 0)
+
+    def sample(self, event):
+        rate = self.rates.get(event)
+        if rate is None or rate == 1:
+            return True
+        if rate <= 0:
+            return False
+        count = self.counts[event]
+        self.counts[event] = count + 1
+        return count % rate == 0
+
+
+sampler = EventSampler(loggingParams.SAMPLING_RATES)
+
+
+def is_logged(event, level=logging.INFO):
+    """
+    Guard of per message logs, checked before the LogRecord is built
+    if is_logged(TELEMETRY_VALUE):
+        logging.info("...", value, extra={"event": TELEMETRY_VALUE})
+    :param event: per message event
+    :param level: level of the guarded call
+    :return: True when the level is enabled and the record is sampled in
+    """
+    return logging.getLogger().isEnabledFor(level) and sampler.sample(event)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line with time, level, message and extra fields
+    """
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for name, value in record.__dict__.items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving message formatting to the listener thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging():
+    """
+    Configure root logger from LoggingConfigurationParams
+    Replaces logging.basicConfig, only the first call has effect
+    :return:
+    """
+    global queue_handler
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if loggingParams.FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(loggingParams.TEXT_FORMAT))
+
+    if loggingParams.QUEUE_ENABLED:
+        queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+        start_queue_listener(stream_handler)
+        # The listener thread does not survive fork, worker processes start their own
+        os.register_at_fork(after_in_child=lambda: start_queue_listener(stream_handler))
+        atexit.register(stop_queue_listener)
+        handler = queue_handler
+    else:
+        handler = stream_handler
+    root.addHandler(handler)
+    root.setLevel(loggingParams.LEVEL)
+
+
+def start_queue_listener(stream_handler):
+    global queue_listener
+    queue_handler.queue = queue.SimpleQueue()
+    queue_listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    queue_listener.start()
+
+
+def stop_queue_listener():
+    """
+    Write queued records and stop the listener thread
+    :return:
+    """
+    global queue_listener
+    if queue_listener:
+        queue_listener.stop()
+        queue_listener = None
@@ -0,0 +1,296 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+
+from abc import ABC, abstractmethod
+from http import HTTPStatus
+
+from mqtt.conf.metrics_conf_params import MetricsConfigurationParams as metricsParams
+from mqtt.observability.http_server import LocalHttpServer
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric(ABC):
+    """
+    Base of registry metrics
+    A metric without label names is its own child,
+    otherwise labels(...) returns the child of the given label values
+    """
+
+    TYPE = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        # label values -> child
+        self.children = {}
+        if not self.label_names:
+            # Exported as 0 before the first update
+            self.labels()
+
+    def labels(self, *label_values):
+        """
+        :param label_values: one value per label name
+        :return: child metric, created on first use
+        """
+        child = self.children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects labels {self.label_names}")
+            child = self.children[label_values] = self.create_child()
+        return child
+
+    @abstractmethod
+    def create_child(self):
+        """
+        :return: new child holding the values of one label set
+        """
+
+    @abstractmethod
+    def samples(self):
+        """
+        :return: list of (name suffix, label values, extra labels, value)
+        """
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.label_names, label_values, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    """
+    Monotonic count, named with the _total suffix
+    """
+
+    TYPE = "counter"
+
+    def create_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [("", label_values, (), child.value) for label_values, child in self.children.items()]
+
+
+class GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """
+        Read the value from function when rendering, nothing to update on the hot path
+        :param function: callable returning a number
+        """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Gauge(Metric):
+    """
+    Value going up and down, set directly or read from a function
+    """
+
+    TYPE = "gauge"
+
+    def create_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def samples(self):
+        samples = []
+        for label_values, child in self.children.items():
+            try:
+                samples.append(("", label_values, (), child.get()))
+            except Exception as e:
+                logging.error(f"Error reading gauge {self.name}")
+                logging.error(e)
+        return samples
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "bucket_counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Non cumulative, last one is +Inf
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in fixed buckets
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=metricsParams.LATENCY_BUCKETS):
+        self.buckets = sorted(buckets)
+        super().__init__(name, help, label_names)
+
+    def create_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        samples = []
+        for label_values, child in self.children.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [math.inf], child.bucket_counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", label_values, (("le", format_value(float(bound))),), cumulative))
+            samples.append(("_sum", label_values, (), child.sum))
+            samples.append(("_count", label_values, (), child.count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Named metrics of the process, rendered in Prometheus text format
+    Asking twice for the same name returns the same metric,
+    so every smart object of a process shares its metrics
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, label_names=()):
+        return self.register(Counter, name, help, label_names)
+
+    def gauge(self, name, help, label_names=()):
+        return self.register(Gauge, name, help, label_names)
+
+    def histogram(self, name, help, label_names=(), buckets=metricsParams.LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, label_names, buckets=buckets)
+
+    def register(self, metric_class, name, help, label_names, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, help, label_names, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"Metric {name} is already registered as {metric.TYPE}")
+        return metric
+
+    def render(self):
+        """
+        :return: Prometheus text exposition of every metric
+        """
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+    def dump(self, file_path):
+        """
+        Write rendered metrics to file, replacing it atomically
+        :param file_path:str
+        :return:
+        """
+        try:
+            folder = os.path.dirname(file_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(file_path + ".tmp", "w") as f:
+                f.write(self.render())
+            os.replace(file_path + ".tmp", file_path)
+        except Exception as e:
+            logging.error("Error dumping metrics")
+            logging.error(e)
+
+    async def start_periodic_dump_task(self, file_path, interval=metricsParams.DUMP_INTERVAL):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.dump(file_path)
+        except asyncio.CancelledError:
+            self.dump(file_path)
+            raise
+        except Exception as e:
+            logging.error("Error in periodic metrics dump task")
+            logging.error(e)
+
+
+# Registry shared by the whole process
+REGISTRY = MetricsRegistry()
+
+
+def start_metrics_exporters(http_port=None, dump_path=None, registry=REGISTRY, serve_http=False):
+    """
+    Expose registry on http://HTTP_ADDRESS:http_port/metrics when HTTP_ENABLED
+    and dump it periodically to dump_path when given
+    Must be called from the running event loop
+    :param http_port:int
+    :param dump_path:str
+    :param registry: MetricsRegistry
+    :param serve_http: start the http server without /metrics, for the caller routes
+    :return: LocalHttpServer, None when http is disabled
+    """
+    http_server = None
+    if (metricsParams.HTTP_ENABLED or serve_http) and http_port:
+        http_server = LocalHttpServer(metricsParams.HTTP_ADDRESS, http_port)
+        if metricsParams.HTTP_ENABLED:
+            http_server.add_route("/metrics", lambda query: (HTTPStatus.OK, PROMETHEUS_CONTENT_TYPE, registry.render()))
+        asyncio.get_event_loop().create_task(http_server.start())
+    if dump_path:
+        asyncio.get_event_loop().create_task(registry.start_periodic_dump_task(dump_path))
+    return http_server
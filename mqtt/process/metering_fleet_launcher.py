@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import time
+
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
+from mqtt.process.metering_smart_object_process import create_metering_smart_object_process
+from mqtt.observability.logging_setup import configure_logging
+
+configure_logging()
+
+
+def expand_topology(topology):
+    """
+    Expand topology into plants
+    A location or plant with a count is numbered like padiglione-01 / impianto01
+    Duplicated resources in the same plant are discarded,
+    keeping one device per resource per plant across workers
+    :param topology: {"locations": [{"name", "count", "plants": [{"name", "count", "resources"}]}]}
+    :return: list of (location, plant, resources)
+    """
+    plants = {}
+    for location_group in topology["locations"]:
+        for location in expand_names(location_group, "{0}-{1:02d}"):
+            for plant_group in location_group["plants"]:
+                for plant in expand_names(plant_group, "{0}{1:02d}"):
+                    resources = plants.setdefault((location, plant), [])
+                    for resource in plant_group["resources"]:
+                        if resource in resources:
+                            logging.error(f"A {resource} device is already present at {location} on {plant} plant")
+                        else:
+                            resources.append(resource)
+    return [(location, plant, resources) for (location, plant), resources in plants.items()]
+
+
+def expand_names(group, name_format):
+    if "count" not in group:
+        return [group["name"]]
+    return [name_format.format(group["name"], index) for index in range(1, group["count"] + 1)]
+
+
+def split_plants(plants, worker_count):
+    """
+    Round robin whole plants across workers
+    :param plants: list of (location, plant, resources)
+    :param worker_count:int
+    :return: list of plant slices, one per worker
+    """
+    return [plants[worker_index::worker_count] for worker_index in range(worker_count)]
+
+
+async def report_publish_rate(worker_index, emulator_process, report_queue):
+    """
+    Periodically send worker published message count to the launcher
+    :param worker_index:int
+    :param emulator_process: MeteringSmartObjectProcess
+    :param report_queue: multiprocessing.Queue
+    :return:
+    """
+    try:
+        while True:
+            await asyncio.sleep(devParams.FLEET_REPORT_INTERVAL)
+            report_queue.put((worker_index, emulator_process.get_published_messages(), time.time()))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error("Error reporting publish rate")
+        logging.error(e)
+
+
+def run_fleet_worker(worker_index, plants, report_queue):
+    """
+    Worker process entry point
+    Emulates its plants on its own event loop
+    :param worker_index:int
+    :param plants: list of (location, plant, resources)
+    :param report_queue: multiprocessing.Queue
+    :return:
+    """
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        emulator_process = create_metering_smart_object_process()
+        for location, plant, resources in plants:
+            for resource in resources:
+                emulator_process.add_smart_obj(resource, location, plant)
+        logging.info(f"Fleet worker {worker_index} emulating {len(plants)} plants")
+        loop.create_task(report_publish_rate(worker_index, emulator_process, report_queue))
+        loop.run_forever()
+        report_queue.put((worker_index, emulator_process.get_published_messages(), time.time()))
+    except Exception as e:
+        logging.error(f"Error in fleet worker {worker_index}")
+        logging.error(e)
+    finally:
+        report_queue.put((worker_index, None, time.time()))
+
+
+class MeteringFleetLauncher:
+    """
+    Launch a fleet of metering smart objects described by a topology file
+    Plants are split across worker processes, each with its own event loop
+    Logs per worker publish rates
+    """
+
+    def __init__(self, topology_path=devParams.FLEET_TOPOLOGY_PATH, worker_count=devParams.FLEET_WORKERS):
+        with open(topology_path) as json_file:
+            self.plants = expand_topology(json.load(json_file))
+        self.worker_count = worker_count
+        self.report_queue = multiprocessing.Queue()
+        self.worker_processes = []
+
+    def start(self):
+        try:
+            for worker_index, plants in enumerate(split_plants(self.plants, self.worker_count)):
+                process = multiprocessing.Process(
+                    target=run_fleet_worker,
+                    args=(worker_index, plants, self.report_queue),
+                    name=f"metering-fleet-worker-{worker_index}",
+                    daemon=True
+                )
+                process.start()
+                self.worker_processes.append(process)
+            logging.info(f"Started {len(self.worker_processes)} fleet workers for {len(self.plants)} plants")
+        except Exception as e:
+            logging.error("Error starting fleet workers!")
+            logging.error(e)
+
+    def report_publish_rates(self):
+        """
+        Log per worker and total publish rates until every worker is done
+        :return:
+        """
+        last_reports = {}
+        rates = {}
+        running_workers = len(self.worker_processes)
+        while running_workers:
+            try:
+                worker_index, published_messages, timestamp = self.report_queue.get(timeout=devParams.FLEET_REPORT_INTERVAL)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.worker_processes):
+                    break
+                continue
+            if published_messages is None:
+                running_workers -= 1
+                rates.pop(worker_index, None)
+                continue
+            if worker_index in last_reports:
+                last_published_messages, last_timestamp = last_reports[worker_index]
+                rates[worker_index] = (published_messages - last_published_messages) / (timestamp - last_timestamp)
+                logging.info(f"Worker {worker_index}: {rates[worker_index]:.1f} msg/s ({published_messages} published), "
+                             f"fleet: {sum(rates.values()):.1f} msg/s")
+            last_reports[worker_index] = (published_messages, timestamp)
+
+    def stop(self):
+        for process in self.worker_processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        logging.info("Fleet workers stopped")
+
+
+def main():
+    launcher = MeteringFleetLauncher()
+    launcher.start()
+    launcher.report_publish_rates()
+    launcher.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+
+from datetime import datetime, timezone
+
+from mqtt.broker.in_process_broker import InProcessBroker
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
+from mqtt.conf.sensor_conf_values import WaterConfValues, GasConfValues, ElectricityConfValues
+from mqtt.consumer.policy_manager_data_collector import PolicyManagerAndDataCollector
+from mqtt.device.metering_smart_object import MeteringSmartObject
+from mqtt.process.metering_fleet_launcher import expand_topology
+from mqtt.process.virtual_clock import VirtualClock
+from mqtt.resource import sensor_simulation_engine
+from mqtt.resource.water_sensor_resource import WaterSensorResource
+from mqtt.resource.gas_sensor_resource import GasSensorResource
+from mqtt.resource.electricity_sensor_resource import ElectricitySensorResource
+from mqtt.resource.generic_actuator_resource import GenericActuatorResource
+from mqtt.storage.streaming_csv_sink import StreamingCsvSink
+
+# Resource name -> (sensor class, conf values)
+RESOURCES = {
+    "water": (WaterSensorResource, WaterConfValues),
+    "gas": (GasSensorResource, GasConfValues),
+    "electricity": (ElectricitySensorResource, ElectricityConfValues),
+}
+
+# Plant of the smart object process main
+DEFAULT_PLANTS = [("padiglione-01", "impianto01", ["gas", "water", "electricity"])]
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+
+def parse_duration(value):
+    """
+    :param value: seconds, or a number with an s, m, h, d or w suffix like 30d
+    :return: seconds
+    """
+    value = str(value).strip()
+    if value[-1:] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+
+def parse_start_time(value):
+    """
+    :param value: ISO date time, UTC when no offset is given
+    :return: epoch seconds
+    """
+    start = datetime.fromisoformat(value)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    return start.timestamp()
+
+
+class MeteringSimulation:
+    """
+    Deterministic fleet simulation on a virtual clock
+    Smart objects, policy manager and in-process broker share one event loop
+    whose time only advances when every task is waiting, so sensor periods,
+    telemetry timestamps and resume delays follow simulated time
+    Each sensor has its own random generator seeded from the simulation seed
+    and its position in the fleet: the same seed, start and fleet give the same data
+    """
+
+    def __init__(self, plants, seed=devParams.SIMULATION_SEED, output_path=devParams.SIMULATION_OUTPUT_PATH):
+        """
+        :param plants: list of (location, plant, resources), see expand_topology
+        :param seed: simulation seed
+        :param output_path: csv file of the records collected by the policy manager
+        """
+        self.plants = plants
+        self.seed = seed
+        self.output_path = output_path
+        self.smart_objects = []
+        self.collector = None
+        # Collector counters are process wide, totals before the run
+        self.initial_totals = (0, 0)
+
+    def collector_totals(self):
+        """
+        :return: (received records, threshold alerts) counted by the collector metrics
+        """
+        return (sum(child.value for child in self.collector.received_records.children.values()),
+                sum(child.value for child in self.collector.threshold_alerts.children.values()))
+
+    def create_rng(self, *names):
+        return random.Random("/".join(str(name) for name in (self.seed,) + names))
+
+    def create_simulation_engines(self):
+        """
+        :return: resource type -> seeded SensorSimulationEngine, None when disabled
+        """
+        if not devParams.SIMULATION_ENGINE_ENABLED:
+            return None
+        if sensor_simulation_engine.np is None:
+            logging.warning("numpy is not installed, sensors run their own update task")
+            return None
+        simulation_engines = {}
+        for _, sens_values in RESOURCES.values():
+            simulation_engine = sensor_simulation_engine.SensorSimulationEngine(sens_values, seed=self.create_rng(sens_values.RESOURCE_TYPE).getrandbits(64))
+            simulation_engines[sens_values.RESOURCE_TYPE] = simulation_engine
+            asyncio.get_event_loop().create_task(simulation_engine.start_periodic_tick_task())
+        return simulation_engines
+
+    async def create_smart_objects(self, broker):
+        simulation_engines = self.create_simulation_engines()
+        for location, plant, resources in self.plants:
+            for resource in resources:
+                sensor_class, _ = RESOURCES[resource]
+                rng = self.create_rng(location, plant, resource)
+                smart_object = MeteringSmartObject({
+                    "sensor": sensor_class(rng),
+                    "actuator": GenericActuatorResource()
+                }, resource, location, plant,
+                    simulation_engines=simulation_engines,
+                    mqtt_client=broker.create_client(client_id=f"simulation-{location}-{plant}-{resource}"),
+                    device_id=uuid.UUID(int=rng.getrandbits(128), version=4))
+                await smart_object.start(demo_time=None)
+                self.smart_objects.append(smart_object)
+
+    async def simulate(self, duration):
+        """
+        :param duration: virtual seconds
+        :return:
+        """
+        broker = InProcessBroker()
+        # One output file, daily rotation on virtual time would split it
+        record_sink = StreamingCsvSink(self.output_path, rotation_max_bytes=math.inf, rotation_max_age=math.inf)
+        # Nothing to recover and no thread in the loop, a simulation is rerun instead
+        self.collector = PolicyManagerAndDataCollector(
+            record_sinks=[record_sink],
+            mqtt_client=broker.create_client(client_id="simulation-policy-manager"),
+            write_ahead_log_path=None,
+            resume_persistence_path=None,
+            overload_policy="block"
+        )
+        self.initial_totals = self.collector_totals()
+        await self.collector.start(demo_time=None)
+        await self.create_smart_objects(broker)
+        await asyncio.sleep(duration)
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        record_sink.close()
+
+    def run(self, duration, start_time):
+        """
+        Run the simulation on a new event loop driven by a VirtualClock
+        :param duration: virtual seconds
+        :param start_time: epoch seconds of the simulated start
+        :return: run statistics
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        virtual_clock = VirtualClock(start_time)
+        virtual_clock.install(loop)
+        started_at = time.perf_counter()
+        try:
+            loop.run_until_complete(self.simulate(duration))
+        finally:
+            virtual_clock.uninstall()
+            loop.close()
+        wall_seconds = time.perf_counter() - started_at
+        received_records, alerts = (total - initial for total, initial in zip(self.collector_totals(), self.initial_totals))
+        return {
+            "devices": len(self.smart_objects),
+            "simulated_seconds": duration,
+            "wall_seconds": wall_seconds,
+            "speedup": duration / wall_seconds if wall_seconds > 0 else None,
+            "published_messages": sum(smart_object.published_messages for smart_object in self.smart_objects),
+            "received_records": received_records,
+            "alerts": alerts,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproducible fleet and policy manager simulation on a virtual clock")
+    parser.add_argument("--duration", type=parse_duration, default=devParams.SIMULATION_DURATION,
+                        help="simulated time, seconds or a number with s, m, h, d or w suffix")
+    parser.add_argument("--start", type=parse_start_time, default=devParams.SIMULATION_START,
+                        help="simulated start, ISO date time, UTC when no offset is given")
+    parser.add_argument("--seed", type=int, default=devParams.SIMULATION_SEED, help="simulation seed")
+    parser.add_argument("--topology", default=devParams.SIMULATION_TOPOLOGY_PATH,
+                        help="fleet topology file, defaults to the plant of the smart object process")
+    parser.add_argument("--output", default=devParams.SIMULATION_OUTPUT_PATH, help="csv file of the collected records")
+    args = parser.parse_args()
+
+    # Keep per message logging out of the run
+    logging.getLogger().setLevel(logging.WARNING)
+    plants = DEFAULT_PLANTS
+    if args.topology:
+        with open(args.topology) as json_file:
+            plants = expand_topology(json.load(json_file))
+    statistics = MeteringSimulation(plants, args.seed, args.output).run(args.duration, args.start)
+    for key, value in statistics.items():
+        print(f"{key:<20}{value:>14.2f}" if isinstance(value, float) else f"{key:<20}{value!s:>14}")
+    print(f"Records saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,60 @@ import logging
 import asyncio
 
 from collections import defaultdict
+from mqtt.conf.device_conf_params import DeviceConfigurationParams as devParams
+from mqtt.conf.metrics_conf_params import MetricsConfigurationParams as metricsParams
 from mqtt.device.metering_smart_object import MeteringSmartObject
+from mqtt.device.metering_gateway import MeteringGateway
+from mqtt.conf.sensor_conf_values import WaterConfValues, GasConfValues, ElectricityConfValues
+from mqtt.resource import sensor_simulation_engine
 from mqtt.resource.water_sensor_resource import WaterSensorResource
 from mqtt.resource.gas_sensor_resource import GasSensorResource
 from mqtt.resource.electricity_sensor_resource import ElectricitySensorResource
 from mqtt.resource.generic_actuator_resource import GenericActuatorResource
+from mqtt.observability.metrics_registry import start_metrics_exporters
+from mqtt.observability.logging_setup import configure_logging
 
-logging.basicConfig(level=logging.DEBUG,
-                    format="%(asctime)s %(levelname)-8s %(message)s")
+configure_logging()
 
 def nested_dict():
     return defaultdict(nested_dict)
 
 class MeteringSmartObjectProcess:
 
-    device_map = nested_dict()
+    def __init__(self, gateway=None, simulation_engines=None):
+        """
+        :param gateway: MeteringGateway shared by every smart object, None for one connection per device
+        :param simulation_engines: resource type -> SensorSimulationEngine, None for one update task per sensor
+        """
+        self.device_map = nested_dict()
+        self.gateway = gateway
+        self.simulation_engines = simulation_engines
+
+    def add_smart_obj(self, resource, location, plant):
+        """
+        Add smart object by resource name
+        :param resource: water, gas or electricity
+        :param location:
+        :param plant:
+        :return:
+        """
+        if resource == "water":
+            self.add_water_smart_obj(location, plant)
+        elif resource == "gas":
+            self.add_gas_smart_obj(location, plant)
+        elif resource == "electricity":
+            self.add_electricity_smart_obj(location, plant)
+        else:
+            logging.error(f"Unknown resource {resource}")
+
+    def get_published_messages(self):
+        """
+        :return: telemetry messages published by every device of the map
+        """
+        return sum(device.published_messages
+                   for plants in self.device_map.values()
+                   for resources in plants.values()
+                   for device in resources.values())
 
     def add_device_to_map(self, location, plant, resource, device):
         try:
@@ -36,7 +75,7 @@ class MeteringSmartObjectProcess:
             water_metering_smart_object = MeteringSmartObject({
                 "sensor" : WaterSensorResource(),
                 "actuator" : GenericActuatorResource()
-            }, type, location, plant)
+            }, type, location, plant, self.gateway, self.simulation_engines)
             if self.add_device_to_map(location, plant, type, water_metering_smart_object):
                 asyncio.get_event_loop().create_task(water_metering_smart_object.start())
         except Exception as e:
@@ -48,7 +87,7 @@ class MeteringSmartObjectProcess:
             gas_metering_smart_object = MeteringSmartObject({
                 "sensor": GasSensorResource(),
                 "actuator": GenericActuatorResource()
-            }, "gas", location, plant)
+            }, "gas", location, plant, self.gateway, self.simulation_engines)
             if self.add_device_to_map(location, plant, "gas", gas_metering_smart_object):
                 asyncio.get_event_loop().create_task(gas_metering_smart_object.start())
         except Exception as e:
@@ -60,15 +99,38 @@ class MeteringSmartObjectProcess:
             electricity_metering_smart_object = MeteringSmartObject({
                 "sensor": ElectricitySensorResource(),
                 "actuator": GenericActuatorResource()
-            }, "electricity", location, plant)
+            }, "electricity", location, plant, self.gateway, self.simulation_engines)
             if self.add_device_to_map(location, plant, "electricity", electricity_metering_smart_object):
                 asyncio.get_event_loop().create_task(electricity_metering_smart_object.start())
         except Exception as e:
             logging.error("Error creating Electricity Metering Smart Object")
             logging.error(e)
 
+def create_metering_smart_object_process():
+    """
+    Create emulator process on the current event loop
+    with gateway and simulation engines when enabled
+    :return MeteringSmartObjectProcess:
+    """
+    gateway = None
+    if devParams.GATEWAY_ENABLED:
+        gateway = MeteringGateway()
+        asyncio.get_event_loop().create_task(gateway.start())
+    simulation_engines = None
+    if devParams.SIMULATION_ENGINE_ENABLED and sensor_simulation_engine.np is None:
+        logging.warning("numpy is not installed, sensors run their own update task")
+    elif devParams.SIMULATION_ENGINE_ENABLED:
+        simulation_engines = {
+            sensValues.RESOURCE_TYPE: sensor_simulation_engine.SensorSimulationEngine(sensValues)
+            for sensValues in (WaterConfValues, GasConfValues, ElectricityConfValues)
+        }
+        for simulation_engine in simulation_engines.values():
+            asyncio.get_event_loop().create_task(simulation_engine.start_periodic_tick_task())
+    return MeteringSmartObjectProcess(gateway, simulation_engines)
+
 def main():
-    mqtt_consumer_emulator = MeteringSmartObjectProcess()
+    start_metrics_exporters(metricsParams.SMART_OBJECT_HTTP_PORT, metricsParams.SMART_OBJECT_DUMP_PATH)
+    mqtt_consumer_emulator = create_metering_smart_object_process()
     mqtt_consumer_emulator.add_gas_smart_obj("padiglione-01", "impianto01")
     mqtt_consumer_emulator.add_water_smart_obj("padiglione-01", "impianto01")
     mqtt_consumer_emulator.add_electricity_smart_obj("padiglione-01", "impianto01")
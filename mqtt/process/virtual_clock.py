@@ -0,0 +1,78 @@
+import time
+
+# Epoch seconds source of current_time, swapped by VirtualClock.install
+time_source = time.time
+
+
+def current_time():
+    """
+    Epoch seconds of message timestamps and resume deadlines
+    Wall clock time, or virtual time while a VirtualClock is installed
+    :return: float
+    """
+    return time_source()
+
+
+class VirtualClock:
+    """
+    Event loop clock advancing only when the loop would wait
+    loop.time() becomes virtual and, instead of blocking in the selector,
+    the clock jumps to the next scheduled callback, so asyncio.sleep
+    and call_later complete as fast as the CPU allows, in the same order
+    Meant for selector event loops without sockets, e.g. on the InProcessBroker:
+    waiting for real I/O does not advance it, results of executor threads
+    are picked up at whatever virtual time they arrive
+    """
+
+    def __init__(self, start_time):
+        """
+        :param start_time: epoch seconds at the virtual start
+        """
+        self.start_time = start_time
+        self.elapsed = 0.0
+        self.loop = None
+        self.select = None
+
+    def time(self):
+        """
+        :return: virtual loop.time(), seconds since install
+        """
+        return self.elapsed
+
+    def epoch_time(self):
+        return self.start_time + self.elapsed
+
+    def install(self, loop):
+        """
+        Drive loop and current_time() with the virtual clock
+        :param loop: selector event loop, not running yet
+        :return:
+        """
+        global time_source
+        self.loop = loop
+        self.select = loop._selector.select
+        loop.time = self.time
+        loop._selector.select = self.virtual_select
+        time_source = self.epoch_time
+
+    def uninstall(self):
+        global time_source
+        time_source = time.time
+        del self.loop.time
+        del self.loop._selector.select
+        self.loop = None
+
+    def virtual_select(self, timeout=None):
+        """
+        Poll without blocking, when nothing is ready move on by timeout
+        :param timeout: seconds to the next scheduled callback, None if there is none
+        :return: selector events
+        """
+        events = self.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Only an executor thread or a signal can wake the loop up
+            return self.select(None)
+        self.elapsed += timeout
+        return events
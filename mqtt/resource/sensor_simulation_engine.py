@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+# The engine needs numpy, devices fall back to one update task per sensor without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from mqtt.resource.resource_data_listener import Event
+
+INITIAL_CAPACITY = 64
+
+
+class SensorSimulationEngine:
+    """
+    Tick based simulation of every sensor of one resource type
+    Levels of all attached sensors live in one numpy array
+    and advance in a single vectorized step per tick
+    Changed values are emitted in bulk, then to each sensor listeners
+    """
+
+    def __init__(self, sens_values, seed=None):
+        """
+        :param sens_values: conf values class of the resource type (WaterConfValues, ...)
+        :param seed: random generator seed
+        """
+        self.sens_values = sens_values
+        self.rng = np.random.default_rng(seed)
+        self.sensors = []
+        self.levels = np.zeros(INITIAL_CAPACITY)
+        self.active = np.zeros(INITIAL_CAPACITY, dtype=bool)
+        # Called with (slots, values) of every changed sensor
+        self.bulk_listeners = Event()
+
+    def register(self, sensor, level):
+        """
+        Attach a sensor to the engine
+        :param sensor: sensor resource
+        :param level: sensor starting level
+        :return slot:int
+        """
+        slot = len(self.sensors)
+        if slot == len(self.levels):
+            self.levels = np.resize(self.levels, 2 * slot)
+            self.active = np.resize(self.active, 2 * slot)
+        self.sensors.append(sensor)
+        self.levels[slot] = level
+        self.active[slot] = sensor.is_active
+        return slot
+
+    def set_active(self, slot, is_active):
+        self.active[slot] = is_active
+
+    def step(self):
+        """
+        Advance levels of every active sensor by one random increment
+        :return: slots of changed sensors
+        """
+        count = len(self.sensors)
+        changed = np.flatnonzero(self.active[:count])
+        increments = self.sens_values.MIN_INCREASE + self.sens_values.MAX_INCREASE * self.rng.random(len(changed))
+        self.levels[changed] += increments
+        return changed
+
+    def emit(self, changed):
+        """
+        Emit changed levels to bulk listeners and to sensors
+        :param changed: slots of changed sensors
+        :return:
+        """
+        values = self.levels[changed]
+        if self.bulk_listeners:
+            self.bulk_listeners(changed, values)
+        sensors = self.sensors
+        for slot, value in zip(changed.tolist(), values.tolist()):
+            sensors[slot].apply_simulated_level(value)
+
+    async def start_periodic_tick_task(self):
+        try:
+            logging.info(f"Starting {self.sens_values.RESOURCE_TYPE} simulation engine with period {self.sens_values.UPDATE_DELAY}s")
+            await asyncio.sleep(self.sens_values.TASK_DELAY)
+            while True:
+                await asyncio.sleep(self.sens_values.UPDATE_DELAY)
+                self.emit(self.step())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in simulation engine tick!")
+            logging.error(e)
@@ -1,41 +1,63 @@
 import asyncio
 import random
-import time
 import uuid
 import logging
 
 from mqtt.resource.smart_object_resource import SmartObjectResource
+from mqtt.process.virtual_clock import current_time
 from mqtt.conf.sensor_conf_values import WaterConfValues as sensValues
 
 class WaterSensorResource(SmartObjectResource):
 
     RESOURCE_TYPE = sensValues.RESOURCE_TYPE
 
-    def __init__(self):
+    def __init__(self, rng=None):
+        """
+        :param rng: random.Random of this sensor, seeded for reproducible simulations
+        """
         super().__init__(uuid.uuid4(), self.RESOURCE_TYPE)
-        self.timestamp = int(time.time())
-        self.water_level = sensValues.MIN_USAGE + random.uniform(sensValues.MIN_USAGE, sensValues.MAX_USAGE) * random.uniform(0, 1)
+        self.rng = rng or random.Random()
+        self.timestamp = int(current_time())
+        self.water_level = sensValues.MIN_USAGE + self.rng.uniform(sensValues.MIN_USAGE, sensValues.MAX_USAGE) * self.rng.uniform(0, 1)
         self.is_active = True
+        self.simulation_engine = None
+        self.simulation_slot = None
 
     async def update_water_level(self):
-        self.water_level = self.water_level + (sensValues.MIN_INCREASE + sensValues.MAX_INCREASE * random.uniform(0, 1))
+        self.water_level = self.water_level + (sensValues.MIN_INCREASE + sensValues.MAX_INCREASE * self.rng.uniform(0, 1))
         await self.notify_update(self.water_level, type=self.type, unit=sensValues.UNIT)
         # TODO check if value < 0
         # TODO maybe add slow decrementing when not active
 
     async def start_periodic_event_value_update_task(self):
         try:
-            logging.info(f"Starting periodic Update Task with period {sensValues.UPDATE_DELAY}s")
+            logging.info("Starting periodic Update Task with period %ss", sensValues.UPDATE_DELAY)
             await asyncio.sleep(sensValues.TASK_DELAY)
             while True:
                 await asyncio.sleep(sensValues.UPDATE_DELAY)
                 if self.is_active:
                     await self.update_water_level()
                 else:
-                    logging.info(f"Water supply monitored by device {self.id} is switched OFF")
+                    logging.info("Water supply monitored by device %s is switched OFF", self.id)
         except Exception as e:
             logging.error("Error starting periodic event value update!")
             logging.error(e)
 
+    def attach_simulation_engine(self, simulation_engine):
+        """
+        Let a SensorSimulationEngine drive the water level
+        instead of the periodic event value update task
+        :param simulation_engine: SensorSimulationEngine
+        :return:
+        """
+        self.simulation_engine = simulation_engine
+        self.simulation_slot = simulation_engine.register(self, self.water_level)
+
+    def apply_simulated_level(self, level):
+        self.water_level = level
+        self.resource_data_listener(level, type=self.type, unit=sensValues.UNIT)
+
     def set_active(self, updated_value, **kwargs):
-        self.is_active = updated_value
\ No newline at end of file
+        self.is_active = updated_value
+        if self.simulation_engine:
+            self.simulation_engine.set_active(self.simulation_slot, updated_value)
\ No newline at end of file
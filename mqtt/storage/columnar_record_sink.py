@@ -0,0 +1,420 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+from array import array
+
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+
+# Fixed size .npy header, leaves room to grow the shape in place
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_HEADER_SIZE = 128
+BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+# column name -> (array typecode, npy descr)
+COLUMNS = {
+    "v": ("d", BYTE_ORDER + "f8"),
+    "t": ("q", BYTE_ORDER + "i8"),
+    "n": ("i", BYTE_ORDER + "i4"),
+    "u": ("i", BYTE_ORDER + "i4"),
+}
+# Columns stored as codes into a per partition dictionary
+DICTIONARY_COLUMNS = ("n", "u")
+# Rows of a partition present in every column, written after the columns
+MANIFEST_FILE = "manifest.json"
+
+SECONDS_PER_DAY = 86400
+
+
+def build_partition_folder(root_folder, resource_type, day):
+    """
+    Craft partition folder from resource type and day
+    <root>/bn=iot_sensor_water/day=2022-01-27
+    :param root_folder:str
+    :param resource_type:str bn
+    :param day:str YYYY-MM-DD
+    :return partition_folder:str
+    """
+    return os.path.join(root_folder, "bn=" + resource_type.replace(":", "_"), "day=" + day)
+
+
+def fsync_path(path):
+    """
+    fsync a file, or on posix a folder so the names of new and replaced files are durable
+    :param path: file or folder
+    :return:
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def build_npy_header(descr, length):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, length)
+    padding = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - len(header) - 1
+    return NPY_MAGIC + struct.pack("<H", NPY_HEADER_SIZE - len(NPY_MAGIC) - 2) + header.encode("latin1") + b" " * padding + b"\n"
+
+
+class ColumnFile:
+    """
+    Append-only .npy column file
+    Data is appended and the shape in the fixed size header is rewritten
+    so the file stays readable by numpy.load at every flush
+    """
+
+    def __init__(self, file_path, column):
+        self.file_path = file_path
+        self.typecode, self.descr = COLUMNS[column]
+        self.item_size = array(self.typecode).itemsize
+        self.length = None
+
+    def append(self, values):
+        """
+        Append values and rewrite header length
+        Bytes past the header length, left by an interrupted flush, are overwritten
+        :param values: array of column typecode
+        :return:
+        """
+        if not os.path.isfile(self.file_path):
+            with open(self.file_path, "wb") as f:
+                f.write(build_npy_header(self.descr, 0))
+            self.length = 0
+        with open(self.file_path, "r+b") as f:
+            if self.length is None:
+                self.length = self.read_length(f)
+            f.seek(NPY_HEADER_SIZE + self.length * self.item_size)
+            values.tofile(f)
+            f.truncate()
+            self.length += len(values)
+            f.seek(0)
+            f.write(build_npy_header(self.descr, self.length))
+
+    def read_length(self, f):
+        f.seek(0)
+        header = f.read(NPY_HEADER_SIZE).decode("latin1")
+        return int(header.split("'shape': (")[1].split(",")[0])
+
+    def stored_length(self):
+        """
+        :return: length in the file header, 0 when the file does not exist
+        """
+        if not os.path.isfile(self.file_path):
+            return 0
+        with open(self.file_path, "rb") as f:
+            return self.read_length(f)
+
+    def truncate(self, length):
+        """
+        Drop values past length, left by a flush interrupted between columns
+        :param length: committed values
+        :return:
+        """
+        with open(self.file_path, "r+b") as f:
+            f.truncate(NPY_HEADER_SIZE + length * self.item_size)
+            f.seek(0)
+            f.write(build_npy_header(self.descr, length))
+        self.length = length
+
+
+def load_committed_rows(folder):
+    """
+    :param folder: partition folder
+    :return: rows in the manifest, None for partitions written without one
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)["rows"]
+
+
+class ColumnarPartition:
+    """
+    Typed columns of one (bn, day) partition
+    v float64, t int64, n/u int32 codes into dictionaries saved as json
+    The manifest holds the rows written to every column, it is replaced
+    after the columns, so rows past it are from an interrupted flush
+    and are truncated when the partition is opened
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.column_files = {column: ColumnFile(os.path.join(folder, column + ".npy"), column) for column in COLUMNS}
+        self.dictionaries = {column: self.load_dictionary(column) for column in DICTIONARY_COLUMNS}
+        self.dictionary_codes = {column: {value: code for code, value in enumerate(values)}
+                                 for column, values in self.dictionaries.items()}
+        self.rows = self.recover_rows()
+
+    def recover_rows(self):
+        """
+        Truncate columns to the committed rows
+        Without a manifest the shortest column is taken as committed
+        :return: committed rows
+        """
+        lengths = {column: column_file.stored_length() for column, column_file in self.column_files.items()}
+        rows = min(lengths.values())
+        committed_rows = load_committed_rows(self.folder)
+        if committed_rows is not None:
+            rows = min(rows, committed_rows)
+        for column, column_file in self.column_files.items():
+            if lengths[column] > rows:
+                logging.warning(f"Dropping {lengths[column] - rows} uncommitted values from {column_file.file_path}")
+                column_file.truncate(rows)
+            else:
+                column_file.length = lengths[column]
+        return rows
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.folder, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"rows": self.rows}, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def sync(self):
+        """
+        fsync columns and dictionaries, then the manifest and the folder
+        :return:
+        """
+        for column_file in self.column_files.values():
+            if os.path.isfile(column_file.file_path):
+                fsync_path(column_file.file_path)
+        for column in DICTIONARY_COLUMNS:
+            dictionary_path = os.path.join(self.folder, column + ".dict.json")
+            if os.path.isfile(dictionary_path):
+                fsync_path(dictionary_path)
+        manifest_path = os.path.join(self.folder, MANIFEST_FILE)
+        if os.path.isfile(manifest_path):
+            fsync_path(manifest_path)
+        if os.name == "posix":
+            fsync_path(self.folder)
+
+    def load_dictionary(self, column):
+        dictionary_path = os.path.join(self.folder, column + ".dict.json")
+        if os.path.isfile(dictionary_path):
+            with open(dictionary_path) as f:
+                return json.load(f)
+        return []
+
+    def save_dictionary(self, column):
+        dictionary_path = os.path.join(self.folder, column + ".dict.json")
+        with open(dictionary_path + ".tmp", "w") as f:
+            json.dump(self.dictionaries[column], f)
+        os.replace(dictionary_path + ".tmp", dictionary_path)
+
+    def encode(self, column, value):
+        codes = self.dictionary_codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.dictionaries[column])
+            self.dictionaries[column].append(value)
+        return code
+
+    def append_rows(self, rows):
+        """
+        Append rows to partition columns
+        Dictionaries are saved before the codes that refer to them,
+        the manifest after every column
+        On failure new codes are forgotten and columns rewind to the committed rows,
+        so a retry encodes and saves them again
+        :param rows: list of (n, bn, v, u, t, seq), seq is not stored
+        :return:
+        """
+        dictionary_sizes = {column: len(values) for column, values in self.dictionaries.items()}
+        try:
+            columns = {column: array(typecode) for column, (typecode, _) in COLUMNS.items()}
+            for n, bn, v, u, t, *_ in rows:
+                columns["n"].append(self.encode("n", str(n)))
+                columns["v"].append(float(v))
+                columns["u"].append(self.encode("u", u or ""))
+                columns["t"].append(int(t))
+            for column, size in dictionary_sizes.items():
+                if len(self.dictionaries[column]) != size:
+                    self.save_dictionary(column)
+            for column, values in columns.items():
+                self.column_files[column].append(values)
+            self.rows += len(rows)
+            self.save_manifest()
+        except Exception:
+            self.rollback(dictionary_sizes)
+            raise
+
+    def rollback(self, dictionary_sizes):
+        """
+        :param dictionary_sizes: dictionary lengths before the failed append
+        :return:
+        """
+        for column, size in dictionary_sizes.items():
+            for value in self.dictionaries[column][size:]:
+                del self.dictionary_codes[column][value]
+            del self.dictionaries[column][size:]
+        for column_file in self.column_files.values():
+            column_file.length = self.rows
+
+
+class ColumnarRecordSink:
+    """
+    Columnar sink for senml records
+    Partitioned by resource type (bn) and day
+    Same streaming interface as StreamingCsvSink
+    """
+
+    def __init__(self, root_folder=storageParams.COLUMNAR_FOLDER,
+                 flush_batch_size=storageParams.FLUSH_BATCH_SIZE):
+        """
+        :param root_folder: partitions root
+        :param flush_batch_size: rows buffered before being written
+        """
+        self.root_folder = root_folder
+        self.flush_batch_size = flush_batch_size
+        self.pending_rows = {}
+        self.pending_count = 0
+        self.partitions = {}
+        # Partitions appended since the last synced flush, by key
+        self.unsynced_partitions = {}
+
+    def open(self):
+        try:
+            os.makedirs(self.root_folder, exist_ok=True)
+            logging.info(f"Writing columnar partitions to {self.root_folder}")
+        except Exception as e:
+            logging.error("Error opening columnar folder")
+            logging.error(e)
+
+    def write_record(self, row):
+        """
+        Buffer a row under its (bn, day) partition
+        :param row: values in header order (n, bn, v, u, t, seq)
+        :return:
+        """
+        key = (row[1], int(row[4]) // SECONDS_PER_DAY)
+        rows = self.pending_rows.get(key)
+        if rows is None:
+            rows = self.pending_rows[key] = []
+        rows.append(row)
+        self.pending_count += 1
+        if self.pending_count >= self.flush_batch_size:
+            self.flush()
+
+    def buffered_records(self):
+        return self.pending_count
+
+    def flush(self, sync=False):
+        """
+        Append buffered rows to each partition columns
+        A partition leaves the buffer once appended, a failure keeps only the others
+        :param sync: fsync partitions appended since the last synced flush
+        :return: False when rows could not be written or synced
+        """
+        try:
+            for key, rows in list(self.pending_rows.items()):
+                partition = self.get_partition(key)
+                partition.append_rows(rows)
+                self.unsynced_partitions[key] = partition
+                del self.pending_rows[key]
+                self.pending_count -= len(rows)
+                logging.debug(f"{len(rows)} records written to partition {key}")
+            if sync:
+                return self.sync()
+            return True
+        except Exception as e:
+            logging.error("Error writing records to columnar partitions")
+            logging.error(e)
+            return False
+
+    def sync(self):
+        """
+        fsync partitions appended since the last sync
+        Safe from an executor thread while the event loop keeps appending
+        :return: False when a partition could not be synced, it is synced again next time
+        """
+        partitions, self.unsynced_partitions = self.unsynced_partitions, {}
+        try:
+            for key, partition in list(partitions.items()):
+                partition.sync()
+                del partitions[key]
+            return True
+        except Exception as e:
+            for key, partition in partitions.items():
+                self.unsynced_partitions.setdefault(key, partition)
+            logging.error("Error syncing columnar partitions")
+            logging.error(e)
+            return False
+
+    def get_partition(self, key):
+        partition = self.partitions.get(key)
+        if partition is None:
+            resource_type, day_index = key
+            day = time.strftime("%Y-%m-%d", time.gmtime(day_index * SECONDS_PER_DAY))
+            partition = self.partitions[key] = ColumnarPartition(
+                build_partition_folder(self.root_folder, resource_type, day))
+            # Only today's and yesterday's partitions are expected to grow
+            for old_key in [k for k in self.partitions if k[1] < day_index - 1]:
+                del self.partitions[old_key]
+        return partition
+
+    async def start_periodic_flush_task(self, interval=storageParams.FLUSH_INTERVAL):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in periodic flush task")
+            logging.error(e)
+
+    def close(self):
+        self.flush()
+        self.partitions = {}
+
+
+def load_columnar_records(resource_type, start_day, end_day, columns=("n", "v", "u", "t"),
+                          root_folder=storageParams.COLUMNAR_FOLDER):
+    """
+    Load one resource family between two days (inclusive) as a pandas DataFrame
+    Only the requested columns of the matching partitions are read
+    n/u are returned as categoricals, a missing unit as an empty string
+    :param resource_type:str bn
+    :param start_day:str YYYY-MM-DD
+    :param end_day:str YYYY-MM-DD
+    :param columns: subset of n, v, u, t
+    :param root_folder: partitions root
+    :return DataFrame:
+    """
+    import numpy as np
+    import pandas as pd
+
+    family_folder = os.path.dirname(build_partition_folder(root_folder, resource_type, start_day))
+    frames = []
+    for partition_name in sorted(os.listdir(family_folder)) if os.path.isdir(family_folder) else []:
+        day = partition_name[len("day="):]
+        if not start_day <= day <= end_day:
+            continue
+        folder = os.path.join(family_folder, partition_name)
+        data = {column: np.load(os.path.join(folder, column + ".npy"), mmap_mode="r") for column in columns}
+        # Values past the manifest rows belong to an interrupted flush
+        committed_rows = load_committed_rows(folder)
+        if committed_rows is None:
+            committed_rows = min(len(values) for values in data.values())
+        for column in columns:
+            values = data[column][:committed_rows]
+            if column in DICTIONARY_COLUMNS:
+                with open(os.path.join(folder, column + ".dict.json")) as f:
+                    values = pd.Categorical.from_codes(values, categories=json.load(f))
+            data[column] = values
+        frames.append(pd.DataFrame(data))
+    if not frames:
+        return pd.DataFrame(columns=list(columns))
+    df = pd.concat(frames, ignore_index=True)
+    for column in DICTIONARY_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype("category")
+    df["bn"] = resource_type
+    return df
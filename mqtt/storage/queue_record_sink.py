@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import queue
+import time
+
+from collections import namedtuple
+
+from mqtt.conf.policy_manager_conf_params import PolicyManagerConfigurationParams as pmParams
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+
+# Sent by a shard to have the supervisor sync its sinks, answered with (sync_id, synced) on the shard ack queue
+SyncRequest = namedtuple("SyncRequest", ["shard_index", "sync_id"])
+
+
+class QueueRecordSink:
+    """
+    Record sink of a policy manager shard
+    Sends batches of rows to the supervisor through a multiprocessing queue
+    None is sent on close to tell the supervisor the shard is done
+    """
+
+    def __init__(self, record_queue, ack_queue=None, shard_index=0,
+                 flush_batch_size=pmParams.SHARD_RECORD_BATCH_SIZE,
+                 sync_timeout=pmParams.SHARD_SYNC_TIMEOUT):
+        """
+        :param record_queue: multiprocessing.Queue read by the supervisor
+        :param ack_queue: multiprocessing.Queue of the supervisor answers to sync requests, None never syncs
+        :param shard_index: shard owning the sink
+        :param flush_batch_size: rows buffered before being sent
+        :param sync_timeout: max seconds waiting for a sync answer
+        """
+        self.record_queue = record_queue
+        self.ack_queue = ack_queue
+        self.shard_index = shard_index
+        self.flush_batch_size = flush_batch_size
+        self.sync_timeout = sync_timeout
+        self.pending_rows = []
+        self.next_sync_id = 0
+
+    def open(self):
+        pass
+
+    def write_record(self, row):
+        self.pending_rows.append(row)
+        if len(self.pending_rows) >= self.flush_batch_size:
+            self.flush()
+
+    def buffered_records(self):
+        return len(self.pending_rows)
+
+    def flush(self, sync=False):
+        """
+        :param sync: rows must be on disk when True is returned
+        :return: False when rows could not be sent, they stay buffered, or could not be synced
+        """
+        try:
+            if self.pending_rows:
+                self.record_queue.put(self.pending_rows)
+                self.pending_rows = []
+            return self.sync() if sync else True
+        except Exception as e:
+            logging.error("Error sending records to supervisor")
+            logging.error(e)
+            return False
+
+    def sync(self):
+        """
+        Have the supervisor sync its sinks and wait for its answer, run in the executor
+        Rows sent before the call are on disk when True is returned
+        :return: False without ack queue, on timeout or when the supervisor could not sync
+        """
+        if self.ack_queue is None:
+            return False
+        try:
+            sync_id = self.next_sync_id
+            self.next_sync_id += 1
+            self.record_queue.put(SyncRequest(self.shard_index, sync_id))
+            deadline = time.monotonic() + self.sync_timeout
+            while True:
+                acked_id, synced = self.ack_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                # Older answers belong to requests that timed out
+                if acked_id == sync_id:
+                    return synced
+        except queue.Empty:
+            logging.error(f"Supervisor did not sync shard {self.shard_index} records within {self.sync_timeout} seconds")
+            return False
+        except Exception as e:
+            logging.error("Error syncing records with supervisor")
+            logging.error(e)
+            return False
+
+    async def start_periodic_flush_task(self, interval=storageParams.FLUSH_INTERVAL):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in periodic flush task")
+            logging.error(e)
+
+    def close(self):
+        self.flush()
+        self.record_queue.put(None)
@@ -0,0 +1,187 @@
+import json
+
+from array import array
+from http import HTTPStatus
+
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+
+
+class DeviceRingBuffer:
+    """
+    Last samples of one device in fixed memory
+    Timestamps and values are two preallocated array('d'),
+    the oldest sample is overwritten when full
+    """
+
+    __slots__ = ("capacity", "timestamps", "values", "next_index", "count")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.next_index = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        index = self.next_index
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.next_index = index + 1 if index + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def samples(self):
+        """
+        :return: (timestamps, values) lists, oldest first
+        """
+        if self.count < self.capacity:
+            return self.timestamps[:self.count].tolist(), self.values[:self.count].tolist()
+        index = self.next_index
+        return ((self.timestamps[index:] + self.timestamps[:index]).tolist(),
+                (self.values[index:] + self.values[:index]).tolist())
+
+
+def downsample(timestamps, values, points):
+    """
+    Average consecutive samples into at most points buckets
+    :return: (timestamps, values) lists
+    """
+    if points <= 0 or len(timestamps) <= points:
+        return timestamps, values
+    bucket_timestamps = []
+    bucket_values = []
+    for bucket in range(points):
+        start = bucket * len(timestamps) // points
+        end = (bucket + 1) * len(timestamps) // points
+        bucket_timestamps.append(sum(timestamps[start:end]) / (end - start))
+        bucket_values.append(sum(values[start:end]) / (end - start))
+    return bucket_timestamps, bucket_values
+
+
+class RingBufferStore:
+    """
+    Live time series of every device, one DeviceRingBuffer each
+    Devices are indexed by location, plant and resource family
+    Resource family is matched both as bn (iot:sensor:water) and as topic level (water)
+    """
+
+    def __init__(self, capacity=storageParams.RING_BUFFER_CAPACITY):
+        """
+        :param capacity: samples kept per device
+        """
+        self.capacity = capacity
+        # device telemetry topic -> DeviceRingBuffer
+        self.topic_buffers = {}
+        # device id -> DeviceRingBuffer
+        self.buffers = {}
+        # device id -> ParsedTopic
+        self.devices = {}
+        self.location_index = {}
+        self.plant_index = {}
+        self.resource_index = {}
+
+    def add(self, parsed_topic, record):
+        """
+        :param parsed_topic: ParsedTopic of the record telemetry topic
+        :param record: TelemetryRecord
+        :return:
+        """
+        buffer = self.topic_buffers.get(parsed_topic.telemetry_topic)
+        if buffer is None:
+            buffer = self.topic_buffers[parsed_topic.telemetry_topic] = self.create_buffer(parsed_topic, record.bn)
+        buffer.append(record.t, record.v)
+
+    def create_buffer(self, parsed_topic, resource_type):
+        device_id = parsed_topic.device_id
+        buffer = self.buffers[device_id] = DeviceRingBuffer(self.capacity)
+        self.devices[device_id] = parsed_topic
+        self.location_index.setdefault(parsed_topic.location, set()).add(device_id)
+        self.plant_index.setdefault((parsed_topic.location, parsed_topic.plant), set()).add(device_id)
+        self.resource_index.setdefault(resource_type, set()).add(device_id)
+        self.resource_index.setdefault(parsed_topic.resource, set()).add(device_id)
+        return buffer
+
+    def select(self, device=None, location=None, plant=None, resource=None):
+        """
+        Devices matching every given filter, plant needs location
+        :return: sorted list of device ids
+        """
+        if plant is not None and location is None:
+            raise ValueError("plant filter needs a location")
+        selections = []
+        if device is not None:
+            selections.append({device} if device in self.buffers else set())
+        if plant is not None:
+            selections.append(self.plant_index.get((location, plant), set()))
+        elif location is not None:
+            selections.append(self.location_index.get(location, set()))
+        if resource is not None:
+            selections.append(self.resource_index.get(resource, set()))
+        if not selections:
+            return sorted(self.buffers)
+        return sorted(set.intersection(*selections))
+
+    def query(self, device_ids, last=None, start=None, end=None, points=None):
+        """
+        Series of the given devices
+        :param device_ids: see select
+        :param last: keep only the last N samples
+        :param start: keep samples with timestamp >= start
+        :param end: keep samples with timestamp <= end
+        :param points: downsample to at most K points
+        :return: {device id: {"location", "plant", "resource", "t": [...], "v": [...]}}
+        """
+        series = {}
+        for device_id in device_ids:
+            timestamps, values = self.buffers[device_id].samples()
+            if start is not None or end is not None:
+                low = -float("inf") if start is None else start
+                high = float("inf") if end is None else end
+                selected = [index for index, timestamp in enumerate(timestamps) if low <= timestamp <= high]
+                timestamps = [timestamps[index] for index in selected]
+                values = [values[index] for index in selected]
+            if last is not None:
+                first = max(len(timestamps) - last, 0)
+                timestamps, values = timestamps[first:], values[first:]
+            if points is not None:
+                timestamps, values = downsample(timestamps, values, points)
+            parsed_topic = self.devices[device_id]
+            series[device_id] = {
+                "location": parsed_topic.location,
+                "plant": parsed_topic.plant,
+                "resource": parsed_topic.resource,
+                "t": timestamps,
+                "v": values,
+            }
+        return series
+
+    def handle_series_request(self, query):
+        """
+        LocalHttpServer handler of /series
+        Filters: device, location, plant, resource
+        Options: last=N, start=t0, end=t1 (epoch seconds), points=K
+        :param query: request parameters
+        :return: (HTTPStatus, content type, json body)
+        """
+        device_ids = self.select(query.get("device"), query.get("location"), query.get("plant"), query.get("resource"))
+        series = self.query(
+            device_ids,
+            last=parse_parameter(query, "last", int),
+            start=parse_parameter(query, "start", float),
+            end=parse_parameter(query, "end", float),
+            points=parse_parameter(query, "points", int)
+        )
+        return HTTPStatus.OK, "application/json", json.dumps(series)
+
+
+def parse_parameter(query, name, convert):
+    value = query.get(name)
+    if value is None:
+        return None
+    try:
+        value = convert(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return value
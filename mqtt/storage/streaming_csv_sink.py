@@ -0,0 +1,198 @@
+import asyncio
+import csv
+import logging
+import os
+import time
+
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+from mqtt.observability.metrics_registry import REGISTRY
+from mqtt.process.virtual_clock import current_time
+
+
+class StreamingCsvSink:
+    """
+    Streaming CSV sink for senml records
+    Buffers rows and appends them to file in batches
+    Flushes when the batch is full or periodically
+    Rotates the active file by size or age
+    Memory use is bound by the batch size, not by the run length
+    """
+
+    def __init__(self, file_path,
+                 header=storageParams.CSV_HEADER,
+                 flush_batch_size=storageParams.FLUSH_BATCH_SIZE,
+                 max_buffered_records=storageParams.MAX_BUFFERED_RECORDS,
+                 rotation_max_bytes=storageParams.ROTATION_MAX_BYTES,
+                 rotation_max_age=storageParams.ROTATION_MAX_AGE):
+        """
+        :param file_path: active csv file, rotated files are written next to it
+        :param header: csv header, the leading row values must follow its order
+        :param flush_batch_size: rows buffered before being written
+        :param max_buffered_records: rows kept while writes fail, the oldest are dropped beyond it
+        :param rotation_max_bytes: max size of the active file
+        :param rotation_max_age: max age in seconds of the active file
+        """
+        self.file_path = file_path
+        self.header = list(header)
+        self.row_length = len(self.header)
+        self.flush_batch_size = flush_batch_size
+        self.max_buffered_records = max_buffered_records
+        self.rotation_max_bytes = rotation_max_bytes
+        self.rotation_max_age = rotation_max_age
+        self.pending_rows = []
+        self.file = None
+        self.writer = None
+        self.opened_at = None
+        self.dropped_records = REGISTRY.counter(
+            "record_sink_dropped_records_total", "Buffered records dropped by a sink that could not write them", ("sink",)).labels("csv")
+
+    def open(self):
+        """
+        Open the active file and write the header
+        A non-empty file left by a previous run is rotated, not overwritten
+        :return:
+        """
+        try:
+            folder = os.path.dirname(self.file_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            if os.path.isfile(self.file_path) and os.path.getsize(self.file_path) > 0:
+                os.rename(self.file_path, self.build_rotated_file_path())
+            self.file = open(self.file_path, "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.header)
+            self.file.flush()
+            self.opened_at = current_time()
+            logging.info(f"Writing header {self.header} to {self.file_path}")
+        except Exception as e:
+            logging.error("Error opening csv file")
+            logging.error(e)
+
+    def write_record(self, row):
+        """
+        Buffer a row, flushing when the batch is full
+        :param row: values in record order (n, bn, v, u, t, seq), those past the header are not written
+        :return:
+        """
+        self.pending_rows.append(row[:self.row_length])
+        if len(self.pending_rows) >= self.flush_batch_size:
+            self.flush()
+
+    def buffered_records(self):
+        return len(self.pending_rows)
+
+    def flush(self, sync=False):
+        """
+        Append buffered rows to the active file and rotate it if needed
+        :param sync: fsync the active file, rows are on disk when True is returned
+        :return: False when rows could not be written, they stay buffered up to max_buffered_records
+        """
+        try:
+            written = len(self.pending_rows)
+            if written:
+                if self.file is None:
+                    self.open()
+                self.writer.writerows(self.pending_rows)
+                self.file.flush()
+                logging.debug(f"{written} records written to {self.file_path}")
+                self.pending_rows = []
+            if sync and self.file is not None:
+                os.fsync(self.file.fileno())
+            if written and self.should_rotate():
+                self.rotate()
+            return True
+        except Exception as e:
+            logging.error("Error writing records to file")
+            logging.error(e)
+            excess = len(self.pending_rows) - self.max_buffered_records
+            if excess > 0:
+                # Like the drop_oldest overload policy, the newest records are kept
+                del self.pending_rows[:excess]
+                self.dropped_records.inc(excess)
+                logging.error(f"Dropped {excess} buffered records, {self.file_path} cannot be written")
+            return False
+
+    def sync(self):
+        """
+        fsync the active file, safe from an executor thread while the event loop keeps writing
+        A file rotated meanwhile was already synced by rotate
+        :return: False when the file could not be synced
+        """
+        try:
+            file = self.file
+            if file is not None:
+                os.fsync(file.fileno())
+            return True
+        except Exception as e:
+            logging.error("Error syncing csv file")
+            logging.error(e)
+            return False
+
+    def should_rotate(self):
+        return self.file.tell() >= self.rotation_max_bytes or current_time() - self.opened_at >= self.rotation_max_age
+
+    def rotate(self):
+        """
+        Close the active file, move it aside and open a new one
+        :return:
+        """
+        try:
+            # Rows of a rotated file are not synced by later flushes
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            rotated_file_path = self.build_rotated_file_path()
+            os.rename(self.file_path, rotated_file_path)
+            logging.info(f"Rotated {self.file_path} to {rotated_file_path}")
+            self.open()
+        except Exception as e:
+            logging.error("Error rotating csv file")
+            logging.error(e)
+
+    def build_rotated_file_path(self):
+        """
+        Craft rotated file name from the active one
+        industrial_metering_consumption-20220127-153000.csv
+        :return rotated_file_path:str
+        """
+        stem, extension = os.path.splitext(self.file_path)
+        suffix = time.strftime("%Y%m%d-%H%M%S", time.localtime(current_time()))
+        rotated_file_path = f"{stem}-{suffix}{extension}"
+        index = 1
+        while os.path.exists(rotated_file_path):
+            rotated_file_path = f"{stem}-{suffix}-{index}{extension}"
+            index += 1
+        return rotated_file_path
+
+    async def start_periodic_flush_task(self, interval=storageParams.FLUSH_INTERVAL):
+        """
+        Flush buffered rows every interval seconds
+        so a slow trickle of records still reaches the disk
+        :param interval:float
+        :return:
+        """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Error in periodic flush task")
+            logging.error(e)
+
+    def close(self):
+        """
+        Flush remaining rows and close the active file
+        :return:
+        """
+        self.flush()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                logging.info("Records successfully written to file")
+        except Exception as e:
+            logging.error("Error closing csv file")
+            logging.error(e)
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+
+from mqtt.conf.storage_conf_params import StorageConfigurationParams as storageParams
+
+# Entry frame: body length, crc32 of body, then body starting with the entry type
+FRAME_HEADER = struct.Struct("<II")
+ENTRY_TYPE = struct.Struct("<B")
+DOUBLE = struct.Struct("<d")
+INTEGER = struct.Struct("<q")
+STRING_LENGTH = struct.Struct("<H")
+NONE_STRING = 0xFFFF
+
+# Telemetry record: topic, n, bn, v, u, t, seq
+ENTRY_RECORD = 1
+# Threshold slot snapshot: topic, resource type, baseline level, notified
+ENTRY_THRESHOLD_STATE = 2
+# Pending resume: control topic, due time
+ENTRY_RESUME = 3
+# Resume sent: control topic
+ENTRY_RESUME_DONE = 4
+# Sequence window snapshot: topic, highest sequence, hex bitmask
+ENTRY_SEQUENCE_WINDOW = 5
+
+# Fields of each entry type, "s" string or None, "d" double, "b" flag, "i" integer or None,
+# "t" timestamp, a double read back as int when integral like the epoch seconds of devices
+ENTRY_FIELDS = {
+    ENTRY_RECORD: "sssdsti",
+    ENTRY_THRESHOLD_STATE: "ssdb",
+    ENTRY_RESUME: "sd",
+    ENTRY_RESUME_DONE: "s",
+    ENTRY_SEQUENCE_WINDOW: "sis",
+}
+
+
+def encode_entry(entry_type, *fields):
+    """
+    :param entry_type: ENTRY_* constant
+    :param fields: values matching ENTRY_FIELDS of entry_type
+    :return: framed entry bytes
+    """
+    body = bytearray(ENTRY_TYPE.pack(entry_type))
+    for kind, value in zip(ENTRY_FIELDS[entry_type], fields):
+        if kind == "s":
+            if value is None:
+                body += STRING_LENGTH.pack(NONE_STRING)
+            else:
+                encoded = str(value).encode("utf-8")
+                body += STRING_LENGTH.pack(len(encoded))
+                body += encoded
+        elif kind in "dt":
+            body += DOUBLE.pack(value)
+        elif kind == "i":
+            if value is None:
+                body.append(0)
+            else:
+                body.append(1)
+                body += INTEGER.pack(value)
+        else:
+            body.append(1 if value else 0)
+    return FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_entry(body):
+    """
+    :param body: entry body, crc already checked
+    :return: (entry type, list of fields)
+    """
+    entry_type = body[0]
+    offset = 1
+    fields = []
+    for kind in ENTRY_FIELDS[entry_type]:
+        if kind == "s":
+            length, = STRING_LENGTH.unpack_from(body, offset)
+            offset += STRING_LENGTH.size
+            if length == NONE_STRING:
+                fields.append(None)
+            else:
+                fields.append(body[offset:offset + length].decode("utf-8"))
+                offset += length
+        elif kind == "d":
+            fields.append(DOUBLE.unpack_from(body, offset)[0])
+            offset += DOUBLE.size
+        elif kind == "t":
+            timestamp, = DOUBLE.unpack_from(body, offset)
+            fields.append(int(timestamp) if timestamp.is_integer() else timestamp)
+            offset += DOUBLE.size
+        elif kind == "i":
+            offset += 1
+            if body[offset - 1]:
+                fields.append(INTEGER.unpack_from(body, offset)[0])
+                offset += INTEGER.size
+            else:
+                fields.append(None)
+        else:
+            fields.append(body[offset])
+            offset += 1
+    return entry_type, fields
+
+
+class WriteAheadLog:
+    """
+    Append-only log of collector state changes
+    Entries are length prefixed and crc checked, a torn tail is dropped on replay
+    Appends are buffered and written with one fsync per group commit,
+    every commit_interval seconds or commit_records entries
+    A checkpoint replaces the whole log with a state snapshot (compaction),
+    so replay only covers entries since the last checkpoint
+    Entries appended between start_checkpoint and checkpoint are kept after the snapshot
+    """
+
+    def __init__(self, file_path,
+                 commit_interval=storageParams.WAL_COMMIT_INTERVAL,
+                 commit_records=storageParams.WAL_COMMIT_RECORDS):
+        """
+        :param file_path: log file
+        :param commit_interval: max seconds between group commits
+        :param commit_records: appended entries forcing a group commit
+        """
+        self.file_path = file_path
+        self.commit_interval = commit_interval
+        self.commit_records = commit_records
+        self.file = None
+        self.buffer = bytearray()
+        self.buffered_entries = 0
+        # Entries appended since the last checkpoint
+        self.logged_entries = 0
+        # Snapshot replacing the log at the next commit
+        self.pending_snapshot = None
+        # Entries appended since start_checkpoint, None when no checkpoint is in progress
+        self.checkpoint_tail = None
+        self.checkpoint_tail_entries = 0
+        self.commit_requested = asyncio.Event()
+        self.commit_lock = asyncio.Lock()
+
+    def replay(self):
+        """
+        Read every valid entry of the log, truncating a torn or corrupted tail
+        Must be called before open
+        :return: list of (entry type, fields)
+        """
+        entries = []
+        if not os.path.isfile(self.file_path):
+            return entries
+        with open(self.file_path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + FRAME_HEADER.size <= len(data):
+            length, crc = FRAME_HEADER.unpack_from(data, offset)
+            body = data[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+            if len(body) < length or zlib.crc32(body) != crc or body[0] not in ENTRY_FIELDS:
+                break
+            try:
+                entries.append(decode_entry(body))
+            except (struct.error, UnicodeDecodeError, IndexError):
+                break
+            offset += FRAME_HEADER.size + length
+        if offset < len(data):
+            logging.warning(f"Dropping {len(data) - offset} bytes of torn or corrupted tail from {self.file_path}")
+            with open(self.file_path, "r+b") as f:
+                f.truncate(offset)
+        self.logged_entries = len(entries)
+        return entries
+
+    def open(self):
+        folder = os.path.dirname(self.file_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(self.file_path, "ab")
+
+    def append(self, entry_type, *fields):
+        """
+        Buffer an entry until the next group commit
+        :param entry_type: ENTRY_* constant
+        :param fields: entry fields
+        :return:
+        """
+        entry = encode_entry(entry_type, *fields)
+        self.buffer += entry
+        self.buffered_entries += 1
+        if self.checkpoint_tail is not None:
+            self.checkpoint_tail += entry
+            self.checkpoint_tail_entries += 1
+        self.logged_entries += 1
+        if self.buffered_entries >= self.commit_records:
+            self.commit_requested.set()
+
+    def start_checkpoint(self):
+        """
+        Mark the point the next checkpoint snapshot is built at
+        Entries appended from now on are kept by checkpoint, so the durable sinks
+        can be synced off the event loop while records keep coming
+        :return:
+        """
+        self.checkpoint_tail = bytearray()
+        self.checkpoint_tail_entries = 0
+
+    def cancel_checkpoint(self):
+        self.checkpoint_tail = None
+        self.checkpoint_tail_entries = 0
+
+    def checkpoint(self, snapshot):
+        """
+        Replace the log with snapshot at the next commit
+        Entries appended before this call, or before start_checkpoint when it was called,
+        are dropped: callers sync the durable sinks and build the snapshot at that point
+        :param snapshot: list of (entry type, fields) rebuilding the state at that point
+        :return:
+        """
+        tail = self.checkpoint_tail or b""
+        self.pending_snapshot = b"".join(encode_entry(entry_type, *fields) for entry_type, fields in snapshot) + tail
+        self.buffer = bytearray()
+        self.buffered_entries = 0
+        self.logged_entries = len(snapshot) + self.checkpoint_tail_entries
+        self.cancel_checkpoint()
+        self.commit_requested.set()
+
+    async def commit(self):
+        """
+        Write buffered entries (or the pending snapshot) and fsync, off the event loop
+        On failure the entries go back in front of the buffer, or are dropped
+        if a checkpoint replaced them meanwhile, and the error is raised
+        A cancelled commit holds the lock until the executor write is over
+        :return:
+        """
+        async with self.commit_lock:
+            snapshot, self.pending_snapshot = self.pending_snapshot, None
+            data, self.buffer = self.buffer, bytearray()
+            entries, self.buffered_entries = self.buffered_entries, 0
+            if snapshot is None and not data:
+                return
+            write = asyncio.get_event_loop().run_in_executor(None, self.write, snapshot, bytes(data))
+            try:
+                await asyncio.shield(write)
+            finally:
+                if not write.done():
+                    # The executor write cannot be interrupted, the next one must not overlap it
+                    await asyncio.wait((write,))
+                if write.exception() is not None and self.pending_snapshot is None:
+                    self.pending_snapshot = snapshot
+                    self.buffer = data + self.buffer
+                    self.buffered_entries += entries
+
+    def write(self, snapshot, data):
+        """
+        A failed write leaves the log as it was and the file open for the next one
+        :param snapshot: bytes replacing the log, None to append
+        :param data: bytes appended
+        :return:
+        """
+        if self.file.closed:
+            self.file = open(self.file_path, "ab")
+        if snapshot is not None:
+            self.file.close()
+            try:
+                with open(self.file_path + ".tmp", "wb") as f:
+                    f.write(snapshot)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.file_path + ".tmp", self.file_path)
+            finally:
+                self.file = open(self.file_path, "ab")
+        else:
+            offset = self.file.tell()
+            try:
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except Exception:
+                # Drop a partial write, the entries are written again by the next commit
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                os.truncate(self.file_path, offset)
+                self.file = open(self.file_path, "ab")
+                raise
+
+    async def start_group_commit_task(self, on_failure=None):
+        """
+        Commit every commit_interval or when commit_records entries are buffered
+        A failed commit is logged and retried after commit_interval, entries are kept
+        :param on_failure: called with the exception of each failed commit
+        :return:
+        """
+        while True:
+            # asyncio.wait, unlike wait_for, never swallows a cancellation
+            waiter = asyncio.ensure_future(self.commit_requested.wait())
+            try:
+                await asyncio.wait((waiter,), timeout=self.commit_interval)
+            finally:
+                waiter.cancel()
+            self.commit_requested.clear()
+            try:
+                await self.commit()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error committing write ahead log, {self.buffered_entries} entries kept for retry")
+                logging.error(e)
+                if on_failure:
+                    on_failure(e)
+                await asyncio.sleep(self.commit_interval)
+
+    async def close(self, snapshot=None):
+        """
+        Final commit, with a last checkpoint when snapshot is given
+        Waits for an in-flight group commit, the write runs off the event loop
+        :param snapshot: list of (entry type, fields) rebuilding the current state
+        :return:
+        """
+        try:
+            if snapshot is not None:
+                # Built now, the snapshot covers the entries of an interrupted checkpoint
+                self.cancel_checkpoint()
+                self.checkpoint(snapshot)
+            if self.file:
+                await self.commit()
+                self.file.close()
+                self.file = None
+        except Exception as e:
+            logging.error("Error closing write ahead log")
+            logging.error(e)